@@ -0,0 +1,227 @@
+"""Admission control and load shedding for the analysis API
+
+Under overload it is better to turn a few requests away at once than to
+queue them all and let every caller's latency grow. An AdmissionController
+admits a request only if
+
+    its client still has a token (`rate` requests per second, bursts up to
+    `burst`), otherwise 429 Too Many Requests, and
+    fewer than `max_concurrent` admitted requests are in flight, otherwise
+    503 Service Unavailable.
+
+Both rejections carry Retry-After and cost a dict lookup under a lock.
+
+An admitted request may also carry a deadline: the milliseconds its caller
+will wait, from the X-Request-Deadline-Ms header or the controller's
+default. Handlers call check_deadline() between stages; once the deadline
+has passed it raises DeadlineExceeded, answered with 503, so work nobody
+is waiting for stops early.
+
+Limits apply per process: with the prefork server each worker admits up to
+`max_concurrent` requests.
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import OrderedDict
+
+DEADLINE_HEADER = 'X-Request-Deadline-Ms'
+# Identifies the client for rate limiting; the remote address if absent
+CLIENT_HEADER = 'X-Client-Id'
+DEFAULT_MAX_CLIENTS = 10000
+
+# Monotonic deadline of the request being handled in this context
+_deadline = contextvars.ContextVar('admission_deadline', default=None)
+
+
+class Rejected(Exception):
+    """A request turned away before any work was done"""
+
+    def __init__(self, status, reason, retry_after=None):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before it finished"""
+
+
+def check_deadline(stage=None, deadline=None):
+    """Raise DeadlineExceeded if the current request's deadline has passed
+
+    Code that runs after the request context is gone (e.g. the generator of
+    a streamed body) passes the deadline it saved from current_deadline().
+    """
+    if deadline is None:
+        deadline = _deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}" if stage else 'Deadline exceeded')
+
+
+def current_deadline():
+    """Monotonic deadline of the current request, or None without one"""
+    return _deadline.get()
+
+
+def remaining():
+    """Seconds left until the current request's deadline, or None without one"""
+    deadline = _deadline.get()
+    return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+
+class Ticket:
+    """An admitted request's concurrency slot and deadline"""
+
+    def __init__(self, controller, deadline):
+        self.deadline = deadline
+        self._controller = controller
+        self._released = False
+
+    def release(self):
+        """Give the slot back; later calls do nothing"""
+        if not self._released:
+            self._released = True
+            self._controller._release()
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent=0, rate=0, burst=0, default_deadline_ms=0, retry_after=1,
+                 max_clients=DEFAULT_MAX_CLIENTS):
+        """0 turns off the concurrency limit, the rate limit or the default deadline
+
+        `burst` defaults to one second's worth of `rate`; `retry_after` is
+        the Retry-After (seconds) of a 503. Buckets are kept for the
+        `max_clients` most recently seen clients.
+        """
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.default_deadline_ms = default_deadline_ms
+        self.retry_after = retry_after
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._buckets = OrderedDict()  # client -> [tokens, monotonic time of last refill]
+        self._counts = {'admitted': 0, 'rate_limited': 0, 'overloaded': 0, 'deadline_exceeded': 0}
+
+    def _take_token(self, client, now):
+        """Seconds until the client has a token, 0 after taking one (lock held)"""
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = [self.burst, now]
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / self.rate
+        bucket[0] -= 1
+        return 0
+
+    def admit(self, client, deadline_ms=None):
+        """Ticket for an admitted request, or raise Rejected / DeadlineExceeded
+
+        `deadline_ms` is the caller's header value (text or number).
+        """
+        now = time.monotonic()
+        if deadline_ms is None or deadline_ms == '':
+            deadline_ms = self.default_deadline_ms or None
+        else:
+            try:
+                deadline_ms = float(deadline_ms)
+            except ValueError:
+                raise Rejected(400, f"{DEADLINE_HEADER} must be a number of milliseconds")
+            if deadline_ms <= 0:
+                self.record_deadline_exceeded()
+                raise DeadlineExceeded('Deadline exceeded on arrival')
+
+        with self._lock:
+            if self.max_concurrent and self._in_flight >= self.max_concurrent:
+                self._counts['overloaded'] += 1
+                raise Rejected(503, 'Server overloaded, retry later', self.retry_after)
+            if self.rate:
+                wait = self._take_token(client, now)
+                if wait:
+                    self._counts['rate_limited'] += 1
+                    raise Rejected(429, 'Rate limit exceeded', max(1, math.ceil(wait)))
+            self._in_flight += 1
+            self._counts['admitted'] += 1
+        return Ticket(self, None if deadline_ms is None else now + deadline_ms / 1000)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def record_deadline_exceeded(self):
+        with self._lock:
+            self._counts['deadline_exceeded'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._counts,
+                in_flight=self._in_flight,
+                max_concurrent=self.max_concurrent,
+                rate=self.rate,
+                burst=self.burst,
+                default_deadline_ms=self.default_deadline_ms,
+                clients=len(self._buckets)
+            )
+
+
+def install(app, controller, endpoints):
+    """Admit requests to the given Flask endpoints through `controller`
+
+    A streamed response keeps its slot until it has been sent. Handlers
+    let DeadlineExceeded propagate; it is answered with 503 here.
+    """
+    from flask import g, jsonify, request
+
+    def shed(message, status, retry_after):
+        response = jsonify({'error': message})
+        response.status_code = status
+        if retry_after:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint not in endpoints:
+            return None
+        client = request.headers.get(CLIENT_HEADER) or request.remote_addr
+        try:
+            ticket = controller.admit(client, request.headers.get(DEADLINE_HEADER))
+        except Rejected as e:
+            return shed(str(e), e.status, e.retry_after)
+        except DeadlineExceeded as e:
+            return shed(str(e), 503, controller.retry_after)
+        g.admission_ticket = ticket
+        _deadline.set(ticket.deadline)
+        return None
+
+    @app.after_request
+    def hold_while_streaming(response):
+        # The request context is gone before a streamed body is sent, so its
+        # slot is freed when the server closes the response instead
+        if response.is_streamed:
+            ticket = g.pop('admission_ticket', None)
+            if ticket is not None:
+                response.call_on_close(ticket.release)
+        return response
+
+    @app.teardown_request
+    def release_admission(exc):
+        ticket = g.pop('admission_ticket', None)
+        if ticket is not None:
+            ticket.release()
+        _deadline.set(None)
+
+    @app.errorhandler(DeadlineExceeded)
+    def deadline_exceeded(e):
+        controller.record_deadline_exceeded()
+        return shed(str(e), 503, controller.retry_after)
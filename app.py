@@ -1,12 +1,32 @@
-from flask import Flask, render_template, request, jsonify, send_file
-import pandas as pd
+from flask import Flask, render_template, request, jsonify, send_file, Response
+from werkzeug.wsgi import get_input_stream
 import numpy as np
+import io
 import os
 import sys
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.preprocessing import LabelEncoder
+import argparse
 import json
+import threading
+import time
+import uuid
 import warnings
+import admission
+import batching
+import cohort_stats
+import datasets
+import jobs
+import lab_schema
+import metrics
+import model_registry
+import model_store
+import result_cache
+import responses
+import retraining
+import similarity
+import symptom_search
+import synthetic
+import thresholds
+import tree_scorer
 warnings.filterwarnings('ignore')
 
 app = Flask(__name__)
@@ -27,6 +47,64 @@ UPLOAD_FOLDER = os.path.join('static', 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Micro-batching of concurrent /api/analyze calls (disabled when max size is 0)
+app.config['MICRO_BATCH_MAX_SIZE'] = int(os.environ.get('MICRO_BATCH_MAX_SIZE', 0))
+app.config['MICRO_BATCH_MAX_WAIT_US'] = int(os.environ.get('MICRO_BATCH_MAX_WAIT_US', 500))
+
+# Model artifact, and how often (seconds) to check it for a model published
+# by another process (0 disables the check)
+app.config['MODEL_PATH'] = model_store.DEFAULT_MODEL_PATH
+app.config['MODEL_RELOAD_INTERVAL'] = float(os.environ.get('MODEL_RELOAD_INTERVAL', 5))
+
+# Registered model (see model_registry.MODELS) to train and serve. Unset keeps
+# whatever kind of model the artifact holds.
+app.config['MODEL_NAME'] = os.environ.get('MODEL_NAME')
+
+# Labelled datasets the retraining API may read
+app.config['TRAINING_DATA_FOLDER'] = os.environ.get('TRAINING_DATA_FOLDER', '.')
+
+# Largest synthetic stream /api/generate_sample?n= will produce
+app.config['SYNTHETIC_MAX_ROWS'] = int(os.environ.get('SYNTHETIC_MAX_ROWS', 10000000))
+
+# Uploaded CSVs converted once to memory-mappable columns, keyed by content hash
+app.config['DATASET_FOLDER'] = datasets.DEFAULT_ROOT
+
+# Similar-patient search: the lab export indexed besides the dataset store, the
+# hack1 database, how often (seconds) to look for new hack1 records and how
+# many new records to buffer before the KD-tree is rebuilt
+app.config['SIMILARITY_CSV'] = os.environ.get('SIMILARITY_CSV', 'uploads.csv')
+app.config['HACK1_PATIENTS_DB'] = os.environ.get(
+    'PATIENTS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hack1', 'database', 'patients.db'))
+app.config['SIMILARITY_REFRESH_INTERVAL'] = float(os.environ.get('SIMILARITY_REFRESH_INTERVAL', 2))
+app.config['SIMILARITY_MAX_PENDING'] = int(os.environ.get('SIMILARITY_MAX_PENDING', similarity.DEFAULT_MAX_PENDING))
+
+# Asynchronous scoring jobs (/api/upload_csv?async=1): where inputs, results
+# and job state go, worker processes (0 = one per core, shared between the
+# prefork workers under `serve`) and CSV bytes per task
+app.config['JOB_FOLDER'] = os.environ.get('JOB_FOLDER', 'jobs')
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 0))
+app.config['JOB_BLOCK_BYTES'] = int(os.environ.get('JOB_BLOCK_BYTES', jobs.DEFAULT_BLOCK_BYTES))
+
+# Rollups behind /api/cohort_stats (shared with the hack1 app)
+app.config['COHORT_STATS_DB'] = cohort_stats.DEFAULT_DB_PATH
+
+# Full-text symptom search over uploaded records
+app.config['SYMPTOM_INDEX_DB'] = symptom_search.DEFAULT_DB_PATH
+
+# Cache of /api/analyze results for repeated panels (size 0 disables, TTL in seconds)
+app.config['RESULT_CACHE_SIZE'] = int(os.environ.get('RESULT_CACHE_SIZE', result_cache.DEFAULT_MAX_ENTRIES))
+app.config['RESULT_CACHE_TTL'] = float(os.environ.get('RESULT_CACHE_TTL', result_cache.DEFAULT_TTL))
+
+# Admission control of /api/analyze and /api/upload_csv, per worker process:
+# admitted requests in flight (0 = unlimited), requests per second and burst
+# per client (rate 0 = unlimited), the deadline in ms of requests that don't
+# send X-Request-Deadline-Ms (0 = none) and the Retry-After seconds of a 503
+app.config['ADMISSION_MAX_CONCURRENT'] = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 64))
+app.config['ADMISSION_RATE'] = float(os.environ.get('ADMISSION_RATE', 0))
+app.config['ADMISSION_BURST'] = float(os.environ.get('ADMISSION_BURST', 0))
+app.config['ADMISSION_DEFAULT_DEADLINE_MS'] = float(os.environ.get('ADMISSION_DEFAULT_DEADLINE_MS', 0))
+app.config['ADMISSION_RETRY_AFTER'] = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
 # Ensure upload directory exists
 if not ensure_directory_exists(UPLOAD_FOLDER):
     print("⚠️  Warning: Could not create upload directory. File uploads may not work.")
@@ -34,105 +112,116 @@ if not ensure_directory_exists(UPLOAD_FOLDER):
     app.config['UPLOAD_FOLDER'] = 'uploads'
     ensure_directory_exists(app.config['UPLOAD_FOLDER'])
 
-# Global variables for ML model
-ml_model = None
-label_encoder = None
+# The active model. Everything derived from a trained model lives in one
+# ModelBundle that is replaced with a single assignment, so a request that
+# picked up the bundle keeps a consistent model/encoder pair and version
+# even if a retrain publishes a new one meanwhile.
+current_model = None
+
+# Results of analyze_patient keyed by panel and model version
+analysis_cache = result_cache.ResultCache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_TTL'])
+
+# Fields every patient record must provide
+PATIENT_FIELDS = ['age', 'gender', 'glucose', 'systolic_bp', 'diastolic_bp', 'cholesterol', 'bmi']
+NUMERIC_FIELDS = ['age', 'glucose', 'systolic_bp', 'diastolic_bp', 'cholesterol', 'bmi']
+
+# Label of each model class
+RISK_LEVELS = ["Normal", "Moderate", "High"]
+
+# Visualization colors
+COLOR_LOW = '#3498db'       # Blue - Low
+COLOR_NORMAL = '#2ecc71'    # Green - Normal
+COLOR_ELEVATED = '#f39c12'  # Orange - Elevated
+COLOR_HIGH = '#e74c3c'      # Red - High
+COLOR_MISSING = '#95a5a6'   # Grey - Not measured
+
+# Chart band level (see thresholds.THRESHOLD_TABLE['chart']) -> color
+LEVEL_COLORS = {'low': COLOR_LOW, 'normal': COLOR_NORMAL, 'elevated': COLOR_ELEVATED, 'high': COLOR_HIGH}
+
+class ModelBundle:
+    """A trained model, its gender encoder and everything derived from them"""
+    
+    def __init__(self, model, encoder, metadata):
+        self.model = model
+        self.encoder = encoder
+        self.metadata = dict(metadata)
+        self.metadata.setdefault('model_version', model_store.model_version(model))
+        self.version = self.metadata['model_version']
+        self.gender_codes = {gender: code for code, gender in enumerate(encoder.classes_.tolist())}
+        try:
+            self.compiled = tree_scorer.CompiledTree.compile(model)
+        except Exception as e:
+            print(f"⚠️  Could not compile model, using scikit-learn for scoring: {e}")
+            self.compiled = None
+        # Explanation of each leaf, precomputed so a prediction only looks one up
+        self.explanations = None
+        if self.compiled is not None:
+            try:
+                self.explanations = self.compiled.explain(
+                    PATIENT_FIELDS,
+                    [RISK_LEVELS[label] for label in self.compiled.classes.tolist()],
+                    {'gender': encoder.classes_.tolist()}
+                )
+            except Exception as e:
+                print(f"⚠️  Could not precompute explanations: {e}")
+    
+    def encode_features(self, X):
+        """Feature matrix for a DataFrame of PATIENT_FIELDS with gender as text"""
+        X = X[PATIENT_FIELDS].copy()
+        X['gender'] = self.encoder.transform(X['gender'])
+        return X.to_numpy(dtype=float)
+    
+    def predict(self, features):
+        """Predicted class for each row of a feature matrix"""
+        if self.compiled is not None:
+            return self.compiled.predict(features)
+        return self.model.predict(features)
+
+def serving_model_name():
+    """Registered model that new models are trained as"""
+    if app.config['MODEL_NAME']:
+        return app.config['MODEL_NAME']
+    if current_model is not None:
+        return current_model.metadata.get('model_name', model_registry.DEFAULT_MODEL)
+    return model_registry.DEFAULT_MODEL
+
+def publish_model(bundle):
+    """Make `bundle` the active model in one atomic step"""
+    global current_model
+    previous, current_model = current_model, bundle
+    # Keys carry the model version, so old entries could never hit again anyway
+    if previous is not None and (bundle is None or previous.version != bundle.version):
+        analysis_cache.clear()
+    if bundle is not None:
+        scoring_jobs.use_version(bundle.version)
 
 class AIDiagnosticSystem:
     def __init__(self):
-        self.reference_ranges = {
-            'glucose': {'normal': (70, 100), 'prediabetes': (100, 126), 'diabetes': (126, 400)},
-            'systolic_bp': {'normal': (90, 120), 'elevated': (120, 130), 'hypertension1': (130, 140), 'hypertension2': (140, 200)},
-            'diastolic_bp': {'normal': (60, 80), 'elevated': (80, 85), 'hypertension1': (85, 90), 'hypertension2': (90, 130)},
-            'cholesterol': {'normal': (0, 200), 'borderline': (200, 240), 'high': (240, 400)},
-            'bmi': {'underweight': (0, 18.5), 'normal': (18.5, 24.9), 'overweight': (25, 29.9), 'obese': (30, 50)}
-        }
+        # Compiled clinical cut-offs shared by rules, charts and training labels
+        self.thresholds = thresholds.ENGINE
+        # Chart color of each band, per chart metric (unmeasured values are grey)
+        self.chart_palettes = [
+            np.array([LEVEL_COLORS.get(band.get('level'), COLOR_MISSING) for band in check.bands], dtype=object)
+            for check in self.thresholds.chart
+        ]
+        # Metric names and normal ranges are the same for everyone, so all
+        # chart data shares one (read-only) copy
+        self.chart_metrics = [check.name for check in self.thresholds.chart]
+        self.chart_normal_ranges = [dict(check.spec['normal_range']) for check in self.thresholds.chart]
+        # Rule result (conditions, risk level, recommendations) of every
+        # combination of finding bands, indexed by the packed band code of
+        # rule_based_analysis_batch. Patients with the same findings share one
+        # (read-only) result object.
+        n_codes = int(np.prod([len(check.bands) for check in self.thresholds.findings]))
+        self.rule_results = [self._rule_result_for_code(code) for code in range(n_codes)]
         
-    def train_model(self):
+    def train_model(self, n_samples=1000, seed=synthetic.DEFAULT_SEED):
         """Train ML model with synthetic data"""
-        global ml_model, label_encoder
-        
         try:
             print("🤖 Training AI model...")
             
-            # Generate synthetic training data
-            np.random.seed(42)
-            n_samples = 1000
-            
-            # Create features
-            age = np.random.randint(18, 80, n_samples)
-            gender = np.random.choice(['Male', 'Female'], n_samples)
-            glucose = np.random.normal(100, 30, n_samples)
-            systolic_bp = np.random.normal(120, 15, n_samples)
-            diastolic_bp = np.random.normal(80, 10, n_samples)
-            cholesterol = np.random.normal(190, 30, n_samples)
-            bmi = np.random.normal(25, 5, n_samples)
-            
-            # Create labels based on medical rules
-            labels = []
-            for i in range(n_samples):
-                conditions = []
-                
-                # Check glucose
-                if glucose[i] >= 126:
-                    conditions.append(2)  # Diabetes
-                elif glucose[i] >= 100:
-                    conditions.append(1)  # Prediabetes
-                else:
-                    conditions.append(0)  # Normal
-                    
-                # Check BP
-                if systolic_bp[i] >= 140 or diastolic_bp[i] >= 90:
-                    conditions.append(2)  # Hypertension
-                elif systolic_bp[i] >= 130 or diastolic_bp[i] >= 85:
-                    conditions.append(1)  # Elevated
-                else:
-                    conditions.append(0)  # Normal
-                    
-                # Check cholesterol
-                if cholesterol[i] >= 240:
-                    conditions.append(2)  # High
-                elif cholesterol[i] >= 200:
-                    conditions.append(1)  # Borderline
-                else:
-                    conditions.append(0)  # Normal
-                    
-                # Check BMI
-                if bmi[i] >= 30:
-                    conditions.append(2)  # Obese
-                elif bmi[i] >= 25:
-                    conditions.append(1)  # Overweight
-                elif bmi[i] < 18.5:
-                    conditions.append(1)  # Underweight
-                else:
-                    conditions.append(0)  # Normal
-                    
-                # Overall risk level
-                if any(c == 2 for c in conditions):
-                    labels.append(2)  # High risk
-                elif any(c == 1 for c in conditions):
-                    labels.append(1)  # Moderate risk
-                else:
-                    labels.append(0)  # Normal
-            
-            # Create DataFrame
-            X = pd.DataFrame({
-                'age': age,
-                'gender': gender,
-                'glucose': glucose,
-                'systolic_bp': systolic_bp,
-                'diastolic_bp': diastolic_bp,
-                'cholesterol': cholesterol,
-                'bmi': bmi
-            })
-            
-            # Encode gender
-            label_encoder = LabelEncoder()
-            X['gender'] = label_encoder.fit_transform(X['gender'])
-            
-            # Train model
-            ml_model = DecisionTreeClassifier(max_depth=5, random_state=42)
-            ml_model.fit(X, np.array(labels))
+            X, labels = self.synthetic_training_data(n_samples, seed)
+            publish_model(self.fit_model(X, labels, {'training_data': 'synthetic', 'seed': seed}))
             
             print("✅ AI model trained successfully!")
             return True
@@ -141,83 +230,119 @@ class AIDiagnosticSystem:
             print(f"❌ Error training model: {e}")
             return False
     
+    def fit_model(self, X, labels, metadata=None):
+        """Train a model on a DataFrame of PATIENT_FIELDS without publishing it
+        
+        The kind of model is metadata['model_name'] if given, else serving_model_name().
+        """
+        from sklearn.preprocessing import LabelEncoder
+        
+        metadata = dict(metadata or {})
+        model = model_registry.create(metadata.setdefault('model_name', serving_model_name()))
+        
+        X = X[PATIENT_FIELDS].copy()
+        encoder = LabelEncoder()
+        # Encode the few distinct genders once instead of every row's string
+        genders = X['gender'].astype('category').cat.remove_unused_categories()
+        encoder.fit(genders.cat.categories)
+        X['gender'] = encoder.transform(genders.cat.categories)[genders.cat.codes]
+        
+        model.fit(X, labels)
+        return ModelBundle(model, encoder, dict(metadata, n_samples=len(X)))
+    
+    def synthetic_training_data(self, n_samples=1000, seed=synthetic.DEFAULT_SEED):
+        """Generate synthetic patients labelled by the medical rules"""
+        return synthetic.generate(n_samples, seed)
+    
+    def save_model(self, path=model_store.DEFAULT_MODEL_PATH, bundle=None):
+        """Persist the trained model as a versioned artifact"""
+        bundle = bundle or current_model
+        if bundle is None:
+            print("❌ No trained model to save")
+            return False
+        try:
+            bundle.metadata = model_store.save_model(path, bundle.model, bundle.encoder.classes_, bundle.metadata)
+            print(f"💾 Model {bundle.version} saved to {path}")
+            return True
+        except Exception as e:
+            print(f"❌ Error saving model: {e}")
+            return False
+    
+    def load_model(self, path=model_store.DEFAULT_MODEL_PATH):
+        """Load a previously trained model artifact instead of retraining"""
+        if not os.path.exists(path):
+            return False
+        try:
+            from sklearn.preprocessing import LabelEncoder
+            
+            started = time.perf_counter()
+            model, gender_classes, header = model_store.load_model(path)
+            encoder = LabelEncoder()
+            encoder.classes_ = np.array(gender_classes, dtype=object)
+            
+            publish_model(ModelBundle(model, encoder, header))
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            print(f"📦 Loaded model {header['model_version']} from {path} in {elapsed_ms:.1f} ms")
+            return True
+        except model_store.ModelArtifactError as e:
+            print(f"❌ Error loading model: {e}")
+            return False
+    
     def analyze_patient(self, patient_data):
         """Analyze patient data using both rule-based and ML approaches"""
         try:
+            # Stick to one model for the whole request, even if a new one is published
+            bundle = current_model
+            version = bundle.version if bundle else None
+            
+            key = result_cache.panel_key(patient_data, PATIENT_FIELDS, version)
+            cached = analysis_cache.get(key)
+            if cached is not None:
+                return cached
+            
             # Rule-based analysis
-            rule_results = self.rule_based_analysis(patient_data)
+            admission.check_deadline('rule_based_analysis')
+            with metrics.stage('rule_based_analysis'):
+                rule_results = self.rule_based_analysis(patient_data)
             
             # ML prediction
-            ml_results = self.ml_prediction(patient_data)
+            admission.check_deadline('ml_prediction')
+            with metrics.stage('ml_prediction'):
+                ml_results = self.ml_prediction(patient_data, bundle)
             
             # Generate visualization data
-            viz_data = self.prepare_visualization_data(patient_data)
+            admission.check_deadline('prepare_visualization_data')
+            with metrics.stage('prepare_visualization_data'):
+                viz_data = self.prepare_visualization_data(patient_data)
             
-            return {
+            result = {
                 'rule_results': rule_results,
                 'ml_results': ml_results,
-                'visualization': viz_data
+                'visualization': viz_data,
+                'model_version': version
             }
+            analysis_cache.put(key, result)
+            return result
+        except admission.DeadlineExceeded:
+            raise
         except Exception as e:
             print(f"❌ Error analyzing patient: {e}")
             return {'error': str(e)}
     
     def rule_based_analysis(self, patient_data):
         """Perform rule-based medical analysis"""
-        conditions = []
-        risk_factors = []
-        
-        # Analyze glucose
-        glucose = patient_data['glucose']
-        if glucose >= 126:
-            conditions.append("Diabetes")
-            risk_factors.append("High glucose level")
-        elif glucose >= 100:
-            conditions.append("Prediabetes Risk")
-            risk_factors.append("Elevated glucose level")
-            
-        # Analyze blood pressure
-        systolic = patient_data['systolic_bp']
-        diastolic = patient_data['diastolic_bp']
-        
-        if systolic >= 140 or diastolic >= 90:
-            conditions.append("Hypertension")
-            risk_factors.append("High blood pressure")
-        elif systolic >= 130 or diastolic >= 85:
-            conditions.append("Elevated Blood Pressure")
-            risk_factors.append("Elevated blood pressure")
-            
-        # Analyze cholesterol
-        cholesterol = patient_data['cholesterol']
-        if cholesterol >= 240:
-            conditions.append("High Cholesterol")
-            risk_factors.append("High cholesterol level")
-        elif cholesterol >= 200:
-            conditions.append("Borderline High Cholesterol")
-            risk_factors.append("Borderline cholesterol level")
-            
-        # Analyze BMI
-        bmi = patient_data['bmi']
-        if bmi >= 30:
-            conditions.append("Obesity")
-            risk_factors.append("High BMI")
-        elif bmi >= 25:
-            conditions.append("Overweight")
-            risk_factors.append("Elevated BMI")
-        elif bmi < 18.5:
-            conditions.append("Underweight")
-            risk_factors.append("Low BMI")
-            
-        # Determine overall risk level
-        if len(conditions) == 0:
-            risk_level = "Normal"
-            risk_emoji = "🟢"
-        elif len(conditions) <= 2:
-            risk_level = "Moderate"
-            risk_emoji = "🟡"
-        else:
-            risk_level = "High"
-            risk_emoji = "🔴"
+        # Each check of the threshold table (glucose, blood pressure,
+        # cholesterol, BMI) reports at most one finding
+        code = 0
+        for check in self.thresholds.findings:
+            code = code * len(check.bands) + check.classify(patient_data)
+        return self.rule_results[code]
+    
+    def summarize_conditions(self, conditions, risk_factors):
+        """Determine overall risk level and recommendations for detected conditions"""
+        level = self.thresholds.risk_level(len(conditions))
+        risk_level = level['label']
+        risk_emoji = level['emoji']
             
         # Generate recommendations
         recommendations = self.generate_recommendations(conditions, risk_factors)
@@ -230,37 +355,58 @@ class AIDiagnosticSystem:
             'recommendations': recommendations
         }
     
-    def ml_prediction(self, patient_data):
+    def ml_prediction(self, patient_data, bundle=None):
         """Perform ML-based prediction"""
-        global ml_model, label_encoder
-        
-        if ml_model is None:
+        bundle = bundle or current_model
+        if bundle is None:
             return {'error': 'Model not trained'}
         
         try:
+            # Unmeasured metrics (NaN or null) can't be scored
+            missing = [field for field in NUMERIC_FIELDS
+                       if patient_data[field] is None or patient_data[field] != patient_data[field]]
+            if missing:
+                return {'error': f"Missing values for: {', '.join(missing)}"}
+            
+            gender = patient_data['gender']
+            gender_code = bundle.gender_codes.get(gender) if isinstance(gender, str) else None
+            if gender_code is None:
+                # Unknown gender: let the encoder raise its usual error
+                gender_code = bundle.encoder.transform([gender])[0]
+            
             # Prepare features
-            features = np.array([[
+            features = [
                 patient_data['age'],
-                label_encoder.transform([patient_data['gender']])[0],
+                gender_code,
                 patient_data['glucose'],
                 patient_data['systolic_bp'],
                 patient_data['diastolic_bp'],
                 patient_data['cholesterol'],
                 patient_data['bmi']
-            ]])
+            ]
             
-            # Make prediction
-            prediction = ml_model.predict(features)[0]
-            prediction_proba = ml_model.predict_proba(features)[0]
+            compiled = bundle.compiled
+            explanation = None
+            if compiled is not None:
+                # One pass over the compiled tree instead of two sklearn calls
+                class_index, _, leaf = compiled.score_one(features)
+                prediction = compiled.classes[class_index]
+                confidence = compiled.confidence[leaf]
+                if bundle.explanations is not None:
+                    explanation = bundle.explanations[leaf]
+            else:
+                features = np.array([features])
+                prediction = bundle.model.predict(features)[0]
+                prediction_proba = bundle.model.predict_proba(features)[0]
+                confidence = round(max(prediction_proba) * 100, 1)
             
-            risk_levels = ["Normal", "Moderate", "High"]
-            predicted_risk = risk_levels[prediction]
-            confidence = max(prediction_proba) * 100
-            
-            return {
-                'predicted_risk': predicted_risk,
-                'confidence': round(confidence, 1)
+            result = {
+                'predicted_risk': RISK_LEVELS[prediction],
+                'confidence': confidence
             }
+            if explanation is not None:
+                result['explanation'] = explanation
+            return result
         except Exception as e:
             return {'error': str(e)}
     
@@ -312,83 +458,485 @@ class AIDiagnosticSystem:
     
     def prepare_visualization_data(self, patient_data):
         """Prepare data for visualization"""
-        metrics = ['Glucose', 'Systolic BP', 'Diastolic BP', 'Cholesterol', 'BMI']
-        values = [
-            patient_data['glucose'],
-            patient_data['systolic_bp'],
-            patient_data['diastolic_bp'],
-            patient_data['cholesterol'],
-            patient_data['bmi']
-        ]
+        chart = self.thresholds.chart
+        values = [patient_data[check.fields[0]] for check in chart]
         
-        # Normal ranges
-        normal_ranges = [
-            {'min': 70, 'max': 100},  # Glucose
-            {'min': 90, 'max': 120},  # Systolic BP
-            {'min': 60, 'max': 80},   # Diastolic BP
-            {'min': 0, 'max': 200},   # Cholesterol
-            {'min': 18.5, 'max': 24.9}  # BMI
+        # Color of the band each value falls in
+        colors = [
+            LEVEL_COLORS.get(check.band(patient_data).get('level'), COLOR_MISSING)
+            for check in chart
         ]
         
-        # Determine colors
-        colors = []
-        for i, metric in enumerate(metrics):
-            value = values[i]
-            range_data = normal_ranges[i]
-            
-            if metric == 'Glucose':
-                if value < 70:
-                    colors.append('#3498db')  # Blue - Low
-                elif value <= 100:
-                    colors.append('#2ecc71')  # Green - Normal
-                elif value <= 126:
-                    colors.append('#f39c12')  # Orange - Prediabetes
-                else:
-                    colors.append('#e74c3c')  # Red - Diabetes
-            elif metric == 'Systolic BP':
-                if value < 90:
-                    colors.append('#3498db')
-                elif value <= 120:
-                    colors.append('#2ecc71')
-                elif value <= 130:
-                    colors.append('#f39c12')
-                else:
-                    colors.append('#e74c3c')
-            elif metric == 'Diastolic BP':
-                if value < 60:
-                    colors.append('#3498db')
-                elif value <= 80:
-                    colors.append('#2ecc71')
-                elif value <= 85:
-                    colors.append('#f39c12')
-                else:
-                    colors.append('#e74c3c')
-            elif metric == 'Cholesterol':
-                if value < 200:
-                    colors.append('#2ecc71')
-                elif value < 240:
-                    colors.append('#f39c12')
-                else:
-                    colors.append('#e74c3c')
-            elif metric == 'BMI':
-                if value < 18.5:
-                    colors.append('#3498db')
-                elif value < 25:
-                    colors.append('#2ecc71')
-                elif value < 30:
-                    colors.append('#f39c12')
-                else:
-                    colors.append('#e74c3c')
-        
         return {
-            'metrics': metrics,
+            'metrics': self.chart_metrics,
             'values': values,
-            'normal_ranges': normal_ranges,
+            'normal_ranges': self.chart_normal_ranges,
             'colors': colors
         }
+    
+    # --- Batch analysis ---
+    
+    def analyze_batch(self, patients):
+        """Analyze many patients at once with vectorized rules and a single model call
+        
+        `patients` is either a dict of field -> list of values (one entry per
+        patient) or a list of patient dicts. Each item of the returned list is
+        identical to what analyze_patient returns for that patient.
+        """
+        try:
+            if isinstance(patients, list):
+                return self._analyze_records(patients)
+            
+            columns = self._batch_columns(patients)
+            if columns is None:
+                # Inputs the vectorized path can't represent keep per-patient semantics
+                return [self.analyze_patient(p) for p in self._batch_records(patients)]
+            return self._analyze_columns(columns)
+        except Exception as e:
+            print(f"❌ Error analyzing batch: {e}")
+            return {'error': str(e)}
+    
+    def _analyze_records(self, patients):
+        """Analyze a list of patient dicts, vectorizing every record that allows it"""
+        results = [None] * len(patients)
+        batchable = []
+        for i, patient in enumerate(patients):
+            if self._is_batchable(patient):
+                batchable.append(i)
+            else:
+                results[i] = self.analyze_patient(patient)
+        
+        if batchable:
+            raw = {field: [patients[i][field] for i in batchable] for field in PATIENT_FIELDS}
+            for i, result in zip(batchable, self._analyze_columns(self._columns_from_raw(raw))):
+                results[i] = result
+        return results
+    
+    def _analyze_columns(self, columns):
+        """Run the vectorized stages over prepared column arrays"""
+        bundle = current_model
+        with metrics.stage('rule_based_analysis_batch'):
+            rule_results = self.rule_based_analysis_batch(columns)
+        with metrics.stage('ml_prediction_batch'):
+            ml_results = self.ml_prediction_batch(columns, bundle)
+        with metrics.stage('prepare_visualization_data_batch'):
+            viz_data = self.prepare_visualization_data_batch(columns)
+        
+        version = bundle.version if bundle else None
+        return [
+            {
+                'rule_results': rule_result,
+                'ml_results': ml_result,
+                'visualization': viz,
+                'model_version': version
+            }
+            for rule_result, ml_result, viz in zip(rule_results, ml_results, viz_data)
+        ]
+    
+    def _batch_records(self, patients):
+        """Return column input as a list of patient dicts"""
+        size = len(next(iter(patients.values()), []))
+        return [{field: values[i] for field, values in patients.items()} for i in range(size)]
+    
+    def _is_batchable(self, patient):
+        """Whether a patient dict can take the vectorized path"""
+        if not isinstance(patient, dict):
+            return False
+        for field in PATIENT_FIELDS:
+            if field not in patient:
+                return False
+        # Strings and other non-numbers fail differently in the scalar comparisons,
+        # so only plain numbers take the vectorized path
+        for field in NUMERIC_FIELDS:
+            if not isinstance(patient[field], (int, float)):
+                return False
+        return True
+    
+    def _batch_columns(self, patients):
+        """Convert column input to arrays, or None if it needs the per-patient path"""
+        for field in PATIENT_FIELDS:
+            if field not in patients:
+                raise KeyError(field)
+        raw = {field: list(patients[field]) for field in PATIENT_FIELDS}
+        if len({len(values) for values in raw.values()}) > 1:
+            raise ValueError('All patient fields must have the same number of values')
+        
+        for field in NUMERIC_FIELDS:
+            if not all(isinstance(value, (int, float)) for value in raw[field]):
+                return None
+        return self._columns_from_raw(raw)
+    
+    def _columns_from_raw(self, raw):
+        """Build the arrays used by the vectorized stages from value lists"""
+        columns = {field: np.asarray(raw[field], dtype=float) for field in NUMERIC_FIELDS}
+        columns['gender'] = raw['gender']
+        columns['raw'] = raw
+        columns['size'] = len(raw['gender'])
+        return columns
+    
+    def rule_based_analysis_batch(self, columns):
+        """Vectorized rule_based_analysis over column arrays"""
+        # Each combination of bands maps to exactly one precomputed result
+        codes = np.zeros(columns['size'], dtype=np.int64)
+        for check in self.thresholds.findings:
+            codes = codes * len(check.bands) + check.classify_batch(columns)
+        rule_results = self.rule_results
+        return [rule_results[code] for code in codes.tolist()]
+    
+    def _rule_result_for_code(self, code):
+        """Build the rule result for a packed code of band indices, one per finding check"""
+        bands = []
+        for check in reversed(self.thresholds.findings):
+            code, index = divmod(code, len(check.bands))
+            bands.append(check.bands[index])
+        bands.reverse()
+        
+        conditions = [band['condition'] for band in bands if 'condition' in band]
+        risk_factors = [band['risk_factor'] for band in bands if 'condition' in band]
+        return self.summarize_conditions(conditions, risk_factors)
+    
+    def ml_prediction_batch(self, columns, bundle=None):
+        """Vectorized ml_prediction: one model call for the whole batch"""
+        bundle = bundle or current_model
+        size = columns['size']
+        if bundle is None:
+            return [{'error': 'Model not trained'} for _ in range(size)]
+        
+        try:
+            codes = [bundle.gender_codes.get(gender) if isinstance(gender, str) else None
+                     for gender in columns['gender']]
+            known = np.array([code is not None for code in codes], dtype=bool)
+            missing = np.column_stack([np.isnan(columns[field]) for field in NUMERIC_FIELDS])
+            has_missing = missing.any(axis=1)
+            
+            results = [None] * size
+            for row in np.flatnonzero(has_missing).tolist():
+                fields = [field for field, absent in zip(NUMERIC_FIELDS, missing[row]) if absent]
+                results[row] = {'error': f"Missing values for: {', '.join(fields)}"}
+            
+            rows = np.flatnonzero(known & ~has_missing)
+            if len(rows):
+                features = np.column_stack([
+                    columns['age'][rows],
+                    np.array([codes[i] for i in rows.tolist()], dtype=float),
+                    columns['glucose'][rows],
+                    columns['systolic_bp'][rows],
+                    columns['diastolic_bp'][rows],
+                    columns['cholesterol'][rows],
+                    columns['bmi'][rows]
+                ])
+                
+                compiled = bundle.compiled
+                explanations = None
+                if compiled is not None:
+                    leaves = compiled.apply(features)
+                    predictions = compiled.classes[compiled.class_index[leaves]]
+                    confidences = compiled.confidence[leaves]
+                    if bundle.explanations is not None:
+                        explanations = [bundle.explanations[leaf] for leaf in leaves.tolist()]
+                else:
+                    prediction_proba = bundle.model.predict_proba(features)
+                    predictions = bundle.model.classes_[np.argmax(prediction_proba, axis=1)]
+                    confidences = np.round(prediction_proba.max(axis=1) * 100, 1)
+                
+                for i, (row, prediction, confidence) in enumerate(zip(rows.tolist(), predictions.tolist(),
+                                                                      confidences.tolist())):
+                    results[row] = {
+                        'predicted_risk': RISK_LEVELS[prediction],
+                        'confidence': confidence
+                    }
+                    if explanations is not None:
+                        results[row]['explanation'] = explanations[i]
+            
+            # Unknown genders go through the scalar path so they report the same error
+            for row in np.flatnonzero(~known & ~has_missing).tolist():
+                results[row] = self.ml_prediction({
+                    field: columns['raw'][field][row] for field in PATIENT_FIELDS
+                }, bundle)
+            return results
+        except Exception as e:
+            return [{'error': str(e)} for _ in range(size)]
+    
+    def prepare_visualization_data_batch(self, columns):
+        """Vectorized prepare_visualization_data over column arrays"""
+        chart = self.thresholds.chart
+        colors = np.column_stack([
+            palette[check.classify_batch(columns)]
+            for check, palette in zip(chart, self.chart_palettes)
+        ]).tolist()
+        
+        metrics = self.chart_metrics
+        normal_ranges = self.chart_normal_ranges
+        raw = columns['raw']
+        values = zip(*[raw[check.fields[0]] for check in chart])
+        return [
+            {
+                'metrics': metrics,
+                'values': list(patient_values),
+                'normal_ranges': normal_ranges,
+                'colors': patient_colors
+            }
+            for patient_values, patient_colors in zip(values, colors)
+        ]
 
 # Initialize AI system
 ai_system = AIDiagnosticSystem()
+cohort_store = cohort_stats.CohortStats(app.config['COHORT_STATS_DB'])
+symptom_index = symptom_search.SymptomIndex(app.config['SYMPTOM_INDEX_DB'])
+
+# Request and stage timings at /metrics; SLOW_REQUEST_MS turns on the slow request profiler
+metrics.install(app, profiler=metrics.profiler_from_env())
+
+# Sheds analysis and upload requests beyond the configured limits
+admission_control = admission.AdmissionController(
+    max_concurrent=app.config['ADMISSION_MAX_CONCURRENT'],
+    rate=app.config['ADMISSION_RATE'],
+    burst=app.config['ADMISSION_BURST'],
+    default_deadline_ms=app.config['ADMISSION_DEFAULT_DEADLINE_MS'],
+    retry_after=app.config['ADMISSION_RETRY_AFTER']
+)
+admission.install(app, admission_control, {'analyze', 'upload_csv'})
+metrics.REGISTRY.gauge(
+    'diagnostic_model_info', 'Version of the model being served', ['version'],
+    lambda: [({'version': current_model.version}, 1)] if current_model else []
+)
+metrics.REGISTRY.gauge(
+    'diagnostic_result_cache', 'Analysis result cache size and lookup counters', ['stat'],
+    lambda: [({'stat': stat}, value) for stat, value in analysis_cache.stats().items()
+             if stat in ('entries', 'hits', 'misses', 'evictions', 'expirations', 'invalidations')]
+)
+metrics.REGISTRY.gauge(
+    'diagnostic_admission', 'Admitted and shed analysis requests and requests in flight', ['stat'],
+    lambda: [({'stat': stat}, value) for stat, value in admission_control.stats().items()
+             if stat in ('admitted', 'rate_limited', 'overloaded', 'deadline_exceeded', 'in_flight')]
+)
+
+response_dictionary = None
+
+def get_response_dictionary():
+    """Dictionary of the static parts of analysis results for the current model"""
+    global response_dictionary
+    bundle = current_model
+    version = bundle.version if bundle else None
+    dictionary = response_dictionary
+    if dictionary is None or dictionary.model_version != version:
+        dictionary = response_dictionary = responses.ResponseDictionary(
+            ai_system.rule_results, ai_system.chart_metrics, ai_system.chart_normal_ranges,
+            bundle.explanations if bundle else None, version)
+    return dictionary
+
+def save_published_model(bundle):
+    """Persist a retrained model so other worker processes pick it up"""
+    return ai_system.save_model(app.config['MODEL_PATH'], bundle)
+
+retraining_job = retraining.RetrainingJob(
+    fit=ai_system.fit_model,
+    get_current=lambda: current_model,
+    publish=publish_model,
+    save=save_published_model
+)
+
+model_reload_lock = threading.Lock()
+model_checked_at = 0.0
+
+@app.before_request
+def reload_published_model():
+    """Pick up a model another process saved to the artifact since the last check"""
+    global model_checked_at
+    
+    interval = app.config['MODEL_RELOAD_INTERVAL']
+    now = time.monotonic()
+    if interval <= 0 or now - model_checked_at < interval:
+        return
+    if not model_reload_lock.acquire(blocking=False):
+        return
+    try:
+        model_checked_at = now
+        path = app.config['MODEL_PATH']
+        if not os.path.exists(path):
+            return
+        header = model_store.read_header(path)
+        if current_model is None or header.get('model_version') != current_model.version:
+            ai_system.load_model(path)
+    except model_store.ModelArtifactError as e:
+        print(f"⚠️  Could not check model artifact: {e}")
+    finally:
+        model_reload_lock.release()
+
+# Created on first use so every (forked) worker process gets its own thread
+micro_batcher = None
+micro_batcher_lock = threading.Lock()
+
+def analyze_micro_batch(patients):
+    """Score patients queued by the micro-batcher"""
+    results = ai_system.analyze_batch(patients)
+    if isinstance(results, dict):
+        return [results] * len(patients)
+    return results
+
+def record_cohort(dataset_id, df=None, frames=None, rollup=None):
+    """Fold an uploaded dataset into the cohort statistics once, without failing the upload
+    
+    dataset_id is its content digest; its records are a DataFrame (df),
+    chunks read from a file with that digest (frames) or a
+    cohort_stats.Rollup folded from them as they streamed in.
+    """
+    try:
+        if rollup is not None:
+            cohort_store.write('uploads', rollup, dataset_id)
+        elif not cohort_store.is_recorded(dataset_id):
+            cohort_store.record_dataset(dataset_id, frames if frames is not None else dataset_chunks(df))
+    except Exception as e:
+        print(f"⚠️  Could not update cohort statistics: {e}")
+
+def dataset_chunks(df, size=100000):
+    for start in range(0, len(df), size):
+        yield df.iloc[start:start + size]
+
+def index_symptoms(dataset_id, df=None, frames=None, staged=None):
+    """Add an uploaded dataset to the symptom index once, without failing the upload
+    
+    dataset_id is its content digest; its records are a DataFrame (df),
+    chunks read from a file with that digest (frames) or were staged under
+    the key `staged` as they streamed in (see stage_symptoms).
+    """
+    try:
+        if staged is not None:
+            symptom_index.commit_staged(staged, dataset_id)
+        elif not symptom_index.is_indexed(dataset_id):
+            symptom_index.index_dataset(dataset_id, frames if frames is not None else dataset_chunks(df))
+    except Exception as e:
+        print(f"⚠️  Could not update the symptom index: {e}")
+
+def stage_symptoms(staged, df):
+    """Index a chunk of a streamed upload under a temporary key until its digest is known"""
+    try:
+        symptom_index.index_frame('uploads', df, staged)
+    except Exception as e:
+        print(f"⚠️  Could not update the symptom index: {e}")
+
+def ingest_upload_file(digest, cohort_file, symptom_file):
+    """Fold a CSV file into the cohort statistics and the symptom index in the
+    background, reading and closing one open handle of it for each"""
+    import pandas as pd
+    
+    with cohort_file:
+        record_cohort(digest, frames=pd.read_csv(cohort_file, chunksize=100000))
+    with symptom_file:
+        index_symptoms(digest, frames=pd.read_csv(symptom_file, chunksize=100000))
+
+# Similar-patient indexes per source, built on first use
+SIMILARITY_SOURCES = ['uploads', 'hack1']
+similarity_indexes = {}
+similarity_lock = threading.Lock()
+hack1_sync = {'last_id': 0, 'checked_at': 0.0}
+
+def upload_similarity_records(df, dataset_id):
+    """(features, ids, diagnoses) of a lab export for the similarity index"""
+    if 'patient_id' in df.columns:
+        ids = df['patient_id'].astype(str).to_numpy(dtype=object)
+    else:
+        ids = np.array([f'{dataset_id[:12]}:{row}' for row in range(len(df))], dtype=object)
+    if 'diagnosis' in df.columns:
+        diagnoses = df['diagnosis'].astype(object).where(df['diagnosis'].notna(), None).to_numpy()
+    else:
+        diagnoses = np.full(len(df), None, dtype=object)
+    return similarity.feature_matrix(df, len(df)), ids, diagnoses
+
+def hack1_similarity_records(after_id):
+    """(features, ids, diagnoses, last id) of hack1 records saved after `after_id`"""
+    import sqlite3
+    
+    path = app.config['HACK1_PATIENTS_DB']
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=5)
+    try:
+        rows = conn.execute('''
+            SELECT id, glucose, systolic_bp, diastolic_bp, cholesterol, diagnosis
+            FROM patients WHERE id > ? ORDER BY id''', (after_id,)).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return None
+    ids, glucose, systolic, diastolic, cholesterol, diagnoses = zip(*rows)
+    features = similarity.feature_matrix({
+        'glucose': glucose, 'systolic_bp': systolic, 'diastolic_bp': diastolic, 'cholesterol': cholesterol
+    }, len(rows))
+    return features, np.array(ids, dtype=object), np.array(diagnoses, dtype=object), ids[-1]
+
+def build_similarity_index(source):
+    index = similarity.SimilarityIndex(app.config['SIMILARITY_MAX_PENDING'])
+    if source == 'uploads':
+        if os.path.exists(app.config['SIMILARITY_CSV']):
+            dataset_store.ingest_file(app.config['SIMILARITY_CSV'], os.path.basename(app.config['SIMILARITY_CSV']))
+        parts = [upload_similarity_records(dataset.frame(), dataset.id) for dataset in dataset_store.list()]
+    else:
+        records = hack1_similarity_records(0)
+        parts = [records[:3]] if records else []
+        hack1_sync.update(last_id=records[3] if records else 0, checked_at=time.monotonic())
+    if parts:
+        index.build(*(np.concatenate(columns) for columns in zip(*parts)))
+    print(f"🔍 Similarity index for {source}: {len(index)} records")
+    return index
+
+def get_similarity_index(source):
+    """The similarity index of a source, built on first use and kept current"""
+    index = similarity_indexes.get(source)
+    if index is None:
+        with similarity_lock:
+            index = similarity_indexes.get(source)
+            if index is None:
+                index = similarity_indexes[source] = build_similarity_index(source)
+    
+    # hack1 saves records from another process, so poll for new ones
+    if source == 'hack1' and time.monotonic() - hack1_sync['checked_at'] >= app.config['SIMILARITY_REFRESH_INTERVAL']:
+        with similarity_lock:
+            if time.monotonic() - hack1_sync['checked_at'] >= app.config['SIMILARITY_REFRESH_INTERVAL']:
+                hack1_sync['checked_at'] = time.monotonic()
+                records = hack1_similarity_records(hack1_sync['last_id'])
+                if records:
+                    index.add(*records[:3])
+                    hack1_sync['last_id'] = records[3]
+    return index
+
+def init_scoring_worker(bundle):
+    """Load the model in a scoring job worker process"""
+    publish_model(bundle)
+
+def score_csv_block(header, block, first_row):
+    """Score whole CSV records in a job worker: (NDJSON text, rows, rows with errors)"""
+    import pandas as pd
+    
+    chunk = pd.read_csv(io.BytesIO(header + block))
+    lines, errors = diagnose_chunk(chunk, first_row)
+    return ''.join(line + '\n' for line in lines), len(chunk), errors
+
+dataset_store = datasets.DatasetStore(app.config['DATASET_FOLDER'])
+
+scoring_jobs = jobs.JobRunner(
+    app.config['JOB_FOLDER'],
+    init_worker=init_scoring_worker,
+    score_block=score_csv_block,
+    workers=app.config['JOB_WORKERS'],
+    block_bytes=app.config['JOB_BLOCK_BYTES']
+)
+
+def get_micro_batcher():
+    """Return the micro-batcher if enabled, starting it on first use"""
+    global micro_batcher
+    
+    if app.config['MICRO_BATCH_MAX_SIZE'] <= 0:
+        return None
+    if micro_batcher is None:
+        with micro_batcher_lock:
+            if micro_batcher is None:
+                micro_batcher = batching.MicroBatcher(
+                    analyze_micro_batch,
+                    max_batch_size=app.config['MICRO_BATCH_MAX_SIZE'],
+                    max_wait_us=app.config['MICRO_BATCH_MAX_WAIT_US']
+                ).start()
+    return micro_batcher
 
 @app.route('/')
 def index():
@@ -400,20 +948,108 @@ def index():
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
     try:
-        data = request.json
+        with metrics.stage('parse_json'):
+            data = request.json
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
-        result = ai_system.analyze_patient(data)
+        batcher = get_micro_batcher()
+        if batcher is not None:
+            # The batch path doesn't consult the cache, so repeated panels skip the queue here
+            version = current_model.version if current_model else None
+            result = analysis_cache.get(result_cache.panel_key(data, PATIENT_FIELDS, version))
+            if result is None:
+                try:
+                    result = batcher.process(data, timeout=admission.remaining())
+                except TimeoutError:
+                    raise admission.DeadlineExceeded('Deadline exceeded waiting for the batch')
+                if 'error' not in result:
+                    analysis_cache.put(result_cache.panel_key(data, PATIENT_FIELDS, result['model_version']), result)
+        else:
+            result = ai_system.analyze_patient(data)
         if 'error' in result:
             return jsonify(result), 500
-        return jsonify(result)
+        if request.args.get('compact'):
+            dictionary = get_response_dictionary()
+            result = dict(dictionary.compact(result), dictionary=dictionary.version)
+        return responses.respond(result)
+    except admission.DeadlineExceeded:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analyze_batch', methods=['POST'])
+def analyze_batch():
+    """Analyze many patients in one request
+    
+    Accepts either {"patients": [{...}, ...]} or column arrays such as
+    {"age": [...], "gender": [...], "glucose": [...], ...}.
+    """
+    try:
+        with metrics.stage('parse_json'):
+            data = request.json
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        patients = data.get('patients', data) if isinstance(data, dict) else data
+        if isinstance(patients, dict):
+            missing = [field for field in PATIENT_FIELDS if field not in patients]
+            if missing:
+                return jsonify({'error': f"Missing fields: {', '.join(missing)}"}), 400
+            if not all(isinstance(patients[field], list) for field in PATIENT_FIELDS):
+                return jsonify({'error': 'Each field must be a list of values'}), 400
+            if len({len(patients[field]) for field in PATIENT_FIELDS}) > 1:
+                return jsonify({'error': 'All fields must have the same number of values'}), 400
+        elif not isinstance(patients, list):
+            return jsonify({'error': 'Patients must be a list or column arrays'}), 400
+        
+        results = ai_system.analyze_batch(patients)
+        if isinstance(results, dict):
+            return jsonify(results), 500
+        if request.args.get('compact'):
+            dictionary = get_response_dictionary()
+            return responses.respond({
+                'results': [dictionary.compact(result) for result in results],
+                'total_records': len(results),
+                'dictionary': dictionary.version
+            })
+        return responses.respond({
+            'results': results,
+            'total_records': len(results)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analyze/dictionary')
+def analyze_dictionary():
+    """Static parts of analysis results that ?compact=1 responses refer to by id
+    
+    The dictionary only changes with the threshold table or the served
+    model; its version is the ETag, so clients revalidate with
+    If-None-Match and get a 304 while it is unchanged.
+    """
+    try:
+        dictionary = get_response_dictionary()
+        response = responses.respond(dictionary.payload)
+        # Weak: the gzip and MessagePack encodings carry the same content
+        response.set_etag(dictionary.version, weak=True)
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def query_flag(name):
+    """True for ?name=1, true or yes; absent, 0, false or anything else is False"""
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
 @app.route('/api/upload_csv', methods=['POST'])
 def upload_csv():
     try:
+        if query_flag('stream'):
+            return stream_csv_diagnoses()
+        if query_flag('async'):
+            return submit_scoring_job()
+        
         if 'file' not in request.files:
             return jsonify({'error': 'No file provided'}), 400
         
@@ -422,11 +1058,19 @@ def upload_csv():
             return jsonify({'error': 'No file selected'}), 400
         
         if file and file.filename.endswith('.csv'):
-            filename = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-            file.save(filename)
-            
-            # Read CSV
-            df = pd.read_csv(filename)
+            # Parsed only the first time these exact bytes are uploaded
+            admission.check_deadline('csv_parse')
+            with metrics.stage('csv_parse'):
+                dataset, converted = dataset_store.ingest_stream(file.stream, file.filename)
+            admission.check_deadline('cohort_stats')
+            df = dataset.frame()
+            record_cohort(dataset.id, df)
+            if converted:
+                if 'uploads' in similarity_indexes:
+                    similarity_indexes['uploads'].add(*upload_similarity_records(df, dataset.id))
+            if not symptom_index.is_indexed(dataset.id):
+                threading.Thread(target=index_symptoms, args=(dataset.id, df),
+                                 name='symptom-indexing', daemon=True).start()
             
             # Get first patient data
             first_patient = df.iloc[0].to_dict()
@@ -434,29 +1078,412 @@ def upload_csv():
             return jsonify({
                 'success': True,
                 'patient_data': first_patient,
-                'total_records': len(df)
+                'total_records': len(df),
+                'dataset_id': dataset.id,
+                'cached': not converted
             })
         else:
             return jsonify({'error': 'Invalid file format. Please upload a CSV file.'}), 400
+    except admission.DeadlineExceeded:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def stream_csv_diagnoses():
+    """Diagnose every row of a raw CSV request body and stream NDJSON results
+    
+    The body (Content-Type: text/csv, not multipart) is parsed in chunks
+    straight from the WSGI input, so it is never written to disk or held in
+    memory as a whole and MAX_CONTENT_LENGTH doesn't apply. Each row produces
+    one line as soon as its chunk is scored; a final summary line closes the
+    stream. A deadline that passes mid-stream ends it with an error line, as
+    the status has already been sent. The body is hashed as it is read, so the cohort statistics and
+    the symptom index take it in once it has been read whole, and only if no
+    upload with the same content was recorded before.
+    """
+    chunksize = request.args.get('chunksize', default=1000, type=int)
+    if chunksize <= 0:
+        return jsonify({'error': 'chunksize must be positive'}), 400
+    
+    # Bypass request.stream, which enforces MAX_CONTENT_LENGTH
+    body = datasets.DigestReader(get_input_stream(request.environ))
+    import pandas as pd
+    
+    # The request context (and its deadline) is gone while the body is generated
+    deadline = admission.current_deadline()
+    admission.check_deadline('csv_parse', deadline)
+    
+    def generate():
+        total_records = 0
+        errors = 0
+        rollup = cohort_stats.Rollup()
+        staged = f'staged:{uuid.uuid4().hex}'
+        try:
+            reader = pd.read_csv(body, chunksize=chunksize)
+            while True:
+                admission.check_deadline('csv_parse', deadline)
+                with metrics.stage('csv_parse'):
+                    chunk = next(reader, None)
+                if chunk is None:
+                    break
+                
+                rollup.add_frame(chunk)
+                stage_symptoms(staged, chunk)
+                lines, chunk_errors = diagnose_chunk(chunk, total_records)
+                total_records += len(lines)
+                errors += chunk_errors
+                yield '\n'.join(lines) + '\n'
+            digest = body.hexdigest()
+            record_cohort(digest, rollup=rollup)
+            index_symptoms(digest, staged=staged)
+        except admission.DeadlineExceeded as e:
+            admission_control.record_deadline_exceeded()
+            yield json.dumps({'error': str(e)}) + '\n'
+        except Exception as e:
+            yield json.dumps({'error': str(e)}) + '\n'
+        finally:
+            # Left over if the body wasn't read whole (e.g. the client went away)
+            try:
+                symptom_index.drop_staged(staged)
+            except Exception as e:
+                print(f"⚠️  Could not update the symptom index: {e}")
+        
+        yield json.dumps({'summary': {'total_records': total_records, 'errors': errors}}) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def diagnose_chunk(chunk, first_row=0):
+    """Score a DataFrame chunk of a lab export: (one JSON line per row, rows with errors)"""
+    results = ai_system.analyze_batch(lab_schema.frame_to_patients(chunk))
+    if isinstance(results, dict):
+        results = [results] * len(chunk)
+    
+    if 'patient_id' in chunk.columns:
+        patient_ids = chunk['patient_id'].tolist()
+    else:
+        patient_ids = [None] * len(chunk)
+    
+    lines = []
+    errors = 0
+    for row, (patient_id, result) in enumerate(zip(patient_ids, results), start=first_row):
+        if 'error' in result:
+            errors += 1
+        else:
+            mark_missing_values(result['visualization'])
+        lines.append(json.dumps(dict(result, row=row, patient_id=patient_id)))
+    return lines, errors
+
+def submit_scoring_job():
+    """Save an uploaded CSV and score it in the background on the worker pool
+    
+    Accepts a multipart 'file' or a raw text/csv body like ?stream=1. Returns
+    202 with the job id; poll /api/jobs/<id> for progress and partial results.
+    """
+    bundle = current_model
+    if bundle is None:
+        return jsonify({'error': 'Model not trained'}), 503
+    
+    job_id = scoring_jobs.new_job_id()
+    path = scoring_jobs.input_path(job_id)
+    if request.files:
+        file = request.files.get('file')
+        if file is None or file.filename == '':
+            return jsonify({'error': 'No file provided'}), 400
+        if not file.filename.endswith('.csv'):
+            return jsonify({'error': 'Invalid file format. Please upload a CSV file.'}), 400
+        file.save(path)
+        source = file.filename
+    else:
+        import shutil
+        
+        # Copied straight from the WSGI input, so large bodies never sit in memory
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(get_input_stream(request.environ), f, 1 << 20)
+        source = None
+    
+    if os.path.getsize(path) == 0:
+        os.remove(path)
+        return jsonify({'error': 'No data provided'}), 400
+    try:
+        admission.check_deadline('scoring_job')
+    except admission.DeadlineExceeded:
+        os.remove(path)
+        raise
+    
+    # The same file scored by the same model reuses the earlier job
+    digest = datasets.file_digest(path)
+    result_key = f'scoring_job:{bundle.version}'
+    previous = dataset_store.recall(digest, result_key)
+    state = scoring_jobs.load_state(previous) if previous else None
+    if state is not None and state['status'] != 'failed':
+        os.remove(path)
+        status_code, cached = 200, True
+    else:
+        if not (cohort_store.is_recorded(digest) and symptom_index.is_indexed(digest)):
+            # Opened now, so the file stays readable after the job removes it
+            threading.Thread(target=ingest_upload_file, args=(digest, open(path, 'rb'), open(path, 'rb')),
+                             name='upload-ingest', daemon=True).start()
+        state = scoring_jobs.submit(job_id, bundle, bundle.version, source)
+        dataset_store.remember(digest, result_key, job_id)
+        status_code, cached = 202, False
+    
+    return jsonify(dict(
+        scoring_jobs.public_state(state),
+        cached=cached,
+        status_url=f"/api/jobs/{state['id']}",
+        results_url=f"/api/jobs/{state['id']}/results"
+    )), status_code
+
+@app.route('/api/jobs/<job_id>')
+def scoring_job_status(job_id):
+    """Progress of a scoring job plus a page of the rows scored so far
+    
+    Query parameters: offset (first row, default 0) and limit (rows, default
+    100, 0 for progress only).
+    """
+    state = scoring_jobs.load_state(job_id)
+    if state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    try:
+        offset = max(request.args.get('offset', default=0, type=int), 0)
+        limit = min(max(request.args.get('limit', default=100, type=int), 0), 10000)
+        return jsonify(dict(
+            scoring_jobs.public_state(state),
+            offset=offset,
+            results=scoring_jobs.read_results(state, offset, limit) if limit else []
+        ))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>/results')
+def scoring_job_results(job_id):
+    """Download the NDJSON results of a finished scoring job"""
+    state = scoring_jobs.load_state(job_id)
+    if state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if state['status'] != 'done':
+        return jsonify(dict(scoring_jobs.public_state(state), error='Job has not finished')), 409
+    return send_file(os.path.abspath(scoring_jobs.result_path(job_id)), mimetype='application/x-ndjson',
+                     as_attachment=True, download_name=f'diagnoses-{job_id}.ndjson')
+
+@app.route('/api/similar_patients', methods=['POST'])
+def similar_patients():
+    """Past patients whose lab values are closest to the posted patient
+    
+    The body holds the patient's values (engine or lab export field names,
+    any of similarity.FEATURES) plus optional "k" (default 5) and "sources",
+    a list of SIMILARITY_SOURCES (default ["uploads"]).
+    """
+    try:
+        data = request.json
+        if not isinstance(data, dict):
+            return jsonify({'error': 'No data provided'}), 400
+        if np.isnan(similarity.patient_vector(data)).all():
+            return jsonify({'error': f"Provide at least one of: {', '.join(similarity.FEATURES)}"}), 400
+        k = int(data.get('k', 5))
+        if not 1 <= k <= 100:
+            return jsonify({'error': 'k must be between 1 and 100'}), 400
+        sources = data.get('sources', ['uploads'])
+        if isinstance(sources, str):
+            sources = [sources]
+        unknown = [source for source in sources if source not in SIMILARITY_SOURCES]
+        if unknown:
+            return jsonify({'error': f"Unknown sources: {', '.join(map(str, unknown))}"}), 400
+        
+        results = {}
+        for source in sources:
+            with metrics.stage('similarity_query'):
+                results[source] = get_similarity_index(source).query(data, k)
+        return jsonify({'k': k, 'results': results})
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/symptom_search')
+def search_symptoms():
+    """Uploaded records whose symptoms and lab values match a query, newest first
+    
+    ?q= takes symptom words, prefixes (fatig*) and "phrases" joined by AND,
+    OR or NOT, plus comparisons on lab values, e.g.
+    q=fatigue AND glucose > 180. Optional limit (default 50) and before (the
+    next_before of the previous page).
+    """
+    query = request.args.get('q', '')
+    if not query.strip():
+        return jsonify({'error': 'Provide a query in q'}), 400
+    try:
+        limit = request.args.get('limit', default=symptom_search.DEFAULT_LIMIT, type=int)
+        before = request.args.get('before', type=int)
+        with metrics.stage('symptom_search'):
+            results = symptom_index.search(query, limit, before)
+        return jsonify({
+            'query': query,
+            'results': results,
+            'next_before': results[-1]['id'] if len(results) == limit else None
+        })
+    except symptom_search.QueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/datasets')
+def list_datasets():
+    """Datasets registered from uploads, with their columns and types"""
+    try:
+        return jsonify({'datasets': [dataset.describe() for dataset in dataset_store.list()]})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/datasets/<dataset_id>')
+def get_dataset(dataset_id):
+    dataset = dataset_store.get(dataset_id)
+    if dataset is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    return jsonify(dataset.describe())
+
+def mark_missing_values(viz_data):
+    """Replace unmeasured (NaN) chart values with null and grey them out"""
+    for i, value in enumerate(viz_data['values']):
+        if value != value:
+            viz_data['values'][i] = None
+            viz_data['colors'][i] = COLOR_MISSING
+
 @app.route('/api/generate_sample')
 def generate_sample():
-    """Generate sample patient data"""
+    """Generate sample patient data
+    
+    Without ?n, one random patient for the analysis form. With ?n=N, a stream
+    of N synthetic lab export rows (the uploads.csv columns) as NDJSON, or CSV
+    with ?format=csv. Every stream has its own seed, returned in the
+    X-Synthetic-Seed header; pass ?seed= to repeat a stream.
+    """
     try:
-        np.random.seed(42)
-        sample_data = {
-            'patient_id': f"SAMPLE_{np.random.randint(1000, 9999)}",
-            'age': np.random.randint(25, 75),
-            'gender': np.random.choice(["Male", "Female"]),
-            'glucose': np.random.randint(70, 180),
-            'systolic_bp': np.random.randint(90, 160),
-            'diastolic_bp': np.random.randint(60, 100),
-            'cholesterol': np.random.randint(150, 280),
-            'bmi': round(np.random.uniform(18, 35), 1)
-        }
-        return jsonify(sample_data)
+        seed = request.args.get('seed', type=int)
+        if seed is None:
+            seed = synthetic.new_seed()
+        elif seed < 0:
+            return jsonify({'error': 'seed must not be negative'}), 400
+        
+        if 'n' not in request.args:
+            frame = synthetic.draw_lab_export(synthetic.lab_export_generators(seed), 1)
+            patient = {field: values[0] for field, values in lab_schema.frame_to_patients(frame).items()}
+            rng = np.random.default_rng(seed)
+            bmi_mean, bmi_std = synthetic.FEATURE_DISTRIBUTIONS['bmi'][1]
+            patient.update(
+                patient_id=f"SAMPLE_{rng.integers(1000, 10000)}",
+                bmi=round(float(np.clip(rng.normal(bmi_mean, bmi_std), 16, 45)), 1)
+            )
+            return jsonify(patient)
+        
+        n = request.args.get('n', type=int)
+        if n is None or not 0 < n <= app.config['SYNTHETIC_MAX_ROWS']:
+            return jsonify({'error': f"n must be between 1 and {app.config['SYNTHETIC_MAX_ROWS']}"}), 400
+        text_format = request.args.get('format', 'ndjson')
+        if text_format not in ('ndjson', 'csv'):
+            return jsonify({'error': 'format must be ndjson or csv'}), 400
+        
+        chunks = synthetic.lab_export_text(n, seed, text_format)
+        mimetype = 'text/csv' if text_format == 'csv' else 'application/x-ndjson'
+        return Response(chunks, mimetype=mimetype, headers={'X-Synthetic-Seed': str(seed)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/batching/stats')
+def batching_stats():
+    """Queue depth and batch-size distribution of the micro-batcher"""
+    if app.config['MICRO_BATCH_MAX_SIZE'] <= 0:
+        return jsonify({'enabled': False})
+    batcher = get_micro_batcher()
+    return jsonify(dict(batcher.stats(), enabled=True))
+
+@app.route('/api/result_cache/stats')
+def result_cache_stats():
+    """Size and hit/miss counters of the analysis result cache"""
+    return jsonify(analysis_cache.stats())
+
+@app.route('/api/model/retrain', methods=['GET', 'POST'])
+def retrain_model():
+    """Start background retraining (POST) or report its progress (GET)
+    
+    POST body: {"dataset": "uploads.csv"} to learn from a labelled lab export
+    in TRAINING_DATA_FOLDER, or {"samples": N} for synthetic data; optional
+    "model" (a model_registry name, default: the kind being served),
+    "holdout_fraction", "min_accuracy" and "max_regression".
+    """
+    if request.method == 'GET':
+        return jsonify(retraining_job.status())
+    
+    try:
+        from werkzeug.utils import safe_join
+        
+        options = request.get_json(silent=True) or {}
+        model_name = options.get('model')
+        if model_name is not None and model_name not in model_registry.MODELS:
+            return jsonify({'error': f"Unknown model: {model_name}",
+                            'models': list(model_registry.MODELS)}), 400
+        dataset = options.get('dataset')
+        if dataset:
+            path = safe_join(app.config['TRAINING_DATA_FOLDER'], dataset)
+            if path is None or not os.path.isfile(path):
+                return jsonify({'error': f"Dataset not found: {dataset}"}), 404
+            load_data = lambda: retraining.load_labelled_csv(path, PATIENT_FIELDS, read=dataset_store.load_csv)
+        else:
+            samples = int(options.get('samples', 1000))
+            if samples <= 0:
+                return jsonify({'error': 'samples must be positive'}), 400
+            
+            def load_data():
+                X, labels = ai_system.synthetic_training_data(samples)
+                return X, labels, {'training_data': 'synthetic'}
+        
+        if model_name:
+            read_data = load_data
+            
+            def load_data():
+                X, labels, info = read_data()
+                return X, labels, dict(info, model_name=model_name)
+        
+        started = retraining_job.start(
+            load_data,
+            holdout_fraction=float(options.get('holdout_fraction', 0.2)),
+            min_accuracy=float(options.get('min_accuracy', 0.8)),
+            max_regression=float(options.get('max_regression', 0.0))
+        )
+        if not started:
+            return jsonify(dict(retraining_job.status(), error='Retraining already running')), 409
+        return jsonify(retraining_job.status()), 202
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/cohort_stats')
+def cohort_statistics():
+    """Counts per diagnosis and metric means/percentiles by cohort
+    
+    Query parameters: group_by (comma-separated, default "age_band,sex"),
+    filters source / age_band / sex, and percentiles (default "25,50,75,90").
+    Answered from the rollups, so the cost doesn't grow with the data.
+    """
+    try:
+        group_by = [d for d in request.args.get('group_by', 'age_band,sex').split(',') if d]
+        unknown = set(group_by) - set(cohort_stats.GROUP_DIMENSIONS)
+        if unknown:
+            return jsonify({'error': f"Unknown group_by dimensions: {', '.join(sorted(unknown))}"}), 400
+        percentiles = [float(p) for p in request.args.get('percentiles', '25,50,75,90').split(',') if p]
+        if not all(0 <= p <= 100 for p in percentiles):
+            return jsonify({'error': 'percentiles must be between 0 and 100'}), 400
+        percentiles = [int(p) if p.is_integer() else p for p in percentiles]
+        
+        filters = {d: request.args.get(d) for d in cohort_stats.GROUP_DIMENSIONS}
+        groups = cohort_store.query(group_by, filters, percentiles)
+        return jsonify({
+            'group_by': group_by,
+            'filters': {d: v for d, v in filters.items() if v is not None},
+            'total_records': sum(group['count'] for group in groups),
+            'groups': groups
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -465,16 +1492,37 @@ def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'model_trained': ml_model is not None,
+        'ready': current_model is not None,
+        'pid': os.getpid(),
+        'model_trained': current_model is not None,
+        'model_version': current_model.version if current_model else None,
+        'retraining': retraining_job.status(),
+        'result_cache': analysis_cache.stats(),
+        'admission': admission_control.stats(),
         'upload_folder': app.config['UPLOAD_FOLDER']
     })
 
-if __name__ == '__main__':
+def prepare_model(model_path):
+    """Load the persisted model, training and saving a new one if none exists"""
+    app.config['MODEL_PATH'] = model_path
+    if ai_system.load_model(model_path):
+        loaded_name = current_model.metadata.get('model_name', model_registry.DEFAULT_MODEL)
+        if loaded_name == serving_model_name():
+            return True
+        print(f"ℹ️  Model artifact at {model_path} is {loaded_name}, training {serving_model_name()}")
+    else:
+        print(f"ℹ️  No usable model artifact at {model_path}, training a new one")
+    if ai_system.train_model():
+        ai_system.save_model(model_path)
+        return True
+    return False
+
+def run_dev_server(args):
+    """Start Flask's development server"""
     print("🚀 Starting AI Diagnostic System...")
     print(f"📁 Upload folder: {app.config['UPLOAD_FOLDER']}")
     
-    # Train model on startup
-    if ai_system.train_model():
+    if prepare_model(args.model_path):
         print("✅ System ready!")
         print("🌐 Open http://localhost:5000 in your browser")
     else:
@@ -485,4 +1533,270 @@ if __name__ == '__main__':
     except Exception as e:
         print(f"❌ Error starting server: {e}")
         print("🔄 Trying alternative port 5001...")
-        app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+        app.run(debug=True, host='0.0.0.0', port=5001)
+    return 0
+
+def job_workers_per_process(server_workers):
+    """Scoring job processes per server process that share the cores between them"""
+    return max(1, (os.cpu_count() or 1) // max(server_workers, 1))
+
+def serve_command(args):
+    """Serve with pre-forked workers sharing the preloaded model"""
+    import prefork
+    
+    print("🚀 Starting AI Diagnostic System (production)...")
+    if not prepare_model(args.model_path):
+        print("❌ No model available, refusing to start")
+        return 1
+    
+    if not app.config['JOB_WORKERS']:
+        # Each prefork worker runs its own job pool
+        scoring_jobs.workers = job_workers_per_process(args.workers)
+    server = prefork.PreforkServer(
+        app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        max_requests=args.max_requests,
+        max_requests_jitter=args.max_requests_jitter,
+        graceful_timeout=args.graceful_timeout,
+        ready_file=args.ready_file
+    )
+    return server.run()
+
+def train_command(args):
+    """Train the model and write it as a versioned artifact"""
+    if args.model:
+        app.config['MODEL_NAME'] = args.model
+    if args.data:
+        try:
+            X, labels, info = retraining.load_labelled_csv(args.data, PATIENT_FIELDS, read=dataset_store.load_csv)
+            bundle = ai_system.fit_model(X, labels, info)
+        except (OSError, ValueError) as e:
+            print(f"❌ Error training model: {e}")
+            return 1
+        print(f"✅ AI model trained on {len(X)} rows of {args.data}")
+        return 0 if ai_system.save_model(args.model_path, bundle) else 1
+    
+    if not ai_system.train_model(n_samples=args.samples, seed=args.seed):
+        return 1
+    return 0 if ai_system.save_model(args.model_path) else 1
+
+def evaluate_models_command(args):
+    """Train every candidate model on one split and report accuracy, latency and size"""
+    if args.data:
+        try:
+            X, labels, info = retraining.load_labelled_csv(args.data, PATIENT_FIELDS, read=dataset_store.load_csv)
+        except (OSError, ValueError) as e:
+            print(f"❌ Error loading {args.data}: {e}")
+            return 1
+    else:
+        X, labels = ai_system.synthetic_training_data(args.samples, args.seed)
+    
+    train_rows, test_rows = retraining.split_holdout(len(X), args.test_fraction, args.seed)
+    print(f"🤖 Evaluating {len(args.models)} models on {len(train_rows)} training "
+          f"and {len(test_rows)} holdout rows...")
+    report = model_registry.evaluate(
+        args.models,
+        fit=lambda X_train, y_train, name: ai_system.fit_model(X_train, y_train, {'model_name': name}),
+        score_row=lambda bundle, patient: ai_system.ml_prediction(patient, bundle),
+        X_train=X.iloc[train_rows], y_train=labels[train_rows],
+        X_test=X.iloc[test_rows].reset_index(drop=True), y_test=labels[test_rows],
+        latency_rows=args.latency_rows
+    )
+    print(model_registry.format_report(report))
+    
+    chosen = model_registry.select(report, args.latency_budget_ms)
+    budget = f" within a p99 budget of {args.latency_budget_ms} ms" if args.latency_budget_ms else ""
+    if chosen is None:
+        print(f"❌ No model meets the p99 budget of {args.latency_budget_ms} ms")
+    else:
+        print(f"✅ Most accurate{budget}: {chosen['model']} ({chosen['accuracy']:.4f}); "
+              f"serve it with MODEL_NAME={chosen['model']}")
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'training_data': args.data or 'synthetic',
+                'train_rows': len(train_rows),
+                'test_rows': len(test_rows),
+                'latency_budget_ms': args.latency_budget_ms,
+                'selected': chosen['model'] if chosen else None,
+                'models': report
+            }, f, indent=2)
+        print(f"💾 Report written to {args.output}")
+    return 0 if chosen else 1
+
+def generate_command(args):
+    """Write a labelled synthetic dataset to CSV or Parquet"""
+    started = time.time()
+    try:
+        rows = synthetic.write(args.output, args.samples, seed=args.seed, chunk_size=args.chunk_size,
+                               lab_export=args.lab_export)
+    except (OSError, ValueError) as e:
+        print(f"❌ Error generating data: {e}")
+        return 1
+    print(f"✅ Wrote {rows} synthetic patients to {args.output} in {time.time() - started:.1f}s")
+    return 0
+
+def verify_scorer_command(args):
+    """Check the compiled tree against scikit-learn on synthetic data and lab exports"""
+    if not prepare_model(args.model_path):
+        return 1
+    bundle = current_model
+    if bundle.compiled is None:
+        print("❌ The loaded model can't be compiled")
+        return 1
+    
+    X, _ = ai_system.synthetic_training_data(args.samples)
+    datasets = [('synthetic', bundle.encode_features(X))]
+    
+    for path in args.csv:
+        patients = lab_schema.frame_to_patients(dataset_store.load_csv(path))
+        features = np.column_stack([
+            np.asarray([bundle.gender_codes.get(g, 0) for g in patients['gender']], dtype=float)
+            if field == 'gender' else np.asarray(patients[field], dtype=float)
+            for field in PATIENT_FIELDS
+        ])
+        # Exports without BMI get the training mean so every row can be compared
+        features[np.isnan(features)] = 25.0
+        datasets.append((path, features))
+    
+    failed = False
+    for name, features in datasets:
+        mismatches = tree_scorer.verify_against_sklearn(bundle.model, bundle.compiled, features)
+        status = "✅" if mismatches == 0 else "❌"
+        print(f"{status} {name}: {mismatches} of {len(features)} rows differ from scikit-learn")
+        failed = failed or mismatches > 0
+    return 1 if failed else 0
+
+def cohort_rebuild_command(args):
+    """Rebuild the cohort statistics from lab exports and the hack1 database"""
+    import pandas as pd
+    import sqlite3
+    
+    cohort_store.reset()
+    total = 0
+    for path in args.csv:
+        dataset, _ = dataset_store.ingest_file(path, os.path.basename(path))
+        # Keyed by digest, so uploading the same file later doesn't count it again
+        total += cohort_store.record_dataset(dataset.id, dataset_chunks(dataset.frame()))
+    
+    if args.patients_db and os.path.exists(args.patients_db):
+        conn = sqlite3.connect(args.patients_db)
+        try:
+            for chunk in pd.read_sql_query('SELECT * FROM patients', conn, chunksize=100000):
+                total += cohort_store.record_frame('hack1', chunk)
+        finally:
+            conn.close()
+    print(f"✅ Cohort statistics rebuilt from {total} records")
+    return 0
+
+def symptom_index_command(args):
+    """Add lab exports and every stored dataset to the symptom search index"""
+    for path in args.csv:
+        if os.path.exists(path):
+            dataset_store.ingest_file(path, os.path.basename(path))
+    added = 0
+    for dataset in dataset_store.list():
+        if not symptom_index.is_indexed(dataset.id):
+            added += symptom_index.index_dataset(dataset.id, dataset_chunks(dataset.frame()))
+    stats = symptom_index.stats()
+    print(f"✅ Indexed {added} new records; {stats['records']} records from {stats['datasets']} datasets are searchable")
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='AI Diagnostic System')
+    parser.add_argument('--model-path', default=model_store.DEFAULT_MODEL_PATH,
+                        help='Model artifact to load or write')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    subparsers.add_parser('run', help='Start the development server (default)')
+    
+    serve_parser = subparsers.add_parser('serve', help='Start the multi-process production server')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=5000)
+    serve_parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                              help='Number of worker processes (default: one per core)')
+    serve_parser.add_argument('--max-requests', type=int, default=0,
+                              help='Recycle a worker after this many requests (0 = never)')
+    serve_parser.add_argument('--max-requests-jitter', type=int, default=0,
+                              help='Random extra requests per worker so they don\'t recycle together')
+    serve_parser.add_argument('--graceful-timeout', type=float, default=30,
+                              help='Seconds to wait for in-flight requests on shutdown')
+    serve_parser.add_argument('--ready-file',
+                              help='File created once all workers pass the /health check')
+    
+    train_parser = subparsers.add_parser('train', help='Train the model and save the artifact')
+    train_parser.add_argument('--samples', type=int, default=1000,
+                              help='Number of synthetic training samples')
+    train_parser.add_argument('--seed', type=int, default=synthetic.DEFAULT_SEED,
+                              help='Seed of the synthetic training data')
+    train_parser.add_argument('--data',
+                              help='Labelled lab export to train on instead of synthetic data')
+    train_parser.add_argument('--model', choices=list(model_registry.MODELS),
+                              help='Kind of model to train (default: MODEL_NAME or the current artifact\'s)')
+    
+    evaluate_parser = subparsers.add_parser('evaluate-models',
+                                            help='Compare the registered models on accuracy, latency and size')
+    evaluate_parser.add_argument('--models', nargs='+', choices=list(model_registry.MODELS),
+                                 default=list(model_registry.MODELS))
+    evaluate_parser.add_argument('--samples', type=int, default=20000,
+                                 help='Number of synthetic samples')
+    evaluate_parser.add_argument('--seed', type=int, default=synthetic.DEFAULT_SEED)
+    evaluate_parser.add_argument('--data',
+                                 help='Labelled lab export to evaluate on instead of synthetic data')
+    evaluate_parser.add_argument('--test-fraction', type=float, default=0.2,
+                                 help='Share of rows held out for measuring')
+    evaluate_parser.add_argument('--latency-rows', type=int, default=1000,
+                                 help='Holdout patients scored one at a time for the latency percentiles')
+    evaluate_parser.add_argument('--latency-budget-ms', type=float,
+                                 help='Pick the most accurate model whose p99 latency is within this')
+    evaluate_parser.add_argument('--output', help='Write the report as JSON')
+    
+    generate_parser = subparsers.add_parser('generate', help='Write a labelled synthetic dataset')
+    generate_parser.add_argument('--samples', type=int, default=1000000,
+                                 help='Number of synthetic patients')
+    generate_parser.add_argument('--seed', type=int, default=synthetic.DEFAULT_SEED)
+    generate_parser.add_argument('--chunk-size', type=int, default=synthetic.DEFAULT_CHUNK_SIZE,
+                                 help='Rows generated and written at a time')
+    generate_parser.add_argument('--output', required=True,
+                                 help='Output file (.csv or .parquet)')
+    generate_parser.add_argument('--lab-export', action='store_true',
+                                 help='Write full lab exports (the uploads.csv columns) labelled by diagnosis')
+    
+    verify_parser = subparsers.add_parser('verify-scorer',
+                                          help='Check the compiled tree scorer against scikit-learn')
+    verify_parser.add_argument('--samples', type=int, default=1000,
+                               help='Number of synthetic rows to compare')
+    verify_parser.add_argument('--csv', nargs='*', default=['uploads.csv'],
+                               help='Lab exports to compare on')
+    
+    cohort_parser = subparsers.add_parser('cohort-rebuild',
+                                          help='Rebuild the cohort statistics rollups from scratch')
+    cohort_parser.add_argument('--csv', nargs='*', default=['uploads.csv'],
+                               help='Lab exports to include')
+    cohort_parser.add_argument('--patients-db', default=os.path.join('hack1', 'database', 'patients.db'),
+                               help='hack1 patients database to include')
+    
+    symptom_parser = subparsers.add_parser('symptom-index',
+                                           help='Index stored datasets for symptom search')
+    symptom_parser.add_argument('--csv', nargs='*', default=['uploads.csv'],
+                                help='Lab exports to add to the dataset store and index')
+    
+    args = parser.parse_args(argv)
+    commands = {
+        None: run_dev_server,
+        'run': run_dev_server,
+        'serve': serve_command,
+        'train': train_command,
+        'evaluate-models': evaluate_models_command,
+        'generate': generate_command,
+        'verify-scorer': verify_scorer_command,
+        'cohort-rebuild': cohort_rebuild_command,
+        'symptom-index': symptom_index_command
+    }
+    return commands[args.command](args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Dynamic micro-batching for concurrent scoring requests
+
+Request threads submit single items; a background thread collects whatever
+arrives within a short window (or until the batch is full) and scores the
+whole batch with one call. Each request waits only for its own result, so
+latency stays bounded by max_wait_us plus the batch's scoring time while
+throughput under load approaches that of the batch API.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size=32, max_wait_us=500):
+        """`process_batch` takes a list of items and returns a list of results in the same order"""
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        if max_wait_us < 0:
+            raise ValueError('max_wait_us must not be negative')
+
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_us = max_wait_us
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._batches = 0
+        self._items = 0
+        self._failures = 0
+        # Batch size histogram in power-of-two buckets: bucket b counts sizes <= b
+        self._size_buckets = []
+        bucket = 1
+        while bucket < max_batch_size:
+            self._size_buckets.append(bucket)
+            bucket *= 2
+        self._size_buckets.append(max_batch_size)
+        self._size_counts = [0] * len(self._size_buckets)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Score everything already queued, then stop the worker thread"""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def submit(self, item):
+        """Queue one item and return a Future for its result"""
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def process(self, item, timeout=None):
+        """Queue one item and wait for its result"""
+        return self.submit(item).result(timeout)
+
+    def stats(self):
+        with self._lock:
+            histogram = {str(bucket): count for bucket, count in zip(self._size_buckets, self._size_counts)}
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_us': self.max_wait_us,
+                'queue_depth': self._queue.qsize(),
+                'batches': self._batches,
+                'items': self._items,
+                'failed_batches': self._failures,
+                'mean_batch_size': round(self._items / self._batches, 2) if self._batches else 0.0,
+                'batch_size_histogram': histogram
+            }
+
+    def _run(self):
+        max_wait = self.max_wait_us / 1_000_000
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is _STOP:
+                break
+
+            # Collect more work until the batch is full or the window closes
+            batch = [entry]
+            deadline = time.perf_counter() + max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining > 0:
+                        entry = self._queue.get(timeout=remaining)
+                    else:
+                        entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            self._process(batch)
+
+    def _process(self, batch):
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            results = self.process_batch(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"Batch returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            with self._lock:
+                self._failures += 1
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self._batches += 1
+            self._items += len(items)
+            for i, bucket in enumerate(self._size_buckets):
+                if len(items) <= bucket:
+                    self._size_counts[i] += 1
+                    break
+        for future, result in zip(futures, results):
+            future.set_result(result)
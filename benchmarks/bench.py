@@ -0,0 +1,295 @@
+"""Offline benchmark suite for the diagnostic engine and both web apps
+
+Runs everything in-process (Flask test clients, temporary databases) with
+uploads.csv as the fixture, writes the results as JSON and compares them with
+a stored baseline. A result more than --tolerance worse than its baseline is
+reported as a regression and the run exits with status 1.
+
+    python benchmarks/bench.py                      # run and compare with baseline.json
+    python benchmarks/bench.py --quick              # smaller sizes, for a fast check
+    python benchmarks/bench.py --update-baseline    # record a new baseline
+
+Timings depend on the machine, so compare against a baseline recorded on the
+same kind of machine. Each latency is the best of --repeat runs, which is the
+most stable estimate of the code's own cost.
+"""
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE = os.path.join(REPO, 'uploads.csv')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def unique_csvs(csv_bytes, count, tag):
+    """`count` copies of a CSV whose first patient ids are made unique with `tag`
+
+    Uploads are recognized by content digest, so sending the same bytes again
+    would measure a cache hit instead of an upload.
+    """
+    header, first = csv_bytes.split(b'\n', 1)
+    patient_id, rest = first.split(b',', 1)
+    return [b'%s\n%s-%s%d,%s' % (header, patient_id, tag, i, rest) for i in range(count)]
+
+
+def best_of(repeat, run):
+    """Shortest wall time of `repeat` calls of run()"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+class Suite:
+    def __init__(self, repeat, quick):
+        self.repeat = repeat
+        self.quick = quick
+        self.results = {}
+
+    def record(self, name, value, unit, better):
+        self.results[name] = {'value': round(value, 3), 'unit': unit, 'better': better}
+        print(f"  {name:<40} {value:>12.3f} {unit}")
+
+    # --- Diagnostic engine ---
+
+    def engine(self, app_module, patients):
+        ai_system = app_module.ai_system
+        cache = app_module.analysis_cache
+
+        def analyze_uncached():
+            cache.clear()
+            for patient in patients:
+                ai_system.analyze_patient(patient)
+        single = best_of(self.repeat, analyze_uncached)
+        self.record('analyze_patient', single / len(patients) * 1e6, 'us/patient', 'lower')
+
+        # Every panel was just analyzed, so this is the repeated-submission path
+        cached = best_of(self.repeat, lambda: [ai_system.analyze_patient(p) for p in patients])
+        self.record('analyze_patient_cached', cached / len(patients) * 1e6, 'us/patient', 'lower')
+
+        batch = best_of(self.repeat, lambda: ai_system.analyze_batch(patients))
+        self.record('analyze_batch', batch / len(patients) * 1e6, 'us/patient', 'lower')
+
+    def training(self, app_module):
+        sizes = [1000, 10000] if self.quick else [1000, 10000, 100000]
+        # The first fit pays for importing scikit-learn
+        app_module.ai_system.train_model(100)
+        for n_samples in sizes:
+            seconds = best_of(max(1, self.repeat // 2), lambda: app_module.ai_system.train_model(n_samples))
+            self.record(f'train_model[{n_samples}]', seconds, 's', 'lower')
+
+    # --- HTTP endpoints ---
+
+    def http(self, app_module, patients, csv_bytes):
+        client = app_module.app.test_client()
+        requests = patients[:200] if self.quick else patients
+
+        def post_all():
+            app_module.analysis_cache.clear()
+            for patient in requests:
+                # Closing the response is what frees its admission slot
+                with client.post('/api/analyze', json=patient) as response:
+                    assert response.status_code == 200, response.data
+        seconds = best_of(self.repeat, post_all)
+        self.record('http_analyze', len(requests) / seconds, 'req/s', 'higher')
+
+        rows = csv_bytes.count(b'\n') - 1
+        bodies = iter(unique_csvs(csv_bytes, self.repeat, b'upload'))
+
+        def upload():
+            with client.post('/api/upload_csv', data={'file': (io.BytesIO(next(bodies)), 'bench.csv')},
+                             content_type='multipart/form-data') as response:
+                assert response.status_code == 200, response.data
+                assert not response.json['cached']
+        seconds = best_of(self.repeat, upload)
+        self.record('http_upload_csv', rows / seconds, 'rows/s', 'higher')
+
+        stream_bodies = iter(unique_csvs(csv_bytes, self.repeat, b'stream'))
+
+        def upload_stream():
+            with client.post('/api/upload_csv?stream=1', data=next(stream_bodies),
+                             content_type='text/csv') as response:
+                assert b'"errors": 0' in response.data.splitlines()[-1], response.data[-200:]
+        seconds = best_of(self.repeat, upload_stream)
+        self.record('http_upload_csv_stream', rows / seconds, 'rows/s', 'higher')
+
+    # --- hack1 ---
+
+    def hack1(self, hack1_app, hack1_db, forms):
+        client = hack1_app.app.test_client()
+        forms = forms[:200] if self.quick else forms
+
+        def submit_all():
+            for form in forms:
+                response = client.post('/analyze', data=form)
+                assert response.status_code == 200
+            if hack1_db.write_behind is not None:
+                hack1_db.write_behind.flush()
+
+        seconds = best_of(self.repeat, submit_all)
+        self.record('hack1_insert', len(forms) / seconds, 'req/s', 'higher')
+
+        hack1_db.init_db(use_write_behind=True)
+        seconds = best_of(self.repeat, submit_all)
+        self.record('hack1_insert_write_behind', len(forms) / seconds, 'req/s', 'higher')
+
+        # Walk the history newest to oldest, one keyset page per request
+        urls = ['/history']
+        rows = hack1_db.recent_patients(20)
+        while rows:
+            urls.append(f"/history?before={rows[-1]['id']}")
+            rows = hack1_db.recent_patients(20, rows[-1]['id'])
+
+        def read_history():
+            for url in urls:
+                response = client.get(url)
+                assert response.status_code == 200
+        seconds = best_of(self.repeat, read_history)
+        self.record('hack1_history', len(urls) / seconds, 'req/s', 'higher')
+
+
+def load_fixture():
+    """uploads.csv as analyze_patient dicts, raw CSV bytes and hack1 form posts"""
+    import pandas as pd
+    import lab_schema
+    import retraining
+
+    df = pd.read_csv(FIXTURE)
+    columns = lab_schema.frame_to_patients(df)
+    # The export has no BMI; use the training default so every row gets an ML prediction
+    for field, default in retraining.FEATURE_DEFAULTS.items():
+        columns[field] = [default if value != value else value for value in columns[field]]
+    patients = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    forms = [{
+        'name': str(patient_id), 'age': str(age), 'gender': lab_schema.GENDER_CODES.get(sex, sex),
+        'glucose': str(glucose), 'systolic_bp': str(systolic), 'diastolic_bp': str(diastolic),
+        'cholesterol': str(cholesterol)
+    } for patient_id, age, sex, glucose, systolic, diastolic, cholesterol in zip(
+        df['patient_id'], df['age'], df['sex'], df['glucose_mg_dl'], df['systolic_bp'],
+        df['diastolic_bp'], df['cholesterol_mg_dl'])]
+
+    with open(FIXTURE, 'rb') as f:
+        return patients, f.read(), forms
+
+
+def load_hack1():
+    """Import hack1/app.py under its own name (both apps are called app.py)"""
+    sys.path.insert(0, os.path.join(REPO, 'hack1'))
+    spec = importlib.util.spec_from_file_location('hack1_app', os.path.join(REPO, 'hack1', 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Flask finds templates/ through the module registered under the app's import name
+    sys.modules['hack1_app'] = module
+    spec.loader.exec_module(module)
+    import db
+    db.init_db()
+    return module, db
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='diagnostic-bench-')
+    # Keep every file the apps write (uploads, databases) out of the repository
+    os.environ['PATIENTS_DB'] = os.path.join(workdir, 'patients.db')
+    os.environ['COHORT_STATS_DB'] = os.path.join(workdir, 'cohort_stats.db')
+    os.environ['SYMPTOM_INDEX_DB'] = os.path.join(workdir, 'symptoms.db')
+    os.environ['MODEL_RELOAD_INTERVAL'] = '0'
+    os.environ.pop('MICRO_BATCH_MAX_SIZE', None)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+
+    import app as app_module
+
+    suite = Suite(args.repeat, args.quick)
+    patients, csv_bytes, forms = load_fixture()
+
+    print("📦 Training")
+    suite.training(app_module)
+    print("🤖 Engine")
+    app_module.ai_system.train_model()
+    suite.engine(app_module, patients)
+    print("🌐 HTTP")
+    suite.http(app_module, patients, csv_bytes)
+    print("💾 hack1")
+    hack1_app, hack1_db = load_hack1()
+    suite.hack1(hack1_app, hack1_db, forms)
+
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'quick': args.quick,
+        'results': suite.results
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Names of results more than `tolerance` worse than the baseline"""
+    regressions = []
+    print(f"\n{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, base in baseline['results'].items():
+        current = results['results'].get(name)
+        if current is None or not base['value']:
+            continue
+        change = current['value'] / base['value'] - 1
+        worse = -change if base['better'] == 'higher' else change
+        status = '❌' if worse > tolerance else '✅'
+        print(f"{name:<40} {base['value']:>12.3f} {current['value']:>12.3f} {change:>+7.1%} {status}")
+        if worse > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the diagnostic system')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON to compare with')
+    parser.add_argument('--update-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown before a result counts as a regression (0.25 = 25%%)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark; the best is kept')
+    parser.add_argument('--quick', action='store_true', help='Smaller workloads for a fast check')
+    args = parser.parse_args(argv)
+    args.output = args.output and os.path.abspath(args.output)
+    args.baseline = os.path.abspath(args.baseline)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"ℹ️  No baseline at {args.baseline}; run with --update-baseline to record one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('quick') != args.quick:
+        print("⚠️  Baseline was recorded with a different --quick setting; sizes differ")
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    print("✅ No regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
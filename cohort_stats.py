@@ -0,0 +1,340 @@
+"""Incrementally maintained cohort statistics for population dashboards
+
+Every saved or uploaded record is folded into rollups kept in SQLite, per
+source (uploads, hack1), age band and sex:
+
+    cohort_diagnoses   record count per diagnosis
+    cohort_metrics     count and sum of each metric (exact means)
+    cohort_histograms  fixed-width histogram of each metric
+
+Histograms with fixed bins are mergeable sketches: combining groups, sources
+or batches is adding counts, so ingesting a batch is a handful of UPSERTs and
+a query reads a few thousand rollup rows however many records were ingested.
+Uploaded datasets are recorded once per content digest (record_dataset), so
+the same file uploaded again, streamed or scored as a job doesn't count twice.
+Percentiles are interpolated within a bin, so they are accurate to one bin
+width (see METRIC_BINS).
+"""
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import numpy as np
+
+import lab_schema
+
+DEFAULT_DB_PATH = os.environ.get(
+    'COHORT_STATS_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'cohort_stats.db')
+)
+
+# Upper edges of the age bands; ages at or above the last edge fall in the last band
+AGE_BAND_EDGES = [18, 30, 40, 50, 60, 70]
+AGE_BANDS = ['<18', '18-29', '30-39', '40-49', '50-59', '60-69', '70+']
+SEXES = ['Female', 'Male']
+UNKNOWN = 'Unknown'
+
+# Metric -> (lowest bin edge, bin width, number of bins); values outside the
+# range are counted in the first or last bin
+METRIC_BINS = {
+    'glucose': (0, 1, 600),
+    'hba1c': (2, 0.1, 180),
+    'systolic_bp': (40, 1, 230),
+    'diastolic_bp': (20, 1, 140),
+    'cholesterol': (0, 1, 600),
+    'bmi': (10, 0.1, 600)
+}
+
+# Metric -> accepted column names; the others resolve through lab_schema
+METRIC_ALIASES = {'hba1c': ['hba1c', 'hb_a1c_percent']}
+
+DEFAULT_PERCENTILES = (25, 50, 75, 90)
+GROUP_DIMENSIONS = ('source', 'age_band', 'sex')
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS cohort_diagnoses (
+        source TEXT, age_band TEXT, sex TEXT, diagnosis TEXT, n INTEGER NOT NULL,
+        PRIMARY KEY (source, age_band, sex, diagnosis))''',
+    '''CREATE TABLE IF NOT EXISTS cohort_metrics (
+        source TEXT, age_band TEXT, sex TEXT, metric TEXT, n INTEGER NOT NULL, total REAL NOT NULL,
+        PRIMARY KEY (source, age_band, sex, metric))''',
+    '''CREATE TABLE IF NOT EXISTS cohort_histograms (
+        source TEXT, age_band TEXT, sex TEXT, metric TEXT, bin INTEGER, n INTEGER NOT NULL,
+        PRIMARY KEY (source, age_band, sex, metric, bin))''',
+    '''CREATE TABLE IF NOT EXISTS cohort_datasets (
+        dataset TEXT PRIMARY KEY, source TEXT, rows INTEGER NOT NULL, recorded_at REAL)'''
+]
+
+
+def _to_float(values):
+    """Float array of `values`; blanks and non-numbers become NaN"""
+    try:
+        return np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        result = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                result[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return result
+
+
+def age_bands(ages):
+    """Age band label index per age (len(AGE_BANDS) for unknown ages)"""
+    ages = _to_float(ages)
+    bands = np.searchsorted(AGE_BAND_EDGES, ages, side='right')
+    return np.where(np.isnan(ages), len(AGE_BANDS), bands)
+
+
+def sex_index(values):
+    """Index into SEXES per value (len(SEXES) for unknown)"""
+    codes = {code: SEXES.index(sex) for code, sex in lab_schema.GENDER_CODES.items()}
+    return np.array([codes.get(value.strip(), len(SEXES)) if isinstance(value, str) else len(SEXES)
+                     for value in values], dtype=np.int64)
+
+
+def metric_bins(metric, values):
+    """Histogram bin per value (NaN values get -1)"""
+    low, width, count = METRIC_BINS[metric]
+    values = _to_float(values)
+    bins = np.clip(np.floor((values - low) / width), 0, count - 1)
+    return np.where(np.isnan(values), -1, bins).astype(np.int64)
+
+
+def frame_to_records(df):
+    """Columns of a lab export DataFrame in the form accepted by record()"""
+    records = {}
+    for field, column in [('age', lab_schema.find_column(df.columns, 'age')),
+                          ('sex', lab_schema.find_column(df.columns, 'gender')),
+                          ('diagnosis', 'diagnosis' if 'diagnosis' in df.columns else None)]:
+        if column:
+            records[field] = df[column].tolist()
+    for metric in METRIC_BINS:
+        aliases = METRIC_ALIASES.get(metric) or lab_schema.FIELD_ALIASES.get(metric, [metric])
+        column = next((name for name in aliases if name in df.columns), None)
+        if column:
+            records[metric] = df[column].to_numpy()
+    return records
+
+
+class Rollup:
+    """Rollup rows of batches of records, merged in memory before they are written
+
+    Its size depends on the groups, diagnoses and histogram bins present, not
+    on the number of records, so a whole dataset can be folded into one.
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.diagnoses = {}   # (age band, sex, diagnosis) -> n
+        self.metrics = {}     # (age band, sex, metric) -> [n, total]
+        self.histograms = {}  # (age band, sex, metric, bin) -> n
+
+    def add(self, records):
+        """Fold a batch of records in
+
+        `records` maps 'age', 'sex', 'diagnosis' and any METRIC_BINS metric to
+        one sequence of values per record; missing fields count as unknown or
+        not measured. Returns the number of records added.
+        """
+        size = len(next(iter(records.values()), []))
+        if size == 0:
+            return 0
+
+        band_index = age_bands(records['age']) if 'age' in records else np.full(size, len(AGE_BANDS))
+        sexes = sex_index(records['sex']) if 'sex' in records else np.full(size, len(SEXES))
+        # One key per (age band, sex) group present in the batch
+        band_names = AGE_BANDS + [UNKNOWN]
+        sex_names = SEXES + [UNKNOWN]
+        group_codes, group_index = np.unique(band_index * len(sex_names) + sexes, return_inverse=True)
+        group_keys = [(band_names[code // len(sex_names)], sex_names[code % len(sex_names)])
+                      for code in group_codes.tolist()]
+
+        diagnoses = np.array([value if isinstance(value, str) and value else UNKNOWN
+                              for value in records.get('diagnosis', [UNKNOWN] * size)], dtype=object)
+        diagnosis_names, diagnosis_index = np.unique(diagnoses, return_inverse=True)
+        cells, cell_counts = np.unique(group_index * len(diagnosis_names) + diagnosis_index, return_counts=True)
+        for cell, count in zip(cells.tolist(), cell_counts.tolist()):
+            group, diagnosis = divmod(cell, len(diagnosis_names))
+            key = group_keys[group] + (diagnosis_names[diagnosis],)
+            self.diagnoses[key] = self.diagnoses.get(key, 0) + count
+
+        for metric in METRIC_BINS:
+            if metric not in records:
+                continue
+            values = _to_float(records[metric])
+            bins = metric_bins(metric, values)
+            measured = bins >= 0
+            if not measured.any():
+                continue
+            counts = np.bincount(group_index[measured], minlength=len(group_keys))
+            totals = np.bincount(group_index[measured], weights=values[measured], minlength=len(group_keys))
+            for group in np.flatnonzero(counts).tolist():
+                sums = self.metrics.setdefault(group_keys[group] + (metric,), [0, 0.0])
+                sums[0] += int(counts[group])
+                sums[1] += float(totals[group])
+
+            n_bins = METRIC_BINS[metric][2]
+            cells, cell_counts = np.unique(group_index[measured] * n_bins + bins[measured], return_counts=True)
+            for cell, count in zip(cells.tolist(), cell_counts.tolist()):
+                group, bin_index = divmod(cell, n_bins)
+                key = group_keys[group] + (metric, bin_index)
+                self.histograms[key] = self.histograms.get(key, 0) + count
+        self.records += size
+        return size
+
+    def add_frame(self, df):
+        """Fold a DataFrame chunk of a lab export in"""
+        return self.add(frame_to_records(df))
+
+
+class CohortStats:
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self._ready = False
+
+    def _connect(self):
+        if not self._ready:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._ready = True
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def record(self, source, records):
+        """Fold a batch of records (see Rollup.add) into the rollups"""
+        rollup = Rollup()
+        rollup.add(records)
+        return self.write(source, rollup)
+
+    def record_frame(self, source, df):
+        """Fold a DataFrame chunk of a lab export into the rollups"""
+        return self.record(source, frame_to_records(df))
+
+    def is_recorded(self, dataset):
+        with closing(self._connect()) as conn:
+            return conn.execute('SELECT 1 FROM cohort_datasets WHERE dataset = ?', (dataset,)).fetchone() is not None
+
+    def record_dataset(self, dataset, frames, source='uploads'):
+        """Fold the DataFrame chunks of a dataset into the rollups unless already recorded
+
+        `dataset` is its content digest. Returns the number of records added.
+        """
+        if self.is_recorded(dataset):
+            return 0
+        rollup = Rollup()
+        for df in frames:
+            rollup.add_frame(df)
+        return self.write(source, rollup, dataset)
+
+    def write(self, source, rollup, dataset=None):
+        """Add a Rollup to the stored rollups; returns the number of records added
+
+        With `dataset` (a content digest) it is added in the same transaction
+        that marks the dataset recorded, and not at all if it already was.
+        """
+        with closing(self._connect()) as conn, conn:
+            if dataset is not None:
+                claimed = conn.execute('INSERT OR IGNORE INTO cohort_datasets VALUES (?, ?, ?, ?)',
+                                       (dataset, source, rollup.records, time.time())).rowcount
+                if not claimed:
+                    return 0
+            conn.executemany('''
+                INSERT INTO cohort_diagnoses VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (source, age_band, sex, diagnosis) DO UPDATE SET n = n + excluded.n
+            ''', [(source,) + key + (n,) for key, n in rollup.diagnoses.items()])
+            conn.executemany('''
+                INSERT INTO cohort_metrics VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, age_band, sex, metric) DO UPDATE SET n = n + excluded.n, total = total + excluded.total
+            ''', [(source,) + key + tuple(sums) for key, sums in rollup.metrics.items()])
+            conn.executemany('''
+                INSERT INTO cohort_histograms VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, age_band, sex, metric, bin) DO UPDATE SET n = n + excluded.n
+            ''', [(source,) + key + (n,) for key, n in rollup.histograms.items()])
+        return rollup.records
+
+    def reset(self, source=None):
+        """Drop the rollups of one source, or all of them"""
+        with closing(self._connect()) as conn, conn:
+            for table in ('cohort_diagnoses', 'cohort_metrics', 'cohort_histograms', 'cohort_datasets'):
+                if source is None:
+                    conn.execute(f'DELETE FROM {table}')
+                else:
+                    conn.execute(f'DELETE FROM {table} WHERE source = ?', (source,))
+
+    def query(self, group_by=('age_band', 'sex'), filters=None, percentiles=DEFAULT_PERCENTILES):
+        """Counts, means and percentiles per group, merged from the rollups
+
+        `group_by` is any subset of GROUP_DIMENSIONS and `filters` maps those
+        dimensions to a required value.
+        """
+        group_by = [dimension for dimension in GROUP_DIMENSIONS if dimension in group_by]
+        filters = {key: value for key, value in (filters or {}).items() if value is not None}
+        for dimension in filters:
+            if dimension not in GROUP_DIMENSIONS:
+                raise ValueError(f"Unknown cohort dimension: {dimension}")
+        where = ' AND '.join(f'{dimension} = ?' for dimension in filters) or '1'
+        params = list(filters.values())
+        keys = ', '.join(group_by + ['']) if group_by else ''
+
+        groups = {}
+
+        def split(row):
+            key = tuple(row[:len(group_by)])
+            if key not in groups:
+                groups[key] = dict(zip(group_by, key), count=0, diagnoses={}, metrics={})
+            return key, row[len(group_by):]
+
+        with closing(self._connect()) as conn:
+            for row in conn.execute(f'''
+                SELECT {keys} diagnosis, SUM(n) FROM cohort_diagnoses WHERE {where}
+                GROUP BY {keys} diagnosis''', params):
+                key, (diagnosis, n) = split(row)
+                groups[key]['diagnoses'][diagnosis] = n
+                groups[key]['count'] += n
+
+            for row in conn.execute(f'''
+                SELECT {keys} metric, SUM(n), SUM(total) FROM cohort_metrics WHERE {where}
+                GROUP BY {keys} metric''', params):
+                key, (metric, n, total) = split(row)
+                groups[key]['metrics'][metric] = {'count': n, 'mean': round(total / n, 2)}
+
+            histograms = {}
+            for row in conn.execute(f'''
+                SELECT {keys} metric, bin, SUM(n) FROM cohort_histograms WHERE {where}
+                GROUP BY {keys} metric, bin''', params):
+                key, (metric, bin_index, n) = split(row)
+                histograms.setdefault((key, metric), {})[bin_index] = n
+
+        for (key, metric), counts in histograms.items():
+            groups[key]['metrics'][metric].update(histogram_percentiles(metric, counts, percentiles))
+
+        return sorted(groups.values(), key=lambda group: [str(group[d]) for d in group_by])
+
+
+def histogram_percentiles(metric, counts, percentiles=DEFAULT_PERCENTILES):
+    """Percentiles interpolated from a {bin: count} histogram of one metric"""
+    low, width, n_bins = METRIC_BINS[metric]
+    histogram = np.zeros(n_bins)
+    for bin_index, count in counts.items():
+        histogram[bin_index] = count
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+
+    result = {}
+    for p in percentiles:
+        target = total * p / 100
+        bin_index = min(int(np.searchsorted(cumulative, target, side='left')), n_bins - 1)
+        before = cumulative[bin_index - 1] if bin_index else 0
+        fraction = (target - before) / histogram[bin_index] if histogram[bin_index] else 0
+        result[f'p{p}'] = round(low + width * (bin_index + fraction), 2)
+    return result
@@ -0,0 +1,275 @@
+"""Content-addressed registry of uploaded lab datasets in a columnar format
+
+A CSV is parsed once and stored as one NumPy .npy file per column under
+<root>/<sha256 of the CSV>/. Numeric columns keep their dtype; text columns
+are dictionary-encoded (int32 codes plus a category list), so reading a
+dataset back is a memory map per column instead of a CSV parse, and a caller
+that needs three columns touches only those three files.
+
+Uploading the same bytes again maps to the same dataset, and results computed
+from a dataset can be remembered under its digest (see recall/remember).
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_ROOT = os.environ.get('DATASET_FOLDER', 'datasets')
+FORMAT = 1
+PARSE_CHUNK_ROWS = 200000
+_HASH_BLOCK = 1 << 20
+
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DigestReader(io.RawIOBase):
+    """Binary stream that hashes what is read through it, as file_digest would
+
+    Once read to the end, hexdigest() identifies the same dataset as the
+    file with those bytes.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._digest = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        block = self._stream.read(len(buffer))
+        buffer[:len(block)] = block
+        self._digest.update(block)
+        return len(block)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+class Dataset:
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.id = meta['id']
+        self.rows = meta['rows']
+        self.columns = [column['name'] for column in meta['columns']]
+        self._specs = {column['name']: column for column in meta['columns']}
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    def column(self, name):
+        """Memory-mapped values of a numeric column, or codes of a text column"""
+        array = self._arrays.get(name)
+        if array is None:
+            spec = self._specs[name]
+            dtype = np.int32 if spec['dtype'] == 'category' else np.dtype(spec['dtype'])
+            if self.rows == 0:
+                array = np.empty(0, dtype=dtype)
+            else:
+                # The offset recorded at conversion skips parsing the .npy header
+                array = np.memmap(os.path.join(self.path, spec['file']), dtype=dtype, mode='r',
+                                  offset=spec['offset'], shape=(self.rows,))
+            with self._lock:
+                array = self._arrays.setdefault(name, array)
+        return array
+
+    def categories(self, name):
+        return self._specs[name].get('categories')
+
+    def frame(self, columns=None):
+        """DataFrame of the selected columns (all by default) without parsing
+
+        Numeric columns wrap the read-only memory maps; text columns become
+        pandas Categoricals over the stored codes.
+        """
+        import pandas as pd
+
+        data = {}
+        for name in columns or self.columns:
+            values = self.column(name)
+            categories = self.categories(name)
+            if categories is not None:
+                categorical = self._arrays.get(('categorical', name))
+                if categorical is None:
+                    categorical = pd.Categorical.from_codes(values, categories)
+                    self._arrays[('categorical', name)] = categorical
+                values = categorical
+            data[name] = values
+        return pd.DataFrame(data, copy=False)
+
+    def describe(self):
+        return {
+            'id': self.id,
+            'names': self.meta['names'],
+            'rows': self.rows,
+            'bytes': self.meta['bytes'],
+            'created_at': self.meta['created_at'],
+            'columns': [{key: column[key] for key in ('name', 'dtype')} for column in self.meta['columns']]
+        }
+
+
+class DatasetStore:
+    def __init__(self, root=DEFAULT_ROOT):
+        self.root = root
+        # Opened datasets keep their memory maps, so reopening one is free
+        self._opened = {}
+
+    def _dataset_path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def get(self, digest):
+        """The stored dataset with this digest, or None"""
+        dataset = self._opened.get(digest)
+        if dataset is not None:
+            return dataset
+        if not digest.isalnum():
+            return None
+        path = self._dataset_path(digest)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                dataset = Dataset(path, json.load(f))
+        except (OSError, ValueError):
+            return None
+        return self._opened.setdefault(digest, dataset)
+
+    def list(self):
+        if not os.path.isdir(self.root):
+            return []
+        found = (self.get(name) for name in sorted(os.listdir(self.root)))
+        return [dataset for dataset in found if dataset is not None]
+
+    def ingest_file(self, path, name=None):
+        """Register a CSV file, returning (dataset, True if it was converted now)"""
+        digest = file_digest(path)
+        dataset = self.get(digest)
+        if dataset is not None:
+            self._add_name(dataset, name)
+            return dataset, False
+        return self._convert(path, digest, name), True
+
+    def ingest_stream(self, stream, name=None):
+        """Register a CSV read from a binary file object (e.g. an upload)"""
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.root, suffix='.csv', delete=False) as f:
+            temp_path = f.name
+            for block in iter(lambda: stream.read(_HASH_BLOCK), b''):
+                digest.update(block)
+                f.write(block)
+        try:
+            dataset = self.get(digest.hexdigest())
+            if dataset is not None:
+                self._add_name(dataset, name)
+                return dataset, False
+            return self._convert(temp_path, digest.hexdigest(), name), True
+        finally:
+            os.remove(temp_path)
+
+    def load_csv(self, path, columns=None):
+        """DataFrame of a CSV file, converted on first use and memory-mapped after"""
+        dataset, _ = self.ingest_file(path, os.path.basename(path))
+        return dataset.frame(columns)
+
+    def _add_name(self, dataset, name):
+        if name and name not in dataset.meta['names']:
+            dataset.meta['names'].append(name)
+            self._write_json(os.path.join(dataset.path, 'meta.json'), dataset.meta)
+
+    def _convert(self, csv_path, digest, name):
+        import pandas as pd
+
+        os.makedirs(self.root, exist_ok=True)
+        work = tempfile.mkdtemp(prefix=f'.{digest[:12]}-', dir=self.root)
+        try:
+            chunks = {}
+            names = None
+            for chunk in pd.read_csv(csv_path, chunksize=PARSE_CHUNK_ROWS):
+                names = names or [str(column) for column in chunk.columns]
+                for column in chunk.columns:
+                    chunks.setdefault(str(column), []).append(chunk[column].to_numpy())
+            if names is None:
+                names = [str(column) for column in pd.read_csv(csv_path, nrows=0).columns]
+
+            specs = []
+            rows = 0
+            for index, column in enumerate(names):
+                parts = chunks.get(column, [])
+                values = np.concatenate(parts) if parts else np.array([], dtype=float)
+                # Column names can be anything, so files are numbered
+                spec = {'name': column, 'file': f'{index:04d}.npy'}
+                if values.dtype == object:
+                    # Mixed or text values: dictionary-encode, blanks become code -1
+                    categorical = pd.Categorical(values)
+                    values = categorical.codes.astype(np.int32)
+                    spec.update(dtype='category', categories=[str(c) for c in categorical.categories])
+                else:
+                    spec['dtype'] = str(values.dtype)
+                column_path = os.path.join(work, spec['file'])
+                np.save(column_path, values, allow_pickle=False)
+                spec['offset'] = os.path.getsize(column_path) - values.nbytes
+                specs.append(spec)
+                rows = len(values)
+
+            meta = {
+                'format': FORMAT,
+                'id': digest,
+                'names': [name] if name else [],
+                'rows': rows,
+                'bytes': os.path.getsize(csv_path),
+                'created_at': time.time(),
+                'columns': specs
+            }
+            self._write_json(os.path.join(work, 'meta.json'), meta)
+            try:
+                os.rename(work, self._dataset_path(digest))
+            except OSError:
+                # Converted concurrently by another process; theirs is identical
+                shutil.rmtree(work, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(work, ignore_errors=True)
+            raise
+        return self.get(digest)
+
+    # --- Results remembered per content digest ---
+
+    def _results_path(self, digest):
+        return os.path.join(self.root, 'results', f'{digest}.json')
+
+    def recall(self, digest, key):
+        """A value remembered for this content and key, or None"""
+        try:
+            with open(self._results_path(digest)) as f:
+                return json.load(f).get(key)
+        except (OSError, ValueError):
+            return None
+
+    def remember(self, digest, key, value):
+        path = self._results_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path) as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            results = {}
+        results[key] = value
+        self._write_json(path, results)
+
+    @staticmethod
+    def _write_json(path, data):
+        temp_path = f"{path}.tmp{os.getpid()}"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
@@ -1,73 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for
-import sqlite3
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response
+from datetime import datetime, time
 import os
+import signal
+import sys
+
+# Share the threshold table and cohort statistics of the main diagnostic app one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+import thresholds
+
+import db
+import export
+
+SCREENING = thresholds.ENGINE.screening
 
 app = Flask(__name__)
 app.secret_key = 'diagnostic_system_secret_key' # Used for flashing messages
 
-# --- Database Initialization ---
-def init_db():
-    """Creates the database and table if they don't exist."""
-    if not os.path.exists('database'):
-        os.makedirs('database')
-    
-    conn = sqlite3.connect('database/patients.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patients (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        age INTEGER NOT NULL,
-        gender TEXT NOT NULL,
-        glucose REAL,
-        systolic_bp REAL,
-        diastolic_bp REAL,
-        cholesterol REAL,
-        diagnosis TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
+# Request and SQLite timings at /metrics; SLOW_REQUEST_MS turns on the slow request profiler
+metrics.install(app, profiler=metrics.profiler_from_env())
 
 # --- Core Logic ---
 def analyze_patient_data(data):
     """Analyzes patient data and returns a dictionary of results."""
     results = []
     
-    # Check glucose level
-    try:
-        glucose = float(data.get('glucose', 0))
-        if glucose > 140:
-            results.append({'parameter': 'Glucose', 'value': glucose, 'status': 'risk', 'message': 'Possible diabetes risk'})
-        else:
-            results.append({'parameter': 'Glucose', 'value': glucose, 'status': 'normal', 'message': 'Normal glucose level'})
-    except (ValueError, TypeError):
-        results.append({'parameter': 'Glucose', 'value': 'N/A', 'status': 'error', 'message': 'Invalid input'})
-
-    # Check blood pressure
-    try:
-        systolic = float(data.get('systolic_bp', 0))
-        diastolic = float(data.get('diastolic_bp', 0))
-        if systolic > 140 or diastolic > 90:
-            results.append({'parameter': 'Blood Pressure', 'value': f"{systolic}/{diastolic}", 'status': 'risk', 'message': 'Possible hypertension'})
-        else:
-            results.append({'parameter': 'Blood Pressure', 'value': f"{systolic}/{diastolic}", 'status': 'normal', 'message': 'Normal blood pressure'})
-    except (ValueError, TypeError):
-        results.append({'parameter': 'Blood Pressure', 'value': 'N/A', 'status': 'error', 'message': 'Invalid input'})
-
-    # Check cholesterol
-    try:
-        cholesterol = float(data.get('cholesterol', 0))
-        if cholesterol > 200:
-            results.append({'parameter': 'Cholesterol', 'value': cholesterol, 'status': 'risk', 'message': 'High cholesterol risk'})
-        else:
-            results.append({'parameter': 'Cholesterol', 'value': cholesterol, 'status': 'normal', 'message': 'Normal cholesterol level'})
-    except (ValueError, TypeError):
-        results.append({'parameter': 'Cholesterol', 'value': 'N/A', 'status': 'error', 'message': 'Invalid input'})
+    # Screening cut-offs come from the shared threshold table
+    for check in SCREENING.values():
+        try:
+            values = {field: float(data.get(field, 0)) for field in check.fields}
+            band = check.band(values)
+            if band is thresholds.MISSING_BAND:
+                raise ValueError('not a number')
+            value = '/'.join(str(values[field]) for field in check.fields) if len(check.fields) > 1 else values[check.fields[0]]
+            results.append({'parameter': check.name, 'value': value, 'status': band['status'], 'message': band['message']})
+        except (ValueError, TypeError):
+            results.append({'parameter': check.name, 'value': 'N/A', 'status': 'error', 'message': 'Invalid input'})
     
     # Overall assessment
     risk_count = sum(1 for r in results if r['status'] == 'risk')
@@ -84,28 +52,6 @@ def analyze_patient_data(data):
         'overall_message': overall_message
     }
 
-def save_patient_data(data, diagnosis):
-    """Saves patient data and diagnosis to the SQLite database."""
-    conn = sqlite3.connect('database/patients.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    INSERT INTO patients (name, age, gender, glucose, systolic_bp, diastolic_bp, cholesterol, diagnosis)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        data.get('name'),
-        data.get('age'),
-        data.get('gender'),
-        data.get('glucose'),
-        data.get('systolic_bp'),
-        data.get('diastolic_bp'),
-        data.get('cholesterol'),
-        diagnosis
-    ))
-    
-    conn.commit()
-    conn.close()
-
 # --- Routes ---
 @app.route('/')
 def index():
@@ -126,7 +72,7 @@ def analyze():
     }
     
     analysis = analyze_patient_data(patient_data)
-    save_patient_data(patient_data, analysis['overall_message'])
+    db.save_patient(patient_data, analysis['overall_message'])
     
     # FIX: Generate the date here in Python and pass it to the template
     current_date = datetime.now().strftime('%B %d, %Y at %I:%M %p')
@@ -138,19 +84,67 @@ def analyze():
 
 @app.route('/history')
 def history():
-    """Shows a history of all patient records."""
-    conn = sqlite3.connect('database/patients.db')
-    conn.row_factory = sqlite3.Row # This allows accessing columns by name
-    cursor = conn.cursor()
+    """Shows a history of all patient records, one page at a time."""
+    per_page = min(max(request.args.get('per_page', default=20, type=int), 1), 100)
+    before = request.args.get('before', type=int)
+    patients = db.recent_patients(per_page, before_id=before)
     
-    cursor.execute('SELECT * FROM patients ORDER BY created_at DESC LIMIT 20')
-    patients = cursor.fetchall()
+    # Cursor of the next (older) page, if there may be one
+    next_before = patients[-1]['id'] if len(patients) == per_page else None
+    
+    return render_template('history.html', patients=patients, next_before=next_before,
+                          per_page=per_page, first_page=before is None)
+
+@app.route('/api/patients/<path:name>/trend')
+def patient_trend(name):
+    """Returns a patient's glucose, BP and cholesterol readings over time."""
+    limit = min(max(request.args.get('limit', default=500, type=int), 1), 5000)
+    try:
+        since = parse_timestamp(request.args.get('since'))
+        until = parse_timestamp(request.args.get('until'), end_of_day=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rows = db.patient_trend(name, since, until, limit)
     
-    conn.close()
+    series = {'created_at': [row['created_at'] for row in rows]}
+    for field in db.TREND_FIELDS:
+        series[field] = [row[field] for row in rows]
+    return jsonify({'name': name, 'points': len(rows), 'series': series})
+
+def parse_timestamp(value, end_of_day=False):
+    """Turns a ?since/?until date or date-time into the text stored in created_at."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date '{value}': use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+    if end_of_day and len(value) == 10:
+        # A bare end date includes the whole day
+        parsed = datetime.combine(parsed.date(), time.max)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+@app.route('/api/patients/export')
+def export_patients():
+    """Streams all stored patients, or those saved in a date range or with
+    given diagnoses, as CSV (default), NDJSON or Parquet."""
+    output_format = request.args.get('format', 'csv').lower()
+    try:
+        export.check_format(output_format)
+        since = parse_timestamp(request.args.get('since'))
+        until = parse_timestamp(request.args.get('until'), end_of_day=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    return render_template('history.html', patients=patients)
+    mimetype, extension, batch_size = export.FORMATS[output_format]
+    batches = db.export_patients(since, until, request.args.getlist('diagnosis'), batch_size)
+    return Response(export.ENCODERS[output_format](db.EXPORT_COLUMNS, batches), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=patients.{extension}'})
 
 # --- Main Execution ---
 if __name__ == '__main__':
-    init_db() # Initialize the database before running the app
-    app.run(debug=True)
\ No newline at end of file
+    # WRITE_BEHIND=1 groups concurrent form submissions into batched transactions
+    db.init_db(use_write_behind=os.environ.get('WRITE_BEHIND') == '1') # Initialize the database before running the app
+    # Exit normally on SIGTERM so queued writes are committed at exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.run(debug=True)
@@ -0,0 +1,353 @@
+"""SQLite persistence for the patient screening app.
+
+Connections are opened once and reused from a small pool instead of per
+request, the database runs in WAL mode so readers never block the writer,
+and saves can optionally go through a write-behind queue that commits many
+form submissions in one transaction.
+"""
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import cohort_stats
+import metrics
+
+DB_PATH = os.environ.get(
+    'PATIENTS_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'patients.db')
+)
+
+# Applied to every new connection. WAL lets reads run alongside a write;
+# synchronous=NORMAL only fsyncs at checkpoints, which is still crash-safe in
+# WAL mode (a power cut can lose the last commits, never corrupt the file).
+PRAGMAS = [
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY'
+]
+
+# Newest-first history pages and per-patient series are range scans of these
+# indexes, so they cost the same however large the table grows
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_patients_created ON patients (created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_patients_name_created ON patients (name, created_at)'
+]
+
+TREND_FIELDS = ['glucose', 'systolic_bp', 'diastolic_bp', 'cholesterol']
+
+PATIENT_COLUMNS = ['name', 'age', 'gender', 'glucose', 'systolic_bp', 'diastolic_bp', 'cholesterol', 'diagnosis']
+EXPORT_COLUMNS = ['id'] + PATIENT_COLUMNS + ['created_at']
+INSERT_PATIENT = f"INSERT INTO patients ({', '.join(PATIENT_COLUMNS)}) VALUES ({', '.join('?' * len(PATIENT_COLUMNS))})"
+
+
+# --- Connections ---
+class ConnectionPool:
+    """Reusable connections to one database file.
+
+    A connection is only ever used by one thread at a time; threads borrow
+    one for the duration of a `with pool.connection()` block.
+    """
+
+    def __init__(self, path, max_idle=8):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+        self._lock = threading.Lock()
+        self._all = []
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, committing on success and rolling back on error."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                self._discard(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            if conn in self._all:
+                self._all.remove(conn)
+        conn.close()
+
+    def close(self):
+        """Close every connection, borrowed or idle."""
+        with self._lock:
+            connections, self._all = self._all, []
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for conn in connections:
+            conn.close()
+
+
+# --- Write-behind ---
+class WriteBehind:
+    """Background writer that batches patient INSERTs into single transactions.
+
+    Rows are committed when `batch_size` rows are pending or the oldest has
+    waited `max_delay` seconds, whichever comes first. A saved row is only
+    durable once flushed: call flush() or close() (also run at exit) before
+    the process ends.
+    """
+
+    def __init__(self, pool, batch_size=100, max_delay=0.05):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='patients-write-behind', daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        self._queue.put(('row', row))
+
+    def flush(self, timeout=None):
+        """Wait until every row queued so far is committed."""
+        done = threading.Event()
+        self._queue.put(('flush', done))
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Commit everything still queued and stop the writer."""
+        if self._thread.is_alive():
+            self._queue.put(('stop', None))
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            kind, item = self._queue.get()
+            rows, waiters, stopping = [], [], False
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if kind == 'row':
+                    rows.append(item)
+                elif kind == 'flush':
+                    waiters.append(item)
+                    break
+                else:
+                    stopping = True
+                    break
+                if len(rows) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    kind, item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if rows:
+                self._write(rows)
+            for waiter in waiters:
+                waiter.set()
+            if stopping:
+                return
+
+    def _write(self, rows):
+        try:
+            with metrics.stage('sqlite_write_batch'), self.pool.connection() as conn:
+                conn.executemany(INSERT_PATIENT, rows)
+            record_cohort(rows)
+            return
+        except sqlite3.IntegrityError:
+            pass
+        except sqlite3.Error as e:
+            print(f"❌ Could not save {len(rows)} patient record(s): {e}")
+            return
+
+        # One invalid row shouldn't cost the rest of the batch
+        saved = []
+        try:
+            with self.pool.connection() as conn:
+                for row in rows:
+                    try:
+                        conn.execute(INSERT_PATIENT, row)
+                        saved.append(row)
+                    except sqlite3.IntegrityError as e:
+                        print(f"❌ Could not save patient record {row[0]!r}: {e}")
+            record_cohort(saved)
+        except sqlite3.Error as e:
+            print(f"❌ Could not save {len(rows)} patient record(s): {e}")
+
+
+# --- Module state ---
+pool = ConnectionPool(DB_PATH)
+write_behind = None
+cohort_store = cohort_stats.CohortStats()
+
+
+def record_cohort(rows):
+    """Adds saved patient rows to the shared cohort statistics."""
+    if not rows:
+        return
+    columns = dict(zip(PATIENT_COLUMNS, zip(*rows)))
+    try:
+        cohort_store.record('hack1', {
+            'age': columns['age'],
+            'sex': columns['gender'],
+            'glucose': columns['glucose'],
+            'systolic_bp': columns['systolic_bp'],
+            'diastolic_bp': columns['diastolic_bp'],
+            'cholesterol': columns['cholesterol'],
+            'diagnosis': columns['diagnosis']
+        })
+    except Exception as e:
+        print(f"⚠️  Could not update cohort statistics: {e}")
+
+
+def init_db(use_write_behind=False, batch_size=100, max_delay=0.05):
+    """Creates the database and table if they don't exist and switches to WAL."""
+    global write_behind
+
+    os.makedirs(os.path.dirname(DB_PATH) or '.', exist_ok=True)
+    with pool.connection() as conn:
+        # journal_mode is stored in the database file, so this sticks
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            glucose REAL,
+            systolic_bp REAL,
+            diastolic_bp REAL,
+            cholesterol REAL,
+            diagnosis TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        for index in INDEXES:
+            conn.execute(index)
+
+    if use_write_behind and write_behind is None:
+        write_behind = WriteBehind(pool, batch_size, max_delay)
+
+
+def save_patient(data, diagnosis):
+    """Saves one patient record, through the write-behind queue when enabled."""
+    row = tuple(data.get(column) for column in PATIENT_COLUMNS[:-1]) + (diagnosis,)
+    if write_behind is not None:
+        write_behind.put(row)
+        return
+    with metrics.stage('sqlite_write'), pool.connection() as conn:
+        conn.execute(INSERT_PATIENT, row)
+    record_cohort([row])
+
+
+def _fetch_rows(sql, params):
+    with metrics.stage('sqlite_read'), pool.connection() as conn:
+        conn.row_factory = sqlite3.Row
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.row_factory = None
+
+
+def recent_patients(limit=20, before_id=None):
+    """Returns a page of patients, newest first.
+
+    Pages are keyed on (created_at, id) rather than OFFSET: pass the id of the
+    last row of a page as `before_id` to get the next, older page.
+    """
+    if before_id is None:
+        return _fetch_rows('SELECT * FROM patients ORDER BY created_at DESC, id DESC LIMIT ?', (limit,))
+    return _fetch_rows('''
+        SELECT * FROM patients
+        WHERE (created_at, id) < (SELECT created_at, id FROM patients WHERE id = ?)
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', (before_id, limit))
+
+
+def patient_trend(name, since=None, until=None, limit=500):
+    """Returns the latest `limit` readings of one patient, oldest first."""
+    conditions = ['name = ?']
+    params = [name]
+    if since:
+        conditions.append('created_at >= ?')
+        params.append(since)
+    if until:
+        conditions.append('created_at <= ?')
+        params.append(until)
+    rows = _fetch_rows(f'''
+        SELECT id, created_at, {', '.join(TREND_FIELDS)} FROM patients
+        WHERE {' AND '.join(conditions)}
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', params + [limit])
+    rows.reverse()
+    return rows
+
+
+def export_patients(since=None, until=None, diagnoses=None, batch_size=1000):
+    """Yields all matching patients as lists of EXPORT_COLUMNS tuples, oldest first.
+
+    The rows are read from one open cursor with fetchmany, so memory use is
+    set by `batch_size` however many rows match. The read keeps the snapshot
+    it started with: rows saved during the export are left for the next one.
+    Date filters go through idx_patients_created; without them the table is
+    read in id order.
+    """
+    conditions = []
+    params = []
+    if since:
+        conditions.append('created_at >= ?')
+        params.append(since)
+    if until:
+        conditions.append('created_at <= ?')
+        params.append(until)
+    if diagnoses:
+        conditions.append(f"diagnosis IN ({', '.join('?' * len(diagnoses))})")
+        params.extend(diagnoses)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'created_at, id' if since or until else 'id'
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM patients {where} ORDER BY {order}"
+
+    with pool.connection() as conn:
+        cursor = conn.execute(sql, params)
+        try:
+            while True:
+                with metrics.stage('sqlite_export'):
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cursor.close()
+
+
+def shutdown():
+    """Commits queued writes and closes all connections."""
+    global write_behind
+    if write_behind is not None:
+        write_behind.close()
+        write_behind = None
+    pool.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,124 @@
+"""Streaming encoders for the bulk patient export.
+
+Each encoder turns the row batches of db.export_patients into chunks of
+bytes for a streamed HTTP response, so only the current batch is ever held
+in memory and the first bytes go out before the whole table is read.
+Parquet needs pyarrow and writes one row group per batch.
+"""
+import csv
+import io
+import json
+
+# Format -> (mimetype, file extension, rows per batch)
+FORMATS = {
+    'csv': ('text/csv', 'csv', 2000),
+    'ndjson': ('application/x-ndjson', 'ndjson', 2000),
+    'parquet': ('application/vnd.apache.parquet', 'parquet', 50000)
+}
+
+# Parquet column types; everything else is a string. created_at stays the
+# text SQLite stores, so it round-trips exactly.
+PARQUET_TYPES = {
+    'id': 'int64',
+    'age': 'int64',
+    'glucose': 'float64',
+    'systolic_bp': 'float64',
+    'diastolic_bp': 'float64',
+    'cholesterol': 'float64'
+}
+
+
+def check_format(name):
+    """Raises ValueError for a format that can't be exported here."""
+    if name not in FORMATS:
+        raise ValueError(f"Unknown format '{name}': use {', '.join(FORMATS)}")
+    if name == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError('Parquet export requires pyarrow (pip install pyarrow)')
+
+
+def csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    # The header goes out before the first rows are read
+    yield buffer.getvalue().encode()
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+
+
+def ndjson_chunks(columns, batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows).encode()
+
+
+class _Sink:
+    """Write-only file that holds what the Parquet writer produced until drained."""
+
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _typed(values, kind):
+    # SQLite keeps whatever a form submitted, so a text age or reading is
+    # exported as null rather than failing the whole file
+    if kind == 'int64':
+        return [value if isinstance(value, int) else None for value in values]
+    if kind == 'float64':
+        return [float(value) if isinstance(value, (int, float)) else None for value in values]
+    return [None if value is None else str(value) for value in values]
+
+
+def parquet_chunks(columns, batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    kinds = [PARQUET_TYPES.get(column, 'string') for column in columns]
+    schema = pa.schema([(column, getattr(pa, kind)()) for column, kind in zip(columns, kinds)])
+    sink = _Sink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        # The magic bytes go out before the first rows are read
+        yield sink.drain()
+        for rows in batches:
+            values = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(_typed(column, kind), type=field.type)
+                 for column, kind, field in zip(values, kinds, schema)],
+                schema=schema))
+            yield sink.drain()
+    # The footer is written on close
+    yield sink.drain()
+
+
+ENCODERS = {
+    'csv': csv_chunks,
+    'ndjson': ndjson_chunks,
+    'parquet': parquet_chunks
+}
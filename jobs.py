@@ -0,0 +1,277 @@
+"""Asynchronous scoring jobs for large CSV uploads
+
+A job scores every row of a CSV file on a pool of worker processes and writes
+one NDJSON line per row (the format of /api/upload_csv?stream=1) to a result
+file. The coordinating thread only reads the input in blocks of whole CSV
+records and writes back finished blocks in order; parsing, scoring and
+serializing happen in the workers, so throughput grows with the number of
+processes while the next blocks are read and earlier ones written.
+
+Workers are started once per model version with the model already loaded
+(`init_worker(model)`), and every block of a job is scored by the model that
+was current when the job started. Publishing a new model (use_version) retires
+the pools of older ones as soon as they have no jobs left.
+
+Job state is a small JSON file next to the results, so any server process
+(e.g. any prefork worker) can report progress and serve partial results.
+"""
+import bisect
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_BLOCK_BYTES = 1 << 20
+
+_QUOTED = re.compile(rb'"[^"]*"')
+# A line with anything but whitespace is a record; pandas skips blank lines
+_RECORD = re.compile(rb'^[ \t\r]*[^\s]', re.M)
+
+
+def split_records(buffer, final=False):
+    """Split `buffer` after its last complete CSV record: (records, rest)
+
+    A newline only ends a record outside quotes, i.e. after an even number of
+    quote characters (escaped quotes are doubled, so they don't change the
+    parity).
+    """
+    if final:
+        return buffer, b''
+    cut = buffer.rfind(b'\n')
+    while cut != -1 and buffer.count(b'"', 0, cut) % 2:
+        cut = buffer.rfind(b'\n', 0, cut)
+    return buffer[:cut + 1], buffer[cut + 1:]
+
+
+def count_records(block):
+    """Number of rows pandas reads from whole CSV records `block`"""
+    if b'"' in block:
+        # Quoted fields may hold newlines; stand one character in for each
+        block = _QUOTED.sub(b'q', block)
+    return len(_RECORD.findall(block))
+
+
+def _init_pool_worker(init_worker, model):
+    init_worker(model)
+
+
+class JobRunner:
+    def __init__(self, folder, init_worker, score_block, workers=None,
+                 block_bytes=DEFAULT_BLOCK_BYTES, start_method='spawn'):
+        """Run scoring jobs, keeping their state and results in `folder`
+
+        init_worker(model)                        loads the model in a new worker process
+        score_block(header, block, first_row)     parses and scores CSV bytes, returning
+                                                  (NDJSON text, rows, rows with errors)
+
+        Both must be importable module-level functions.
+        """
+        self.folder = folder
+        self.init_worker = init_worker
+        self.score_block = score_block
+        self.workers = workers or os.cpu_count() or 1
+        self.block_bytes = block_bytes
+        self.context = multiprocessing.get_context(start_method)
+        self._lock = threading.Lock()
+        self._pools = {}  # model version -> [executor, jobs using it]
+        self._latest_version = None
+
+    # --- Paths and state ---
+
+    def _path(self, job_id, extension):
+        return os.path.join(self.folder, f"{job_id}.{extension}")
+
+    def input_path(self, job_id):
+        return self._path(job_id, 'csv')
+
+    def result_path(self, job_id):
+        return self._path(job_id, 'ndjson')
+
+    def new_job_id(self):
+        os.makedirs(self.folder, exist_ok=True)
+        return uuid.uuid4().hex
+
+    def _save_state(self, state):
+        temp_path = self._path(state['id'], f'json.tmp{os.getpid()}')
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self._path(state['id'], 'json'))
+
+    def load_state(self, job_id):
+        """The job's state dict, or None for an unknown id"""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id, 'json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def public_state(state):
+        """State without the internal block index"""
+        return {key: value for key, value in state.items() if key != 'blocks'}
+
+    def read_results(self, state, offset=0, limit=100):
+        """Up to `limit` finished result rows starting at row `offset`"""
+        blocks = state.get('blocks', [])  # [first row, byte offset] of each written block
+        if offset >= state.get('rows_scored', 0) or not blocks:
+            return []
+        index = bisect.bisect_right([first_row for first_row, _ in blocks], offset) - 1
+        first_row, position = blocks[index]
+        end = min(offset + limit, state['rows_scored'])
+        rows = []
+        with open(self.result_path(state['id']), 'rb') as f:
+            f.seek(position)
+            for row, line in enumerate(f, start=first_row):
+                if row >= end:
+                    break
+                if row >= offset:
+                    rows.append(json.loads(line))
+        return rows
+
+    # --- Worker pools ---
+
+    def _acquire_pool(self, version, model):
+        with self._lock:
+            entry = self._pools.get(version)
+            if entry is None:
+                executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=self.context,
+                    initializer=_init_pool_worker,
+                    initargs=(self.init_worker, model)
+                )
+                entry = self._pools[version] = [executor, 0]
+                print(f"🚀 Started {self.workers} scoring worker(s) for model {version}")
+            self._latest_version = version
+            entry[1] += 1
+            self._retire_pools()
+            return entry[0]
+
+    def _release_pool(self, version):
+        with self._lock:
+            entry = self._pools.get(version)
+            if entry is not None:  # None after shutdown()
+                entry[1] -= 1
+            self._retire_pools()
+
+    def use_version(self, version):
+        """Make `version` the current model's: pools of other versions shut
+        down now if idle, otherwise once their last job is done"""
+        with self._lock:
+            self._latest_version = version
+            self._retire_pools()
+
+    def _retire_pools(self):
+        # Pools of older models go away once their last job is done
+        for version, (executor, users) in list(self._pools.items()):
+            if version != self._latest_version and users == 0:
+                del self._pools[version]
+                executor.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for executor, _ in pools.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    # --- Jobs ---
+
+    def submit(self, job_id, model, version, source=None):
+        """Start scoring the CSV at input_path(job_id) and return the job state"""
+        state = {
+            'id': job_id,
+            'status': 'queued',
+            'source': source,
+            'model_version': version,
+            'created_at': time.time(),
+            'bytes_total': os.path.getsize(self.input_path(job_id)),
+            'bytes_scored': 0,
+            'progress': 0.0,
+            'rows_scored': 0,
+            'errors': 0,
+            'blocks': []
+        }
+        self._save_state(state)
+        threading.Thread(target=self._run, args=(state, model, version),
+                         name=f'scoring-job-{job_id[:8]}', daemon=True).start()
+        return state
+
+    def _run(self, state, model, version):
+        executor = self._acquire_pool(version, model)
+        try:
+            state.update(status='running', started_at=time.time())
+            self._save_state(state)
+            self._score_file(state, executor)
+            state.update(status='done', progress=1.0)
+        except Exception as e:
+            traceback.print_exc()
+            state.update(status='failed', error=str(e))
+        finally:
+            self._release_pool(version)
+            state['finished_at'] = time.time()
+            self._save_state(state)
+            try:
+                os.remove(self.input_path(state['id']))
+            except OSError:
+                pass
+        elapsed = state['finished_at'] - state['started_at'] if 'started_at' in state else 0
+        print(f"📦 Job {state['id']} {state['status']}: {state['rows_scored']} rows in {elapsed:.1f}s")
+
+    def _score_file(self, state, executor):
+        # Keep every worker busy plus one block each queued behind it
+        max_pending = self.workers * 2
+        pending = deque()
+        first_row = 0
+
+        with open(self.input_path(state['id']), 'rb') as source, \
+                open(self.result_path(state['id']), 'wb') as results:
+            header = source.readline()
+
+            def write_next():
+                future, expected_rows = pending.popleft()
+                text, rows, errors, size = future.result()
+                if rows != expected_rows:
+                    raise RuntimeError(f"Block at row {state['rows_scored']} has {rows} rows, "
+                                       f"expected {expected_rows}")
+                state['blocks'].append([state['rows_scored'], results.tell()])
+                results.write(text.encode('utf-8'))
+                results.flush()
+                state['rows_scored'] += rows
+                state['errors'] += errors
+                state['bytes_scored'] += size
+                state['progress'] = round(state['bytes_scored'] / max(state['bytes_total'], 1), 4)
+                self._save_state(state)
+
+            buffer = b''
+            while True:
+                data = source.read(self.block_bytes)
+                buffer += data
+                block, buffer = split_records(buffer, final=not data)
+                if not block:
+                    if not data:
+                        break
+                    continue  # one record longer than a block
+                rows = count_records(block)
+                pending.append((executor.submit(_score, self.score_block, header, block, first_row), rows))
+                first_row += rows
+                while len(pending) >= max_pending:
+                    write_next()
+            while pending:
+                write_next()
+
+            results.write(json.dumps({'summary': {
+                'total_records': state['rows_scored'], 'errors': state['errors']
+            }}).encode('utf-8') + b'\n')
+
+
+def _score(score_block, header, block, first_row):
+    text, rows, errors = score_block(header, block, first_row)
+    return text, rows, errors, len(block)
@@ -0,0 +1,73 @@
+"""Column layout of uploaded lab exports and how it maps onto the diagnostic engine
+
+Lab exports (see uploads.csv) use their own column names and one-letter sex
+codes. The helpers here translate a chunk of such a file into the column
+arrays accepted by AIDiagnosticSystem.analyze_batch.
+"""
+import numpy as np
+
+# Columns of a full lab export, in file order
+UPLOAD_COLUMNS = [
+    'patient_id', 'age', 'sex', 'glucose_mg_dl', 'hb_a1c_percent', 'systolic_bp',
+    'diastolic_bp', 'cholesterol_mg_dl', 'hdl_mg_dl', 'ldl_mg_dl', 'creatinine_mg_dl',
+    'pulse_rate', 'temp_c', 'spO2', 'symptoms', 'diagnosis'
+]
+
+# Engine field -> accepted column names, in order of preference
+FIELD_ALIASES = {
+    'age': ['age'],
+    'gender': ['gender', 'sex'],
+    'glucose': ['glucose', 'glucose_mg_dl'],
+    'systolic_bp': ['systolic_bp'],
+    'diastolic_bp': ['diastolic_bp'],
+    'cholesterol': ['cholesterol', 'cholesterol_mg_dl'],
+    'bmi': ['bmi']
+}
+
+# Recorded diagnosis -> overall risk level used as the model's training label
+# (0 Normal, 1 Moderate, 2 High), matching how the rules grade each finding
+RISK_LEVELS = ['Normal', 'Moderate', 'High']
+DIAGNOSIS_RISK = {
+    'Normal': 0,
+    'Prediabetes': 1,
+    'Borderline Hypertension': 1,
+    'Type 2 Diabetes Mellitus': 2,
+    'Hypertension': 2,
+    'Dyslipidemia': 2,
+    'Type 2 Diabetes + Hypertension': 2,
+    'Type 2 Diabetes + Hypertension + Dyslipidemia': 2
+}
+
+GENDER_CODES = {
+    'M': 'Male', 'm': 'Male', 'male': 'Male', 'Male': 'Male',
+    'F': 'Female', 'f': 'Female', 'female': 'Female', 'Female': 'Female'
+}
+
+
+def find_column(columns, field):
+    """Return the column holding an engine field, or None if the export lacks it"""
+    for name in FIELD_ALIASES[field]:
+        if name in columns:
+            return name
+    return None
+
+
+def frame_to_patients(df):
+    """Convert a DataFrame chunk of a lab export to analyze_batch column arrays
+
+    Metrics the export doesn't carry (e.g. BMI in uploads.csv) are filled with
+    NaN, which the engine treats as "not measured".
+    """
+    size = len(df)
+    patients = {}
+    for field in FIELD_ALIASES:
+        column = find_column(df.columns, field)
+        if field == 'gender':
+            values = df[column].tolist() if column else [None] * size
+            patients[field] = [GENDER_CODES.get(value, value) if isinstance(value, str) else value
+                               for value in values]
+        elif column:
+            patients[field] = df[column].tolist()
+        else:
+            patients[field] = np.full(size, np.nan).tolist()
+    return patients
@@ -0,0 +1,345 @@
+"""Low-overhead request and stage metrics in the Prometheus text format
+
+Counters and histograms live in a process-wide REGISTRY and cost one lock and
+a bisect per observation. install(app) adds request counting and timing to a
+Flask app and serves everything at /metrics. Each process (e.g. each
+prefork worker) keeps its own numbers; Prometheus sums them per instance.
+
+Set SLOW_REQUEST_MS to turn on the sampling profiler: requests still running
+after that many milliseconds get their stack sampled every
+SLOW_REQUEST_SAMPLE_MS, and finished slow requests are reported as folded
+stacks (flame graph input) at /debug/slow_requests.
+"""
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+            lines += self._render_samples(items)
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self, items):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def labels(self, **labels):
+        """The histogram of one label combination, for repeated observations"""
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        return _HistogramChild(self, state)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels):
+        return _Timer(self.labels(**labels))
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {repr(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'lock', 'state')
+
+    def __init__(self, histogram, state):
+        self.buckets = histogram.buckets
+        self.lock = histogram._lock
+        self.state = state
+
+    def observe(self, value):
+        # Index of the first bucket whose upper bound holds the value (le semantics)
+        index = bisect.bisect_left(self.buckets, value)
+        state = self.state
+        with self.lock:
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+
+class _Timer:
+    """Context manager observing its duration into a histogram child"""
+    __slots__ = ('child', 'started')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Gauge(_Metric):
+    """Gauge whose samples are read from a callback at scrape time
+
+    `collect()` returns a list of (labels dict, value) pairs.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, collect):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in self.collect():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, self._key(labels))} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames, collect):
+        return self._register(Gauge(name, documentation, labelnames, collect))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                lines.append(f'# {metric.name} unavailable: {_escape(e)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'diagnostic_stage_seconds', 'Time spent in each processing stage', ['stage'])
+REQUESTS = REGISTRY.counter(
+    'diagnostic_requests_total', 'HTTP requests served', ['method', 'endpoint', 'status'])
+REQUEST_ERRORS = REGISTRY.counter(
+    'diagnostic_request_errors_total', 'HTTP requests answered with a 5xx status', ['method', 'endpoint'])
+REQUEST_SECONDS = REGISTRY.histogram(
+    'diagnostic_request_seconds', 'Time to produce a response', ['method', 'endpoint'])
+
+
+_stage_histograms = {}
+
+
+def stage(name):
+    """Context manager timing one processing stage into STAGE_SECONDS"""
+    child = _stage_histograms.get(name)
+    if child is None:
+        child = _stage_histograms[name] = STAGE_SECONDS.labels(stage=name)
+    return _Timer(child)
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of requests that run longer than a threshold
+
+    A single watcher thread wakes every `interval` seconds and, for each
+    registered request older than `threshold`, records where its thread is.
+    Fast requests are never sampled, so the cost for them is registering and
+    unregistering the thread.
+    """
+
+    def __init__(self, threshold, interval=0.005, max_reports=50):
+        self.threshold = threshold
+        self.interval = interval
+        self.reports = collections.deque(maxlen=max_reports)
+        self._active = {}  # thread id -> [started, samples Counter, description]
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # Threads don't survive fork, so each worker process starts its own
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+            self._thread.start()
+
+    def begin(self, description):
+        self._ensure_started()
+        with self._lock:
+            self._active[threading.get_ident()] = [time.perf_counter(), collections.Counter(), description]
+
+    def end(self):
+        with self._lock:
+            entry = self._active.pop(threading.get_ident(), None)
+        if entry is None:
+            return None
+        started, samples, description = entry
+        duration = time.perf_counter() - started
+        if duration < self.threshold or not samples:
+            return None
+        report = {
+            'request': description,
+            'duration_ms': round(duration * 1000, 1),
+            'samples': sum(samples.values()),
+            'stacks': [{'stack': stack, 'samples': count} for stack, count in samples.most_common(20)]
+        }
+        self.reports.append(report)
+        print(f"🐢 Slow request {description}: {report['duration_ms']} ms, {report['samples']} stack samples")
+        return report
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                slow = {tid: entry[1] for tid, entry in self._active.items() if now - entry[0] >= self.threshold}
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for tid, samples in slow.items():
+                frame = frames.get(tid)
+                if frame is not None:
+                    samples[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame):
+        """Stack as 'outer;...;inner' function names, the folded flame graph format"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+def profiler_from_env():
+    """SlowRequestProfiler configured from SLOW_REQUEST_MS, or None when unset"""
+    threshold_ms = float(os.environ.get('SLOW_REQUEST_MS', 0))
+    if threshold_ms <= 0:
+        return None
+    interval_ms = float(os.environ.get('SLOW_REQUEST_SAMPLE_MS', 5))
+    return SlowRequestProfiler(threshold_ms / 1000, interval_ms / 1000)
+
+
+def install(app, registry=REGISTRY, profiler=None):
+    """Count and time every request of a Flask app and serve /metrics
+
+    Also serves /debug/slow_requests when a profiler is given.
+    """
+    from flask import Response, g, jsonify, request
+
+    def endpoint():
+        # The route pattern, not the path, so label values stay bounded
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        if profiler is not None:
+            profiler.begin(f"{request.method} {request.path}")
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            labels = {'method': request.method, 'endpoint': endpoint()}
+            REQUEST_SECONDS.observe(time.perf_counter() - started, **labels)
+            REQUESTS.inc(status=response.status_code, **labels)
+            if response.status_code >= 500:
+                REQUEST_ERRORS.inc(**labels)
+        return response
+
+    if profiler is not None:
+        @app.teardown_request
+        def finish_profile(exc):
+            profiler.end()
+
+        @app.route('/debug/slow_requests')
+        def slow_requests():
+            return jsonify({'threshold_ms': profiler.threshold * 1000, 'reports': list(profiler.reports)})
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
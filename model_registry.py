@@ -0,0 +1,136 @@
+"""Candidate classifiers for the diagnostic model and their offline evaluation
+
+Every registered model is trained on the same PATIENT_FIELDS features, so any
+of them can be served (MODEL_NAME, `train --model` or the retraining API).
+evaluate() trains each candidate on the same split and measures what matters
+for serving: holdout accuracy, p50/p99 latency of scoring one patient through
+the real request path, batch throughput and the size of the pickled model.
+select() then picks the most accurate candidate within a latency budget.
+"""
+import pickle
+import time
+
+import numpy as np
+
+DEFAULT_MODEL = 'tree-d5'
+
+
+def _tree(max_depth):
+    def create():
+        from sklearn.tree import DecisionTreeClassifier
+        return DecisionTreeClassifier(max_depth=max_depth, random_state=42)
+    return create
+
+
+def _logistic():
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    return make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+
+
+def _gradient_boosting():
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    return HistGradientBoostingClassifier(max_iter=100, random_state=42)
+
+
+# Model name -> (description, factory of an unfitted estimator)
+MODELS = {
+    'tree-d3': ('Decision tree, max depth 3', _tree(3)),
+    'tree-d5': ('Decision tree, max depth 5', _tree(5)),
+    'tree-d8': ('Decision tree, max depth 8', _tree(8)),
+    'tree-d12': ('Decision tree, max depth 12', _tree(12)),
+    'logistic': ('Standardized logistic regression', _logistic),
+    'gradient-boosting': ('Histogram gradient boosting, 100 iterations', _gradient_boosting)
+}
+
+
+def create(name):
+    """Unfitted estimator of a registered model"""
+    if name not in MODELS:
+        raise ValueError(f"Unknown model: {name} (choose from {', '.join(MODELS)})")
+    return MODELS[name][1]()
+
+
+def _percentile_ms(seconds, q):
+    return round(float(np.percentile(seconds, q)) * 1000, 4)
+
+
+def evaluate(names, fit, score_row, X_train, y_train, X_test, y_test, latency_rows=1000, repeat=3):
+    """Train and measure each named model, returning one report row per model
+
+    fit(X, labels, name) -> bundle    trains a model bundle (see app.ModelBundle)
+    score_row(bundle, patient)        scores one patient dict the way a request does
+
+    Latency is measured on the first `latency_rows` holdout patients after a
+    short warm-up; throughput is the best of `repeat` runs of bundle.predict
+    over the whole holdout.
+    """
+    patients = X_test.head(latency_rows).to_dict('records')
+    report = []
+    for name in names:
+        started = time.perf_counter()
+        bundle = fit(X_train, y_train, name)
+        fit_seconds = time.perf_counter() - started
+
+        features = bundle.encode_features(X_test)
+        accuracy = float(np.mean(bundle.predict(features) == y_test))
+
+        batch_seconds = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            bundle.predict(features)
+            batch_seconds.append(time.perf_counter() - started)
+
+        for patient in patients[:20]:
+            score_row(bundle, patient)
+        latencies = []
+        for patient in patients:
+            started = time.perf_counter()
+            score_row(bundle, patient)
+            latencies.append(time.perf_counter() - started)
+
+        report.append({
+            'model': name,
+            'description': MODELS[name][0],
+            'accuracy': round(accuracy, 4),
+            'latency_p50_ms': _percentile_ms(latencies, 50),
+            'latency_p99_ms': _percentile_ms(latencies, 99),
+            'batch_rows_per_second': round(len(features) / max(min(batch_seconds), 1e-9)),
+            'model_bytes': len(pickle.dumps(bundle.model, protocol=pickle.HIGHEST_PROTOCOL)),
+            'fit_seconds': round(fit_seconds, 3)
+        })
+    return report
+
+
+def select(report, latency_budget_ms=None):
+    """The most accurate report row whose p99 latency is within budget, or None
+
+    Ties go to the faster model.
+    """
+    eligible = [row for row in report
+                if latency_budget_ms is None or row['latency_p99_ms'] <= latency_budget_ms]
+    if not eligible:
+        return None
+    return max(eligible, key=lambda row: (row['accuracy'], -row['latency_p99_ms']))
+
+
+def format_report(report):
+    """Plain-text table of a report"""
+    columns = [
+        ('model', 'model', '{}'),
+        ('accuracy', 'accuracy', '{:.4f}'),
+        ('latency_p50_ms', 'p50 ms', '{:.3f}'),
+        ('latency_p99_ms', 'p99 ms', '{:.3f}'),
+        ('batch_rows_per_second', 'batch rows/s', '{:,}'),
+        ('model_bytes', 'model bytes', '{:,}'),
+        ('fit_seconds', 'fit s', '{:.2f}')
+    ]
+    cells = [[title for _, title, _ in columns]]
+    cells += [[fmt.format(row[key]) for key, _, fmt in columns] for row in report]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    lines = ['  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                       for i, (cell, width) in enumerate(zip(line, widths)))
+             for line in cells]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
@@ -0,0 +1,101 @@
+"""Versioned on-disk artifact for the trained diagnostic model
+
+An artifact is a single file: one line of JSON header followed by the pickled
+model. The header records the format version, the model version, the gender
+classes of the LabelEncoder and a SHA-256 checksum of the payload, so a
+truncated or corrupted file is rejected before it is unpickled. The checksum
+is stored in the same file, so it is no defence against deliberate
+tampering: unpickling runs code, so only load artifacts from trusted paths.
+"""
+import hashlib
+import json
+import os
+import pickle
+from datetime import datetime, timezone
+
+ARTIFACT_FORMAT = 1
+DEFAULT_MODEL_PATH = os.environ.get('MODEL_PATH', os.path.join('models', 'diagnostic_model.bin'))
+
+
+class ModelArtifactError(Exception):
+    """Raised when a model artifact is missing, corrupt or of an unknown format"""
+
+
+def model_version(model, created_at=None):
+    """Version string for a model: creation time plus a short checksum of its pickle"""
+    payload = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    created_at = created_at or datetime.now(timezone.utc)
+    return f"{created_at:%Y%m%d%H%M%S}-{hashlib.sha256(payload).hexdigest()[:8]}"
+
+
+def save_model(path, model, gender_classes, metadata=None):
+    """Write the model and encoder classes to `path` atomically and return the header
+
+    A 'model_version' already present in metadata is kept, so a model keeps the
+    version it was served under before being saved.
+    """
+    payload = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    checksum = hashlib.sha256(payload).hexdigest()
+    created_at = datetime.now(timezone.utc)
+
+    header = dict(metadata or {})
+    header.setdefault('model_version', f"{created_at:%Y%m%d%H%M%S}-{checksum[:8]}")
+    header.update({
+        'format': ARTIFACT_FORMAT,
+        'created_at': created_at.isoformat(),
+        'model_class': type(model).__name__,
+        'gender_classes': [str(c) for c in gender_classes],
+        'sha256': checksum,
+        'payload_bytes': len(payload)
+    })
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    # Write next to the target and rename so readers never see a partial file
+    temp_path = f"{path}.tmp{os.getpid()}"
+    with open(temp_path, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return header
+
+
+def read_header(path):
+    """Read only the JSON header of an artifact"""
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        raise ModelArtifactError(f"Cannot read model artifact {path}: {e}")
+    if not isinstance(header, dict):
+        raise ModelArtifactError(f"Invalid header in model artifact {path}")
+    return header
+
+
+def load_model(path):
+    """Load an artifact, returning (model, gender_classes, header)"""
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            payload = f.read()
+    except (OSError, ValueError) as e:
+        raise ModelArtifactError(f"Cannot read model artifact {path}: {e}")
+
+    if not isinstance(header, dict):
+        raise ModelArtifactError(f"Invalid header in model artifact {path}")
+    if header.get('format') != ARTIFACT_FORMAT:
+        raise ModelArtifactError(f"Unsupported model artifact format: {header.get('format')}")
+    if len(payload) != header.get('payload_bytes') or hashlib.sha256(payload).hexdigest() != header.get('sha256'):
+        raise ModelArtifactError(f"Checksum mismatch in model artifact {path}")
+
+    try:
+        model = pickle.loads(payload)
+        gender_classes = header['gender_classes']
+    except Exception as e:
+        # e.g. a model class that no longer exists in this code
+        raise ModelArtifactError(f"Cannot load model artifact {path}: {e}")
+    return model, gender_classes, header
@@ -0,0 +1,284 @@
+"""Pre-forking WSGI server for production serving
+
+The master process loads everything once (the caller prepares the model
+before calling run), binds the listening socket and forks workers that all
+accept from it. Workers inherit the loaded model copy-on-write instead of
+each training or loading their own copy, so adding workers costs neither
+model memory nor startup time.
+
+Signals to the master:
+    SIGTERM / SIGINT  graceful shutdown: workers finish in-flight requests
+    SIGHUP            rolling restart of all workers
+Workers are also recycled after serving max_requests requests.
+"""
+import gc
+import json
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib.request
+
+from werkzeug.serving import make_server
+
+
+class PreforkServer:
+    def __init__(self, app, host='0.0.0.0', port=5000, workers=None, threads=True,
+                 max_requests=0, max_requests_jitter=0, graceful_timeout=30,
+                 readiness_path='/health', ready_file=None, backlog=2048):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.readiness_path = readiness_path
+        self.ready_file = ready_file
+        self.backlog = backlog
+
+        self.socket = None
+        self.children = {}  # pid -> worker slot
+        self.stopping = False
+        self.reload_requested = False
+
+    # --- Master ---
+
+    def run(self):
+        """Bind, fork the workers and supervise them until shut down"""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+        self.socket.set_inheritable(True)
+
+        # Move everything loaded so far out of the garbage collector's reach, so
+        # collections in the workers don't touch (and un-share) those pages
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+        print(f"🚀 Master {os.getpid()} listening on {self.host}:{self.port} with {self.workers} workers")
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        if self._wait_until_ready():
+            print("✅ All workers ready")
+            if self.ready_file:
+                with open(self.ready_file, 'w') as f:
+                    f.write(str(os.getpid()))
+        else:
+            print("⚠️  Readiness check failed; workers keep running")
+
+        try:
+            self._supervise()
+        finally:
+            self._shutdown()
+        return 0
+
+    def _spawn(self, slot):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                code = self._worker_main(write_fd)
+            except BaseException as e:
+                print(f"❌ Worker {os.getpid()} crashed: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            os._exit(code)
+
+        os.close(write_fd)
+        self.children[pid] = {'slot': slot, 'started_fd': read_fd, 'started_at': time.time()}
+        return pid
+
+    def _wait_until_ready(self, timeout=30):
+        """Wait for every worker to start serving, then check the readiness endpoint"""
+        deadline = time.time() + timeout
+        pending = {info['started_fd'] for info in self.children.values()}
+        while pending and time.time() < deadline:
+            readable, _, _ = select.select(list(pending), [], [], 0.5)
+            for fd in readable:
+                os.read(fd, 1)
+                pending.discard(fd)
+        if pending:
+            return False
+
+        host = '127.0.0.1' if self.host in ('0.0.0.0', '') else self.host
+        url = f"http://{host}:{self.port}{self.readiness_path}"
+        while time.time() < deadline:
+            try:
+                with urllib.request.urlopen(url, timeout=2) as response:
+                    body = json.loads(response.read() or b'{}')
+                    if response.status == 200 and body.get('ready', True):
+                        return True
+            except (OSError, ValueError):
+                pass
+            time.sleep(0.2)
+        return False
+
+    def _supervise(self):
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self._rolling_restart()
+
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid and pid in self.children:
+                info = self._forget(pid)
+                if not self.stopping:
+                    reason = 'recycled' if os.waitstatus_to_exitcode(status) == 0 else 'died'
+                    print(f"🔄 Worker {pid} {reason}, starting a replacement")
+                    self._spawn(info['slot'])
+                continue
+            time.sleep(0.1)
+
+    def _rolling_restart(self):
+        print("🔄 Restarting workers")
+        for pid in list(self.children):
+            slot = self.children[pid]['slot']
+            self._spawn(slot)
+            self._stop_worker(pid)
+
+    def _stop_worker(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.time() + self.graceful_timeout
+        while time.time() < deadline:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                self._forget(pid)
+                return
+            time.sleep(0.05)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self._forget(pid)
+
+    def _forget(self, pid):
+        info = self.children.pop(pid)
+        try:
+            os.close(info['started_fd'])
+        except OSError:
+            pass
+        return info
+
+    def _shutdown(self):
+        print("🛑 Shutting down workers")
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self._forget(pid)
+            else:
+                time.sleep(0.05)
+
+        for pid in list(self.children):
+            print(f"⚠️  Worker {pid} did not stop in time, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self._forget(pid)
+
+        self.socket.close()
+        if self.ready_file and os.path.exists(self.ready_file):
+            os.remove(self.ready_file)
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    # --- Worker ---
+
+    def _worker_main(self, started_fd):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        random.seed()
+
+        limit = 0
+        if self.max_requests:
+            limit = self.max_requests + random.randint(0, self.max_requests_jitter)
+
+        tracker = _RequestTracker(self.app, limit)
+        server = make_server(self.host, self.port, tracker, threaded=self.threads,
+                             fd=self.socket.fileno())
+        tracker.on_limit = lambda: threading.Thread(target=server.shutdown, daemon=True).start()
+
+        def handle_term(signum, frame):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, handle_term)
+
+        os.write(started_fd, b'1')
+        os.close(started_fd)
+
+        server.serve_forever()
+        # Let in-flight requests finish before exiting
+        tracker.wait_idle(self.graceful_timeout)
+        return 0
+
+
+class _RequestTracker:
+    """WSGI middleware counting served and in-flight requests of one worker"""
+
+    def __init__(self, app, limit=0):
+        self.app = app
+        self.limit = limit
+        self.on_limit = None
+        self.served = 0
+        self.in_flight = 0
+        self._idle = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._idle:
+            self.in_flight += 1
+        iterable = None
+        try:
+            iterable = self.app(environ, start_response)
+            yield from iterable
+        finally:
+            # yield from only closes the app's iterable if this one is closed
+            # early; WSGI requires it always, e.g. for Response.call_on_close
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            with self._idle:
+                self.in_flight -= 1
+                self.served += 1
+                reached_limit = self.limit and self.served == self.limit
+                self._idle.notify_all()
+            if reached_limit and self.on_limit:
+                self.on_limit()
+
+    def wait_idle(self, timeout):
+        with self._idle:
+            self._idle.wait_for(lambda: self.in_flight == 0, timeout)
@@ -0,0 +1,125 @@
+"""Compact and content-negotiated encodings of analysis responses
+
+Most of an /api/analyze response is text that only changes with the
+threshold table or the model: the rule result (conditions, risk level and
+recommendations) of each combination of findings, the chart's metric names
+and normal ranges, and the explanation of each tree leaf. A
+ResponseDictionary numbers those parts once. Compact responses carry the
+numbers instead of the text, plus the dictionary's version, and clients
+fetch the dictionary itself once per version.
+
+respond() serializes a payload as JSON or, for clients that prefer it,
+MessagePack, and gzips larger bodies for clients that accept it. Without
+either request header the body is exactly what jsonify would return.
+
+msgpack is an optional dependency, not listed in requirements.txt; without
+it every client gets JSON whatever it prefers.
+"""
+import gzip
+import hashlib
+import json
+
+from flask import current_app, request
+
+try:
+    import msgpack
+except ImportError:  # optional: without it every client gets JSON
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ['application/msgpack', 'application/x-msgpack']
+
+# Bodies smaller than this aren't worth the CPU of compressing
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+
+
+class ResponseDictionary:
+    """Static parts of analysis results, numbered for compact responses
+
+    `rule_results` is the list of precomputed rule results the analysis
+    returns (shared objects, so a result is found by identity), and
+    `explanations` the leaf explanations of the served model, if any.
+    """
+
+    def __init__(self, rule_results, chart_metrics, chart_normal_ranges, explanations=None, model_version=None):
+        self.rule_results = rule_results
+        self.chart_metrics = chart_metrics
+        self.explanations = explanations
+        self.model_version = model_version
+        self._rule_ids = {id(result): i for i, result in enumerate(rule_results)}
+        self._explanation_ids = {id(explanation): i for i, explanation in enumerate(explanations or [])}
+
+        # Many finding combinations share a list of recommendations
+        bundles = {}
+        rules = []
+        for result in rule_results:
+            bundle = bundles.setdefault(tuple(result['recommendations']), len(bundles))
+            rules.append(dict(result, recommendations=bundle))
+        self.payload = {
+            'rule_results': rules,
+            'recommendation_bundles': [list(bundle) for bundle in bundles],
+            'chart': {'metrics': chart_metrics, 'normal_ranges': chart_normal_ranges},
+            'explanations': explanations or [],
+            'model_version': model_version
+        }
+        digest = hashlib.sha256(json.dumps(self.payload, sort_keys=True).encode())
+        self.version = digest.hexdigest()[:16]
+        self.payload['version'] = self.version
+
+    def compact(self, result):
+        """Compact form of one analysis result
+
+        Parts that aren't in this dictionary (e.g. an explanation of a model
+        published after it was built) are sent in full under their usual key.
+        """
+        if 'error' in result:
+            return result
+        compact = {'model_version': result['model_version']}
+
+        rule_id = self._rule_ids.get(id(result['rule_results']))
+        if rule_id is None:
+            compact['rule_results'] = result['rule_results']
+        else:
+            compact['rule_result'] = rule_id
+
+        ml_results = result['ml_results']
+        explanation = ml_results.get('explanation')
+        if explanation is not None:
+            ml_results = dict(ml_results)
+            explanation_id = self._explanation_ids.get(id(explanation))
+            if explanation_id is not None:
+                del ml_results['explanation']
+                ml_results['explanation_id'] = explanation_id
+        compact['ml_results'] = ml_results
+
+        visualization = result['visualization']
+        if visualization['metrics'] is self.chart_metrics:
+            compact['chart_values'] = visualization['values']
+            compact['chart_colors'] = visualization['colors']
+        else:
+            compact['visualization'] = visualization
+        return compact
+
+
+def _accepts_msgpack():
+    if msgpack is None:
+        return False
+    # JSON wins ties, so only clients that prefer MessagePack get it
+    return request.accept_mimetypes.best_match([JSON_MIMETYPE] + MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES
+
+
+def respond(payload, status=200):
+    """Response for `payload` in the encoding the request negotiated"""
+    if _accepts_msgpack():
+        response = current_app.response_class(msgpack.packb(payload, use_bin_type=True),
+                                              status=status, mimetype=MSGPACK_MIMETYPES[0])
+    else:
+        response = current_app.json.response(payload)
+        response.status_code = status
+    response.vary.update(('Accept', 'Accept-Encoding'))
+
+    if request.accept_encodings['gzip'] and response.content_length >= GZIP_MIN_BYTES:
+        response.set_data(gzip.compress(response.get_data(), GZIP_LEVEL, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
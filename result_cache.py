@@ -0,0 +1,122 @@
+"""Bounded LRU cache of analysis results for repeated lab panels
+
+Retries, page refreshes and several clinicians opening the same patient send
+identical panels. Results are keyed by the panel's feature values (in a fixed
+field order, ignoring unrelated fields) plus the version of the model that
+produced them, so a hit returns exactly what a fresh analysis would. Entries
+expire after `ttl` seconds and the least recently used entry is dropped when
+the cache is full.
+
+Cached results are shared between callers and must be treated as read-only.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 300
+
+# Stands in for an absent field; distinct from None, which a client may send
+_MISSING = ('missing',)
+_NAN = ('nan',)
+
+
+def _canonical(value):
+    """Hashable form of one field value, or raise TypeError if it can't be keyed
+
+    The type is kept with the value: 100 and 100.0 (or True and 1) compare
+    equal in Python but are echoed differently in the response.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (bool, int, float)):
+        if isinstance(value, float) and math.isnan(value):
+            return _NAN
+        return (type(value).__name__, value)
+    raise TypeError(f"Cannot cache a value of type {type(value).__name__}")
+
+
+def panel_key(patient, fields, model_version):
+    """Cache key of a patient panel scored by `model_version`, or None if not cacheable"""
+    if not isinstance(patient, dict):
+        return None
+    try:
+        return (model_version,) + tuple(_canonical(patient[field]) if field in patient else _MISSING
+                                        for field in fields)
+    except TypeError:
+        return None
+
+
+class ResultCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        """`max_entries` of 0 disables the cache; `ttl` is in seconds (0 never expires)"""
+        if max_entries < 0:
+            raise ValueError('max_entries must not be negative')
+        if ttl < 0:
+            raise ValueError('ttl must not be negative')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        """The cached result for `key`, or None"""
+        if key is None or not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            expires_at, result = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return result
+
+    def put(self, key, result):
+        if key is None or not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        """Drop every entry, e.g. when a new model is published"""
+        with self._lock:
+            self._entries.clear()
+            self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / lookups, 4) if lookups else None,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations
+            }
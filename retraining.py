@@ -0,0 +1,180 @@
+"""Background retraining with holdout validation before a model is published
+
+A RetrainingJob trains on a labelled dataset in a background thread while
+requests keep being served by the current model. The candidate is scored on
+a holdout split, compared with the current model on the same rows and only
+published (saved, then swapped in) if it is good enough.
+"""
+import threading
+import time
+import traceback
+
+import numpy as np
+
+import lab_schema
+
+# Values used for features a dataset doesn't record (e.g. BMI in uploads.csv).
+# A constant column carries no information, so the tree simply won't split on it.
+FEATURE_DEFAULTS = {'bmi': 25.0}
+
+
+def load_labelled_csv(path, fields, read=None):
+    """Load a labelled lab export as (features DataFrame, labels, info)
+
+    `read(path)` returns the file as a DataFrame (pandas.read_csv by default;
+    see datasets.DatasetStore.load_csv to skip the parse on reuse).
+    """
+    if read is None:
+        import pandas as pd
+        read = pd.read_csv
+    return labelled_frame(read(path), fields, str(path))
+
+
+def labelled_frame(df, fields, source):
+    """Features, labels and info of a lab export DataFrame
+
+    Labels come from a 'risk_level' column (Normal/Moderate/High) when
+    present, otherwise from the recorded diagnosis via lab_schema.DIAGNOSIS_RISK.
+    """
+    import pandas as pd
+
+    patients = lab_schema.frame_to_patients(df)
+    X = pd.DataFrame({field: patients[field] for field in fields})
+
+    imputed = []
+    for field, default in FEATURE_DEFAULTS.items():
+        if lab_schema.find_column(df.columns, field) is None:
+            X[field] = default
+            imputed.append(field)
+
+    if 'risk_level' in df.columns:
+        labels = df['risk_level'].astype(object).map({name: i for i, name in enumerate(lab_schema.RISK_LEVELS)})
+        unknown = df.loc[labels.isna(), 'risk_level']
+    elif 'diagnosis' in df.columns:
+        labels = df['diagnosis'].astype(object).map(lab_schema.DIAGNOSIS_RISK)
+        unknown = df.loc[labels.isna(), 'diagnosis']
+    else:
+        raise ValueError(f"{source} has no 'risk_level' or 'diagnosis' column to learn from")
+    if len(unknown):
+        raise ValueError(f"Unknown labels in {source}: {', '.join(sorted(map(str, unknown.unique())))}")
+
+    # Rows with unmeasured features can't be used for training
+    complete = X.notna().all(axis=1).to_numpy()
+    info = {
+        'training_data': source,
+        'imputed_features': imputed,
+        'dropped_rows': int((~complete).sum())
+    }
+    return X[complete].reset_index(drop=True), labels.to_numpy(dtype=int)[complete], info
+
+
+def split_holdout(size, holdout_fraction, seed):
+    """Shuffle row indices into (train, holdout)"""
+    if not 0 < holdout_fraction < 1:
+        raise ValueError('holdout_fraction must be between 0 and 1')
+    order = np.random.default_rng(seed).permutation(size)
+    n_holdout = max(1, int(round(size * holdout_fraction)))
+    return order[n_holdout:], order[:n_holdout]
+
+
+def holdout_accuracy(bundle, X, labels):
+    """Fraction of rows a model bundle labels correctly"""
+    return float(np.mean(bundle.predict(bundle.encode_features(X)) == labels))
+
+
+class RetrainingJob:
+    def __init__(self, fit, get_current, publish, save=None):
+        """
+        fit(X, labels, metadata) -> bundle   trains a candidate without publishing it
+        get_current() -> bundle or None      the model currently served
+        publish(bundle)                      atomically makes a bundle the active model
+        save(bundle) -> bool                 optionally persists a bundle before publishing
+        """
+        self.fit = fit
+        self.get_current = get_current
+        self.publish = publish
+        self.save = save
+        self._lock = threading.Lock()
+        self._thread = None
+        self._status = {'state': 'idle'}
+
+    def status(self):
+        with self._lock:
+            return dict(self._status)
+
+    def start(self, load_data, holdout_fraction=0.2, min_accuracy=0.8,
+              max_regression=0.0, seed=42):
+        """Start retraining in the background; returns False if a job is already running
+
+        `load_data()` returns (X, labels, info). The candidate is published only
+        if its holdout accuracy is at least `min_accuracy` and no more than
+        `max_regression` below the current model's accuracy on the same rows.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._status = {'state': 'running', 'started_at': time.time()}
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(load_data, holdout_fraction, min_accuracy, max_regression, seed),
+                name='model-retraining',
+                daemon=True
+            )
+            self._thread.start()
+        return True
+
+    def join(self, timeout=None):
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _update(self, **fields):
+        with self._lock:
+            self._status.update(fields)
+
+    def _run(self, load_data, holdout_fraction, min_accuracy, max_regression, seed):
+        try:
+            X, labels, info = load_data()
+            train_rows, holdout_rows = split_holdout(len(X), holdout_fraction, seed)
+            X_train, X_holdout = X.iloc[train_rows], X.iloc[holdout_rows]
+
+            metadata = dict(info, holdout_fraction=holdout_fraction, seed=seed)
+            candidate = self.fit(X_train, labels[train_rows], metadata)
+            accuracy = holdout_accuracy(candidate, X_holdout, labels[holdout_rows])
+            candidate.metadata['holdout_accuracy'] = round(accuracy, 4)
+
+            current = self.get_current()
+            baseline = None
+            if current is not None:
+                try:
+                    baseline = holdout_accuracy(current, X_holdout, labels[holdout_rows])
+                except Exception:
+                    # e.g. the current encoder doesn't know a gender in this data
+                    baseline = None
+
+            self._update(
+                candidate_version=candidate.version,
+                holdout_rows=len(holdout_rows),
+                accuracy=round(accuracy, 4),
+                baseline_accuracy=None if baseline is None else round(baseline, 4)
+            )
+
+            if accuracy < min_accuracy:
+                self._finish('rejected', f"Holdout accuracy {accuracy:.3f} is below the minimum {min_accuracy:.3f}")
+                return
+            if baseline is not None and accuracy < baseline - max_regression:
+                self._finish('rejected', f"Holdout accuracy {accuracy:.3f} is worse than the current model's {baseline:.3f}")
+                return
+
+            if self.save is not None and not self.save(candidate):
+                self._finish('failed', 'Could not save the new model artifact')
+                return
+            self.publish(candidate)
+            self._finish('published', f"Model {candidate.version} published", version=candidate.version)
+        except Exception as e:
+            traceback.print_exc()
+            self._finish('failed', str(e))
+
+    def _finish(self, state, message, **fields):
+        print(f"🔁 Retraining {state}: {message}")
+        self._update(state=state, message=message, finished_at=time.time(), **fields)
@@ -0,0 +1,224 @@
+"""Nearest-neighbour lookup of past patients with a similar lab profile
+
+Each SimilarityIndex keeps a KD-tree over z-score normalized lab values
+(FEATURES) plus a small buffer of records added since the tree was built.
+A query searches the tree and scans the buffer, so new records are findable
+immediately; once the buffer reaches `max_pending` rows the tree is rebuilt
+over everything in a background thread and swapped in.
+
+Distances are Euclidean in standard deviations over the features both the
+query and the source record, with a separate tree per such feature set:
+a panel of glucose, BP and cholesterol isn't pulled towards records with
+average HbA1c or HDL. An individual record's unmeasured value counts as the
+cohort average. The same record uploaded twice is reported once.
+"""
+import threading
+import warnings
+
+import numpy as np
+
+import lab_schema
+
+# Feature -> accepted column names, in order of preference
+FEATURE_ALIASES = {
+    'glucose': lab_schema.FIELD_ALIASES['glucose'],
+    'hba1c': ['hba1c', 'hb_a1c_percent'],
+    'systolic_bp': lab_schema.FIELD_ALIASES['systolic_bp'],
+    'diastolic_bp': lab_schema.FIELD_ALIASES['diastolic_bp'],
+    'cholesterol': lab_schema.FIELD_ALIASES['cholesterol'],
+    'hdl': ['hdl', 'hdl_mg_dl'],
+    'ldl': ['ldl', 'ldl_mg_dl'],
+    'creatinine': ['creatinine', 'creatinine_mg_dl'],
+    'bmi': lab_schema.FIELD_ALIASES['bmi']
+}
+FEATURES = list(FEATURE_ALIASES)
+
+DEFAULT_MAX_PENDING = 20000
+DEFAULT_LEAF_SIZE = 40
+# Trees kept per snapshot for different query feature sets (the full set is always kept)
+MAX_TREES = 8
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def feature_matrix(columns, size):
+    """(size, len(FEATURES)) float matrix from a mapping of column name -> values
+
+    Works with DataFrames and dicts of lists; absent or non-numeric values are NaN.
+    """
+    matrix = np.full((size, len(FEATURES)), np.nan)
+    for j, feature in enumerate(FEATURES):
+        name = next((alias for alias in FEATURE_ALIASES[feature] if alias in columns), None)
+        if name is None:
+            continue
+        try:
+            matrix[:, j] = np.asarray(columns[name], dtype=float)
+        except (TypeError, ValueError):
+            matrix[:, j] = [_to_float(value) for value in columns[name]]
+    return matrix
+
+
+def patient_vector(patient):
+    """Feature vector of one patient dict (engine or lab export field names)"""
+    return feature_matrix({key: [value] for key, value in patient.items()}, 1)[0]
+
+
+class _Snapshot:
+    """Immutable records, the scaling they were normalized with and their KD-trees"""
+
+    def __init__(self, raw, ids, diagnoses, leaf_size):
+        self.raw = raw
+        self.ids = ids
+        self.diagnoses = diagnoses
+        self.leaf_size = leaf_size
+        with warnings.catch_warnings():
+            # Features a source never records are all NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(raw, axis=0)
+            scale = np.nanstd(raw, axis=0)
+        self.mean = np.where(np.isfinite(mean), mean, 0.0)
+        self.scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+        # Features recorded for at least one record
+        self.recorded = np.isfinite(mean)
+        self.scaled = self.normalize(raw)
+        self._trees = {}
+        self._lock = threading.Lock()
+        if len(raw):
+            self.tree(tuple(np.flatnonzero(self.recorded).tolist()))
+
+    def normalize(self, raw):
+        scaled = (raw - self.mean) / self.scale
+        scaled[np.isnan(scaled)] = 0.0
+        return scaled
+
+    def tree(self, columns):
+        """KD-tree over the given feature columns, built on first use"""
+        from sklearn.neighbors import KDTree
+
+        with self._lock:
+            tree = self._trees.get(columns)
+            if tree is None:
+                if len(self._trees) >= MAX_TREES:
+                    # Drop the oldest tree but the first (full feature set) one
+                    del self._trees[list(self._trees)[1]]
+                tree = KDTree(np.ascontiguousarray(self.scaled[:, columns]), leaf_size=self.leaf_size)
+                self._trees[columns] = tree
+            return tree
+
+
+class SimilarityIndex:
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING, leaf_size=DEFAULT_LEAF_SIZE):
+        self.max_pending = max_pending
+        self.leaf_size = leaf_size
+        self._lock = threading.Lock()
+        self._snapshot = self._empty_snapshot()
+        self._pending = []  # (raw matrix, ids, diagnoses) batches not in the tree yet
+        self._pending_view = None  # the batches concatenated and normalized, built on demand
+        self._rebuilding = False
+
+    def _empty_snapshot(self):
+        return _Snapshot(np.empty((0, len(FEATURES))), np.empty(0, dtype=object),
+                         np.empty(0, dtype=object), self.leaf_size)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._snapshot.raw) + sum(len(batch[1]) for batch in self._pending)
+
+    def build(self, raw, ids, diagnoses):
+        """Replace the whole index with these records"""
+        snapshot = _Snapshot(np.asarray(raw, dtype=float), np.asarray(ids, dtype=object),
+                             np.asarray(diagnoses, dtype=object), self.leaf_size)
+        with self._lock:
+            self._snapshot = snapshot
+            self._pending = []
+            self._pending_view = None
+
+    def add(self, raw, ids, diagnoses):
+        """Make new records searchable right away; the tree catches up in the background"""
+        if len(ids) == 0:
+            return
+        batch = (np.asarray(raw, dtype=float), np.asarray(ids, dtype=object), np.asarray(diagnoses, dtype=object))
+        with self._lock:
+            self._pending.append(batch)
+            self._pending_view = None
+            pending_rows = sum(len(b[1]) for b in self._pending)
+            if pending_rows < self.max_pending or self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild, name='similarity-rebuild', daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            with self._lock:
+                snapshot, merged = self._snapshot, len(self._pending)
+                batches = [(snapshot.raw, snapshot.ids, snapshot.diagnoses)] + self._pending[:merged]
+            rebuilt = _Snapshot(*(np.concatenate(parts) for parts in zip(*batches)), leaf_size=self.leaf_size)
+            with self._lock:
+                self._snapshot = rebuilt
+                # Batches added while building stay pending
+                self._pending = self._pending[merged:]
+                self._pending_view = None
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def _pending_arrays(self, snapshot):
+        with self._lock:
+            view = self._pending_view
+            if view is None or view[0] is not snapshot:
+                if self._pending:
+                    raw, ids, diagnoses = (np.concatenate(parts) for parts in zip(*self._pending))
+                else:
+                    raw = np.empty((0, len(FEATURES)))
+                    ids = diagnoses = np.empty(0, dtype=object)
+                view = self._pending_view = (snapshot, snapshot.normalize(raw), raw, ids, diagnoses)
+            return view[1:]
+
+    def query(self, patient, k=5):
+        """The k records closest to a patient dict, nearest first"""
+        with self._lock:
+            snapshot = self._snapshot
+        vector = patient_vector(patient)
+        scaled, raw, ids, diagnoses = self._pending_arrays(snapshot)
+        recorded = snapshot.recorded | (~np.isnan(raw).all(axis=0) if len(raw) else False)
+        columns = tuple(np.flatnonzero(~np.isnan(vector) & recorded).tolist())
+        if not columns:
+            return []
+        point = snapshot.normalize(vector[None, :])[:, columns]
+        # Extra candidates make up for duplicates dropped below
+        wanted = 2 * k
+
+        candidates = []  # (distance, raw row, id, diagnosis)
+        if len(snapshot.raw):
+            distances, rows = snapshot.tree(columns).query(point, k=min(wanted, len(snapshot.raw)))
+            candidates += [(d, snapshot.raw[i], snapshot.ids[i], snapshot.diagnoses[i])
+                           for d, i in zip(distances[0].tolist(), rows[0].tolist())]
+        if len(ids):
+            # The pending buffer is small, so a vectorized scan is cheaper than a tree
+            distances = np.sqrt(((scaled[:, columns] - point) ** 2).sum(axis=1))
+            nearest = (np.argpartition(distances, wanted - 1)[:wanted] if len(distances) > wanted
+                       else np.arange(len(distances)))
+            candidates += [(distances[i], raw[i], ids[i], diagnoses[i]) for i in nearest.tolist()]
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        matches = []
+        seen = set()
+        for distance, row, record_id, diagnosis in candidates:
+            values = tuple(None if value != value else value for value in row.tolist())
+            if (record_id, values) in seen:
+                continue
+            seen.add((record_id, values))
+            matches.append({
+                'id': record_id,
+                'diagnosis': diagnosis,
+                'distance': round(float(distance), 4),
+                'values': dict(zip(FEATURES, values))
+            })
+            if len(matches) == k:
+                break
+        return matches
@@ -0,0 +1,353 @@
+"""Full-text search over the free-text symptoms of uploaded lab records
+
+Records are copied into a SQLite database (database/symptoms.db by
+default, beside the cohort statistics) with their lab values, and their
+symptoms are indexed by an FTS5 table. A query combines symptom terms with numeric filters on the
+lab values:
+
+    fatigue AND glucose > 180
+    "high BP" OR dizz* age >= 60
+
+Words, prefixes (word*) and quoted phrases may be joined with AND (the
+default), OR and NOT; every comparison must hold for a record to match.
+Numeric filters are answered by the same full-text index: every record also
+carries one token per lab value naming its bucket (see FILTER_BUCKETS), a
+range becomes an OR of bucket tokens, and only records in the buckets at the
+edges of a range are checked against the exact bound. So FTS5 intersects the
+symptom terms with the ranges in its compressed posting lists, and a page of
+results (newest first) never looks up records that can't match. Building
+B-tree indexes on every lab value instead made ingestion several times slower.
+
+Datasets are indexed once per content digest. A whole dataset is indexed by
+index_dataset; the chunks of a streamed upload are staged under a temporary
+key as they arrive (index_frame) and, once its digest is known, adopted by
+commit_staged or dropped if the same content was indexed before.
+"""
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+
+import lab_schema
+
+DEFAULT_DB_PATH = os.environ.get(
+    'SYMPTOM_INDEX_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'symptoms.db')
+)
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+
+# Filterable value -> accepted column names of a lab export
+FILTER_ALIASES = {
+    'age': lab_schema.FIELD_ALIASES['age'],
+    'glucose': lab_schema.FIELD_ALIASES['glucose'],
+    'hba1c': ['hba1c', 'hb_a1c_percent'],
+    'systolic_bp': lab_schema.FIELD_ALIASES['systolic_bp'],
+    'diastolic_bp': lab_schema.FIELD_ALIASES['diastolic_bp'],
+    'cholesterol': lab_schema.FIELD_ALIASES['cholesterol'],
+    'hdl': ['hdl', 'hdl_mg_dl'],
+    'ldl': ['ldl', 'ldl_mg_dl'],
+    'creatinine': ['creatinine', 'creatinine_mg_dl']
+}
+FILTER_FIELDS = list(FILTER_ALIASES)
+
+# Filterable value -> (token prefix, bucket width, lowest bucket edge, number
+# of buckets); values outside the range fall in the first or last bucket.
+# Prefixes are alphanumeric so the tokenizer keeps "glux18" in one piece.
+FILTER_BUCKETS = {
+    'age': ('agex', 5, 0, 30),
+    'glucose': ('glux', 10, 0, 60),
+    'hba1c': ('aicx', 0.5, 2, 36),
+    'systolic_bp': ('sbpx', 10, 40, 23),
+    'diastolic_bp': ('dbpx', 5, 20, 28),
+    'cholesterol': ('cholx', 10, 0, 60),
+    'hdl': ('hdlx', 5, 0, 30),
+    'ldl': ('ldlx', 10, 0, 40),
+    'creatinine': ('creatx', 0.1, 0, 100)
+}
+
+RECORD_COLUMNS = ['source', 'dataset', 'patient_id', 'sex', 'diagnosis', 'symptoms'] + FILTER_FIELDS + ['buckets']
+
+SCHEMA = [
+    f'''CREATE TABLE IF NOT EXISTS symptom_records (
+        id INTEGER PRIMARY KEY, source TEXT, dataset TEXT, patient_id TEXT, sex TEXT,
+        diagnosis TEXT, symptoms TEXT, {', '.join(f'{field} REAL' for field in FILTER_FIELDS)}, buckets TEXT)''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS symptom_fts USING fts5(
+        symptoms, buckets, content='symptom_records', content_rowid='id')''',
+    '''CREATE TRIGGER IF NOT EXISTS symptom_records_ad AFTER DELETE ON symptom_records BEGIN
+        INSERT INTO symptom_fts (symptom_fts, rowid, symptoms, buckets)
+        VALUES ('delete', old.id, old.symptoms, old.buckets);
+    END''',
+    '''CREATE TABLE IF NOT EXISTS symptom_datasets (
+        dataset TEXT PRIMARY KEY, source TEXT, rows INTEGER NOT NULL, indexed_at REAL)''',
+    # Finds the records of a dataset (or staged upload) to adopt or remove
+    'CREATE INDEX IF NOT EXISTS symptom_records_dataset ON symptom_records (dataset)'
+]
+
+_COMPARISONS = {'<': '<', '<=': '<=', '>': '>', '>=': '>=', '=': '=', '==': '=', '!=': '!='}
+_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<comparison>(?P<field>[A-Za-z_][A-Za-z0-9_]*)\s*(?P<op><=|>=|!=|==|<|>|=)\s*(?P<number>-?\d+(?:\.\d+)?))
+      | "(?P<phrase>[^"]*)"
+      | (?P<word>[^\s"()<>=!*]+)(?P<prefix>\*)?
+    )''', re.X)
+_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class QueryError(ValueError):
+    """Raised for a search query that can't be parsed"""
+
+
+def parse_query(query):
+    """Split a query into (FTS5 match expression or None, [(field, operator, value)])"""
+    terms = []  # FTS5 terms and operators, in order
+    filters = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if match is None or match.end() == position:
+            raise QueryError(f"Can't parse the query at: {query[position:]}")
+        position = match.end()
+        if match.group('comparison'):
+            field = match.group('field').lower()
+            if field not in FILTER_ALIASES:
+                raise QueryError(f"Unknown filter field: {field} (use {', '.join(FILTER_FIELDS)})")
+            filters.append((field, _COMPARISONS[match.group('op')], float(match.group('number'))))
+        elif match.group('phrase') is not None:
+            if match.group('phrase').strip():
+                terms.append('"' + match.group('phrase').replace('"', '') + '"')
+        elif match.group('word').upper() in _OPERATORS:
+            terms.append(match.group('word').upper())
+        else:
+            # Quoted, so FTS5 syntax in the word is taken literally
+            terms.append('"' + match.group('word') + '"' + (' *' if match.group('prefix') else ''))
+
+    # Operators left dangling by removed comparisons (or typed twice) are dropped
+    expression = []
+    for term in terms:
+        if term in _OPERATORS:
+            if expression and expression[-1] not in _OPERATORS:
+                expression.append(term)
+            elif term == 'NOT' and not expression:
+                raise QueryError('A query can\'t start with NOT')
+        else:
+            expression.append(term)
+    while expression and expression[-1] in _OPERATORS:
+        expression.pop()
+
+    if not expression and not filters:
+        raise QueryError('Empty query')
+    return (' '.join(expression) or None), filters
+
+
+def bucket_index(field, values):
+    """Bucket of each value of a filter field (NaN values get -1)"""
+    import numpy as np
+
+    _, width, low, count = FILTER_BUCKETS[field]
+    values = np.asarray(values, dtype=float)
+    buckets = np.clip(np.floor((values - low) / width), 0, count - 1)
+    return np.where(np.isnan(values), -1, buckets).astype(np.int64)
+
+
+def bucket_terms(field, op, value):
+    """FTS5 expression over the bucket tokens a comparison can match, or None for any"""
+    prefix, _, _, count = FILTER_BUCKETS[field]
+    bucket = int(bucket_index(field, [value])[0])
+    if op in ('>', '>='):
+        buckets = range(bucket, count)
+    elif op in ('<', '<='):
+        buckets = range(0, bucket + 1)
+    elif op == '=':
+        buckets = [bucket]
+    else:
+        return None
+    return '(' + ' OR '.join(f'{prefix}{b}' for b in buckets) + ')'
+
+
+def frame_to_rows(df, source, dataset=None):
+    """symptom_records rows (RECORD_COLUMNS order) of a lab export DataFrame chunk"""
+    import numpy as np
+    import pandas as pd
+
+    size = len(df)
+
+    def text(name):
+        if name not in df.columns:
+            return [None] * size
+        values = df[name]
+        strings = values.astype(str).to_numpy(dtype=object)
+        strings[values.isna().to_numpy()] = None
+        return strings.tolist()
+
+    gender = lab_schema.find_column(df.columns, 'gender')
+    columns = [
+        [source] * size,
+        [dataset] * size,
+        text('patient_id'),
+        text(gender) if gender else [None] * size,
+        text('diagnosis'),
+        text('symptoms')
+    ]
+    tokens = []
+    for field in FILTER_FIELDS:
+        name = next((alias for alias in FILTER_ALIASES[field] if alias in df.columns), None)
+        if name is None:
+            columns.append([None] * size)
+            continue
+        values = pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=float)
+        # SQLite stores NaN as NULL
+        columns.append(values.tolist())
+        prefix, _, _, count = FILTER_BUCKETS[field]
+        table = np.array([f'{prefix}{b}' for b in range(count)] + [''], dtype=object)
+        tokens.append(table[bucket_index(field, values)].tolist())
+    columns.append([' '.join(row) for row in zip(*tokens)] if tokens else [''] * size)
+    return list(zip(*columns))
+
+
+class SymptomIndex:
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self._ready = False
+
+    def _connect(self):
+        if not self._ready:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._ready = True
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _insert(self, conn, rows):
+        # Take the write lock before reading the last id: otherwise rows another
+        # connection commits in between would be added to symptom_fts twice
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        last_id = conn.execute('SELECT MAX(id) FROM symptom_records').fetchone()[0] or 0
+        conn.executemany(
+            f"INSERT INTO symptom_records ({', '.join(RECORD_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(RECORD_COLUMNS))})", rows)
+        # One bulk insert into the full-text index is several times faster than
+        # a trigger adding each row
+        conn.execute('INSERT INTO symptom_fts (rowid, symptoms, buckets) '
+                     'SELECT id, symptoms, buckets FROM symptom_records WHERE id > ?', (last_id,))
+        return len(rows)
+
+    def index_frame(self, source, df, dataset=None):
+        """Index a DataFrame chunk of a lab export; returns the number of records"""
+        rows = frame_to_rows(df, source, dataset)
+        if not rows:
+            return 0
+        with closing(self._connect()) as conn, conn:
+            return self._insert(conn, rows)
+
+    def is_indexed(self, dataset):
+        with closing(self._connect()) as conn:
+            return conn.execute('SELECT 1 FROM symptom_datasets WHERE dataset = ?', (dataset,)).fetchone() is not None
+
+    def index_dataset(self, dataset, frames, source='uploads'):
+        """Index the DataFrame chunks of a dataset unless it is already indexed
+
+        `dataset` is its content digest, so the same file uploaded twice (or by
+        two processes at once) is indexed once. Returns the number of records
+        added. Each chunk is committed on its own; if indexing fails the
+        dataset's records are removed again so a later attempt starts over.
+        """
+        with closing(self._connect()) as conn:
+            with conn:
+                claimed = conn.execute('INSERT OR IGNORE INTO symptom_datasets VALUES (?, ?, 0, NULL)',
+                                       (dataset, source)).rowcount
+            if not claimed:
+                return 0
+            total = 0
+            try:
+                for df in frames:
+                    with conn:
+                        total += self._insert(conn, frame_to_rows(df, source, dataset))
+                with conn:
+                    conn.execute('UPDATE symptom_datasets SET rows = ?, indexed_at = ? WHERE dataset = ?',
+                                 (total, time.time(), dataset))
+            except BaseException:
+                with conn:
+                    conn.execute('DELETE FROM symptom_records WHERE dataset = ?', (dataset,))
+                    conn.execute('DELETE FROM symptom_datasets WHERE dataset = ?', (dataset,))
+                raise
+        return total
+
+    def commit_staged(self, staged, dataset, source='uploads'):
+        """Adopt the records indexed under the key `staged` as the dataset with
+        content digest `dataset`, or drop them if it is already indexed
+
+        Returns the number of records kept.
+        """
+        with closing(self._connect()) as conn, conn:
+            claimed = conn.execute('INSERT OR IGNORE INTO symptom_datasets VALUES (?, ?, 0, NULL)',
+                                   (dataset, source)).rowcount
+            if not claimed:
+                conn.execute('DELETE FROM symptom_records WHERE dataset = ?', (staged,))
+                return 0
+            total = conn.execute('UPDATE symptom_records SET dataset = ? WHERE dataset = ?', (dataset, staged)).rowcount
+            conn.execute('UPDATE symptom_datasets SET rows = ?, indexed_at = ? WHERE dataset = ?',
+                         (total, time.time(), dataset))
+        return total
+
+    def drop_staged(self, staged):
+        """Remove the records of an upload that stopped before it was committed"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM symptom_records WHERE dataset = ?', (staged,))
+
+    def search(self, query, limit=DEFAULT_LIMIT, before=None):
+        """Newest records matching a query, at most `limit`
+
+        `before` is the id of the last record of the previous page. Raises
+        QueryError for an invalid query.
+        """
+        expression, filters = parse_query(query)
+        if not 0 < limit <= MAX_LIMIT:
+            raise QueryError(f"limit must be between 1 and {MAX_LIMIT}")
+
+        # Bucket tokens narrow the candidates; the exact bounds are checked per record
+        parts = [f'symptoms : ({expression})'] if expression is not None else []
+        parts += [f'buckets : {terms}' for terms in (bucket_terms(*f) for f in filters) if terms is not None]
+        conditions = [f'r.{field} {op} ?' for field, op, _ in filters]
+        params = [value for _, _, value in filters]
+        if before is not None:
+            # On symptom_fts.rowid FTS5 starts the scan there instead of skipping to it
+            conditions.append('symptom_fts.rowid < ?' if parts else 'r.id < ?')
+            params.append(int(before))
+        columns = ', '.join(f'r.{column}' for column in ['id'] + RECORD_COLUMNS[:-1])
+        if parts:
+            sql = (f"SELECT {columns} FROM symptom_fts JOIN symptom_records r ON r.id = symptom_fts.rowid "
+                   f"WHERE symptom_fts MATCH ? {''.join(' AND ' + c for c in conditions)} "
+                   f"ORDER BY symptom_fts.rowid DESC LIMIT ?")
+            params = [' AND '.join(parts)] + params
+        else:
+            # Only != filters: newest records first until the page is full
+            sql = (f"SELECT {columns} FROM symptom_records r WHERE {' AND '.join(conditions)} "
+                   f"ORDER BY r.id DESC LIMIT ?")
+
+        with closing(self._connect()) as conn:
+            try:
+                rows = conn.execute(sql, params + [limit]).fetchall()
+            except sqlite3.OperationalError as e:
+                if 'fts5' in str(e):
+                    raise QueryError(f"Invalid search terms: {e}")
+                raise
+        names = ['id'] + RECORD_COLUMNS[:-1]
+        return [dict(zip(names, row)) for row in rows]
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            records = conn.execute('SELECT COUNT(*) FROM symptom_records').fetchone()[0]
+            datasets = conn.execute('SELECT COUNT(*) FROM symptom_datasets WHERE indexed_at IS NOT NULL').fetchone()[0]
+        return {'records': records, 'datasets': datasets}
@@ -0,0 +1,341 @@
+"""Vectorized synthetic patient generator for training and stress tests
+
+Features are drawn with array operations and labelled by the threshold table
+(thresholds.ENGINE), so millions of patients take seconds. Every feature has
+its own np.random.Generator spawned from one seed, which keeps each column
+reproducible on its own and makes chunked generation produce exactly the same
+rows as generating everything at once.
+
+lab_export_chunks() generates full lab exports instead (the uploads.csv
+columns: HbA1c, lipids, creatinine, vitals, symptoms and a diagnosis), for
+load tests that should look like real uploads. Each patient first gets a
+diagnosis from DIAGNOSIS_MIX; its glycemic, blood pressure and lipid status
+then set the distributions of the related lab values.
+"""
+import functools
+import json
+import os
+
+import numpy as np
+
+import lab_schema
+import thresholds
+
+# Feature -> (distribution, parameters) of the synthetic population
+FEATURE_DISTRIBUTIONS = {
+    'age': ('integers', (18, 80)),
+    'gender': ('category', (['Female', 'Male'],)),
+    'glucose': ('normal', (100, 30)),
+    'systolic_bp': ('normal', (120, 15)),
+    'diastolic_bp': ('normal', (80, 10)),
+    'cholesterol': ('normal', (190, 30)),
+    'bmi': ('normal', (25, 5))
+}
+
+DEFAULT_SEED = 42
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+# Diagnosis -> (share of patients, glycemic status, blood pressure status,
+# lipid status, symptom lists), after the mix in uploads.csv
+DIAGNOSIS_MIX = {
+    'Normal': (0.142, 'normal', 'normal', 'normal',
+               ['routine checkup', 'annual physical', 'no complaints']),
+    'Prediabetes': (0.136, 'prediabetes', 'normal', 'normal',
+                    ['fatigue, thirst', 'increased thirst', 'fatigue']),
+    'Type 2 Diabetes Mellitus': (0.133, 'diabetes', 'normal', 'normal',
+                                 ['frequent urination, blurred vision', 'frequent urination, thirst',
+                                  'blurred vision, fatigue']),
+    'Borderline Hypertension': (0.128, 'normal', 'borderline', 'normal',
+                                ['light headache, mild fatigue', 'light headache', 'routine checkup']),
+    'Hypertension': (0.118, 'normal', 'hypertension', 'normal',
+                     ['headache, dizziness', 'headache, high BP', 'dizziness, fatigue']),
+    'Type 2 Diabetes + Hypertension': (0.116, 'diabetes', 'hypertension', 'normal',
+                                       ['blurred vision, high BP, fatigue', 'frequent urination, headache']),
+    'Type 2 Diabetes + Hypertension + Dyslipidemia': (0.116, 'diabetes', 'hypertension', 'dyslipidemia',
+                                                      ['vision problems, chest pain, high BP',
+                                                       'blurred vision, chest discomfort']),
+    'Dyslipidemia': (0.111, 'normal', 'normal', 'dyslipidemia',
+                     ['chest discomfort, fatigue', 'routine checkup', 'fatigue'])
+}
+
+# Lab value -> (status kind, {status: (mean, standard deviation)}, decimals, (min, max))
+LAB_DISTRIBUTIONS = {
+    'glucose_mg_dl': ('glycemic', {'normal': (93, 14.5), 'prediabetes': (142.5, 18), 'diabetes': (181, 39)},
+                      1, (45, 400)),
+    'hb_a1c_percent': ('glycemic', {'normal': (5.23, 0.4), 'prediabetes': (6.2, 0.5), 'diabetes': (7.95, 1.2)},
+                       1, (3.5, 15)),
+    'systolic_bp': ('bp', {'normal': (120, 10.5), 'borderline': (151, 15), 'hypertension': (150.5, 15)},
+                    1, (75, 230)),
+    'diastolic_bp': ('bp', {'normal': (80, 5), 'borderline': (92, 10), 'hypertension': (96, 10)},
+                     1, (45, 140)),
+    'cholesterol_mg_dl': ('lipid', {'normal': (180, 20), 'dyslipidemia': (250, 25)}, 1, (100, 400)),
+    'hdl_mg_dl': ('lipid', {'normal': (55, 10), 'dyslipidemia': (40.3, 7.3)}, 1, (15, 110)),
+    'ldl_mg_dl': ('lipid', {'normal': (101, 15), 'dyslipidemia': (161, 19.5)}, 1, (40, 260)),
+    'creatinine_mg_dl': (None, (0.9, 0.2), 2, (0.2, 3)),
+    'temp_c': (None, (36.9, 0.31), 1, (35.5, 39.5)),
+    'spO2': (None, (98, 1), 1, (90, 100))
+}
+# Uniformly drawn integers, like uploads.csv
+LAB_INTEGERS = {'age': (20, 80), 'pulse_rate': (70, 100)}
+FEMALE_SHARE = 0.53
+
+
+def feature_generators(seed=DEFAULT_SEED):
+    """One independent np.random.Generator per feature, spawned from `seed`"""
+    streams = np.random.SeedSequence(seed).spawn(len(FEATURE_DISTRIBUTIONS))
+    return {feature: np.random.default_rng(stream)
+            for feature, stream in zip(FEATURE_DISTRIBUTIONS, streams)}
+
+
+def draw_features(generators, n_samples):
+    """Draw the next `n_samples` patients as column arrays
+
+    Gender is returned as integer codes into its category list, which is much
+    cheaper than millions of strings; see gender_categories().
+    """
+    columns = {}
+    for feature, (distribution, params) in FEATURE_DISTRIBUTIONS.items():
+        rng = generators[feature]
+        if distribution == 'integers':
+            columns[feature] = rng.integers(*params, size=n_samples)
+        elif distribution == 'category':
+            columns[feature] = rng.integers(0, len(params[0]), size=n_samples).astype(np.int8)
+        else:
+            columns[feature] = getattr(rng, distribution)(*params, size=n_samples)
+    return columns
+
+
+def gender_categories():
+    return FEATURE_DISTRIBUTIONS['gender'][1][0]
+
+
+def label(columns, engine=None):
+    """Risk label per patient (0 Normal, 1 Moderate, 2 High): its most severe finding"""
+    return (engine or thresholds.ENGINE).severity_batch(columns)
+
+
+def to_frame(columns):
+    """DataFrame of PATIENT_FIELDS with gender as a categorical column"""
+    import pandas as pd
+
+    frame = pd.DataFrame(columns)
+    frame['gender'] = pd.Categorical.from_codes(columns['gender'], gender_categories())
+    return frame
+
+
+def generate(n_samples, seed=DEFAULT_SEED):
+    """Generate (features DataFrame, labels) for `n_samples` synthetic patients"""
+    columns = draw_features(feature_generators(seed), n_samples)
+    return to_frame(columns), label(columns)
+
+
+def iter_chunks(n_samples, seed=DEFAULT_SEED, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (features DataFrame, labels) in chunks adding up to `n_samples` rows
+
+    The concatenated chunks are identical to generate(n_samples, seed).
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive')
+    generators = feature_generators(seed)
+    for start in range(0, n_samples, chunk_size):
+        columns = draw_features(generators, min(chunk_size, n_samples - start))
+        yield to_frame(columns), label(columns)
+
+
+def new_seed():
+    """A fresh random seed, e.g. for a stream that should differ from every other"""
+    return np.random.SeedSequence().entropy
+
+
+def lab_export_generators(seed=DEFAULT_SEED):
+    """Independent generators of the lab export columns, spawned from `seed`"""
+    names = ['diagnosis', 'sex', 'symptoms'] + list(LAB_INTEGERS) + list(LAB_DISTRIBUTIONS)
+    streams = np.random.SeedSequence(seed).spawn(len(names))
+    return {name: np.random.default_rng(stream) for name, stream in zip(names, streams)}
+
+
+@functools.lru_cache(maxsize=None)
+def _lab_values():
+    """Column -> array of every value it can take; rows are drawn as codes into these
+
+    Lab values are rounded to a fixed number of decimals within their bounds,
+    so even they have a small finite set of values.
+    """
+    values = {
+        'sex': np.array(['F', 'M'], dtype=object),
+        'symptoms': np.array([symptoms for entry in DIAGNOSIS_MIX.values() for symptoms in entry[4]], dtype=object),
+        'diagnosis': np.array(list(DIAGNOSIS_MIX), dtype=object)
+    }
+    for name, (low, high) in LAB_INTEGERS.items():
+        values[name] = np.arange(low, high)
+    for name, (_, _, decimals, (low, high)) in LAB_DISTRIBUTIONS.items():
+        scale = 10 ** decimals
+        values[name] = (low * scale + np.arange((high - low) * scale + 1)) / scale
+    return values
+
+
+def _draw_lab_codes(generators, n_samples):
+    """Codes into _lab_values() of the next `n_samples` lab export rows"""
+    shares = np.array([entry[0] for entry in DIAGNOSIS_MIX.values()])
+    diagnosis = generators['diagnosis'].choice(len(shares), size=n_samples, p=shares / shares.sum())
+    codes = {
+        'diagnosis': diagnosis,
+        'sex': (generators['sex'].random(n_samples) >= FEMALE_SHARE).astype(np.intp)
+    }
+    for name, (low, high) in LAB_INTEGERS.items():
+        codes[name] = generators[name].integers(0, high - low, size=n_samples)
+
+    kinds = {'glycemic': 1, 'bp': 2, 'lipid': 3}
+    for name, (kind, params, decimals, (low, high)) in LAB_DISTRIBUTIONS.items():
+        if kind is None:
+            mean, std = params
+        else:
+            # Mean and standard deviation of each diagnosis, picked per row
+            statuses = [entry[kinds[kind]] for entry in DIAGNOSIS_MIX.values()]
+            mean = np.array([params[status][0] for status in statuses])[diagnosis]
+            std = np.array([params[status][1] for status in statuses])[diagnosis]
+        values = np.clip(generators[name].standard_normal(n_samples) * std + mean, low, high)
+        codes[name] = np.rint((values - low) * 10 ** decimals).astype(np.intp)
+
+    # A uniform pick among the diagnosis' symptom lists
+    counts = np.array([len(entry[4]) for entry in DIAGNOSIS_MIX.values()])
+    offsets = np.cumsum(counts) - counts
+    picks = (generators['symptoms'].random(n_samples) * counts[diagnosis]).astype(np.intp)
+    codes['symptoms'] = offsets[diagnosis] + picks
+    return codes
+
+
+def _patient_ids(first_id, n_samples, id_prefix):
+    return [f"{id_prefix}{i:08d}" for i in range(first_id, first_id + n_samples)]
+
+
+def draw_lab_export(generators, n_samples, first_id=1, id_prefix='S'):
+    """Draw the next `n_samples` lab export rows as a DataFrame in UPLOAD_COLUMNS order"""
+    import pandas as pd
+
+    codes = _draw_lab_codes(generators, n_samples)
+    values = _lab_values()
+    columns = {name: values[name][codes[name]] for name in codes}
+    columns['patient_id'] = _patient_ids(first_id, n_samples, id_prefix)
+    return pd.DataFrame({name: columns[name] for name in lab_schema.UPLOAD_COLUMNS})
+
+
+def _csv_field(text):
+    if any(c in text for c in ',"\n\r'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+@functools.lru_cache(maxsize=None)
+def _lab_text(text_format):
+    """Column -> array of each value already formatted as a CSV field or a JSON member"""
+    decimals = {name: spec[2] for name, spec in LAB_DISTRIBUTIONS.items()}
+    tables = {}
+    for name, values in _lab_values().items():
+        if name in decimals:
+            texts = [f"{value:.{decimals[name]}f}" for value in values.tolist()]
+        elif values.dtype == object:
+            texts = [_csv_field(value) if text_format == 'csv' else json.dumps(value)
+                     for value in values.tolist()]
+        else:
+            texts = [str(value) for value in values.tolist()]
+        if text_format == 'ndjson':
+            texts = [f'"{name}":{text}' for text in texts]
+        tables[name] = np.array(texts, dtype=object)
+    return tables
+
+
+def lab_export_text(n_samples, seed=DEFAULT_SEED, text_format='csv', chunk_size=10000, id_prefix='S'):
+    """Yield the rows of lab_export_chunks() as CSV (with a header) or NDJSON text
+
+    Every value is a code into a table of preformatted strings, so producing a
+    chunk is array indexing plus one join per row rather than number
+    formatting. Rows don't depend on `chunk_size`, only on the seed.
+    """
+    if text_format not in ('csv', 'ndjson'):
+        raise ValueError(f"Unsupported format '{text_format}': use csv or ndjson")
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive')
+    tables = _lab_text(text_format)
+    generators = lab_export_generators(seed)
+    if text_format == 'csv':
+        yield ','.join(lab_schema.UPLOAD_COLUMNS) + '\n'
+        row_template = '%s'
+        ids_template = '{}'
+    else:
+        row_template = '{%s}'
+        ids_template = '"patient_id":"{}"'
+
+    for start in range(0, n_samples, chunk_size):
+        size = min(chunk_size, n_samples - start)
+        codes = _draw_lab_codes(generators, size)
+        columns = [
+            [ids_template.format(i) for i in _patient_ids(start + 1, size, id_prefix)] if name == 'patient_id'
+            else tables[name][codes[name]].tolist()
+            for name in lab_schema.UPLOAD_COLUMNS
+        ]
+        yield '\n'.join(map(row_template.__mod__, map(','.join, zip(*columns)))) + '\n'
+
+
+def lab_export_chunks(n_samples, seed=DEFAULT_SEED, chunk_size=DEFAULT_CHUNK_SIZE, id_prefix='S'):
+    """Yield lab export DataFrames in chunks adding up to `n_samples` rows
+
+    Like iter_chunks, the rows don't depend on the chunk size.
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive')
+    generators = lab_export_generators(seed)
+    for start in range(0, n_samples, chunk_size):
+        yield draw_lab_export(generators, min(chunk_size, n_samples - start), start + 1, id_prefix)
+
+
+def write(path, n_samples, seed=DEFAULT_SEED, chunk_size=DEFAULT_CHUNK_SIZE, lab_export=False):
+    """Write a labelled synthetic dataset to a .csv or .parquet file, chunk by chunk
+
+    Labels go in a 'risk_level' column (Normal/Moderate/High), so the file can
+    be used as training data like any labelled lab export. With `lab_export`
+    the rows are full lab exports (see lab_export_chunks), labelled by their
+    'diagnosis'. Parquet needs pyarrow. Returns the number of rows written.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ('.csv', '.parquet'):
+        raise ValueError(f"Unsupported output format '{extension}': use .csv or .parquet")
+
+    writer = None
+    if extension == '.parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError('Writing Parquet requires pyarrow (pip install pyarrow)')
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if lab_export and extension == '.csv':
+        with open(path, 'w', newline='') as f:
+            for text in lab_export_text(n_samples, seed, 'csv'):
+                f.write(text)
+        return n_samples
+    if lab_export:
+        frames = lab_export_chunks(n_samples, seed, chunk_size)
+    else:
+        risk_levels = np.array(lab_schema.RISK_LEVELS, dtype=object)
+        frames = (frame.assign(risk_level=risk_levels[labels])
+                  for frame, labels in iter_chunks(n_samples, seed, chunk_size))
+    rows = 0
+    try:
+        for frame in frames:
+            if extension == '.csv':
+                frame.to_csv(path, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+            else:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            rows += len(frame)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The diagnostic app with a trained model, writing only to a temporary directory"""
+    workdir = tmp_path_factory.mktemp('app')
+    os.environ.update({
+        'PATIENTS_DB': str(workdir / 'patients.db'),
+        'COHORT_STATS_DB': str(workdir / 'cohort_stats.db'),
+        'SYMPTOM_INDEX_DB': str(workdir / 'symptoms.db'),
+        'DATASET_FOLDER': str(workdir / 'datasets'),
+        'JOB_FOLDER': str(workdir / 'jobs'),
+        'MODEL_PATH': str(workdir / 'model.bin'),
+        'MODEL_RELOAD_INTERVAL': '0'
+    })
+    os.environ.pop('MICRO_BATCH_MAX_SIZE', None)
+    os.chdir(workdir)
+
+    import app
+    assert app.ai_system.train_model(500)
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
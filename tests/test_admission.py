@@ -0,0 +1,87 @@
+import io
+import json
+import os
+import time
+
+import admission
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads.csv')
+
+PATIENT = {'age': 52, 'gender': 'Male', 'glucose': 131, 'systolic_bp': 142, 'diastolic_bp': 91,
+           'cholesterol': 236, 'bmi': 29.4}
+
+
+def test_sequential_requests_beyond_the_limit_are_admitted(app_module, client):
+    limit = app_module.admission_control.max_concurrent
+    assert limit > 0
+    # Responses are left unclosed, as the test client and many callers do
+    statuses = [client.post('/api/analyze', json=dict(PATIENT, age=20 + i)).status_code for i in range(limit + 5)]
+    assert statuses == [200] * (limit + 5)
+    assert app_module.admission_control.stats()['in_flight'] == 0
+
+
+def test_streamed_upload_holds_its_slot_until_closed(app_module, client):
+    with open(FIXTURE, 'rb') as f:
+        body = f.read()
+    response = client.post('/api/upload_csv?stream=1&chunksize=100', data=body, content_type='text/csv',
+                           buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    assert app_module.admission_control.stats()['in_flight'] == 1
+    summary = json.loads(b''.join(chunks).splitlines()[-1])
+    response.close()
+    assert summary['summary']['total_records'] == 1000
+    assert app_module.admission_control.stats()['in_flight'] == 0
+
+
+def test_rejections_carry_retry_after():
+    controller = admission.AdmissionController(max_concurrent=1, rate=1, burst=1)
+    ticket = controller.admit('a')
+    try:
+        controller.admit('b')
+    except admission.Rejected as e:
+        assert (e.status, e.retry_after) == (503, 1)
+    else:
+        raise AssertionError('second request admitted past the limit')
+    ticket.release()
+    ticket.release()
+    controller.admit('b').release()
+    try:
+        controller.admit('b')
+    except admission.Rejected as e:
+        assert (e.status, e.retry_after) == (429, 1)
+    else:
+        raise AssertionError('request admitted past the rate limit')
+    assert controller.stats()['in_flight'] == 0
+
+
+def slowed(function, seconds):
+    def call(*args, **kwargs):
+        time.sleep(seconds)
+        return function(*args, **kwargs)
+    return call
+
+
+def test_uploads_past_their_deadline_get_503(app_module, client, monkeypatch):
+    with open(FIXTURE, 'rb') as f:
+        body = f.read().replace(b'P0001,', b'P0001-deadline,', 1)
+    monkeypatch.setattr(app_module.dataset_store, 'ingest_stream',
+                        slowed(app_module.dataset_store.ingest_stream, 0.05))
+    with client.post('/api/upload_csv', data={'file': (io.BytesIO(body), 'late.csv')},
+                     content_type='multipart/form-data', headers={'X-Request-Deadline-Ms': '20'}) as response:
+        assert response.status_code == 503
+        assert 'Deadline exceeded' in response.json['error']
+    assert app_module.admission_control.stats()['in_flight'] == 0
+
+
+def test_streams_past_their_deadline_stop_early(app_module, client, monkeypatch):
+    with open(FIXTURE, 'rb') as f:
+        body = f.read()
+    exceeded = app_module.admission_control.stats()['deadline_exceeded']
+    monkeypatch.setattr(app_module, 'diagnose_chunk', slowed(app_module.diagnose_chunk, 0.02))
+    with client.post('/api/upload_csv?stream=1&chunksize=100', data=body, content_type='text/csv',
+                     headers={'X-Request-Deadline-Ms': '100'}) as response:
+        lines = [json.loads(line) for line in response.get_data().splitlines()]
+    assert 'Deadline exceeded' in lines[-2]['error']
+    assert lines[-1]['summary']['total_records'] < 1000
+    assert app_module.admission_control.stats()['deadline_exceeded'] == exceeded + 1
@@ -0,0 +1,42 @@
+import io
+import os
+import threading
+
+import datasets
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads.csv')
+
+
+def fixture_subset(rows):
+    """The first `rows` records of uploads.csv, as bytes no other test uploads"""
+    with open(FIXTURE, 'rb') as f:
+        return b''.join(f.readlines()[:rows + 1])
+
+
+def uploads_count(app_module):
+    groups = app_module.cohort_store.query(group_by=('source',), filters={'source': 'uploads'})
+    return groups[0]['count'] if groups else 0
+
+
+def test_each_upload_is_recorded_once(app_module, client):
+    body = fixture_subset(250)
+    digest = datasets.DigestReader(io.BytesIO(body))
+    digest.read()
+    before = uploads_count(app_module)
+
+    for _ in range(2):
+        with client.post('/api/upload_csv?stream=1', data=body, content_type='text/csv') as response:
+            assert response.status_code == 200
+            response.get_data()
+    assert app_module.cohort_store.is_recorded(digest.hexdigest())
+    assert uploads_count(app_module) - before == 250
+
+    for query in ('', '?async=1'):
+        with client.post(f'/api/upload_csv{query}', data={'file': (io.BytesIO(body), 'subset.csv')},
+                         content_type='multipart/form-data') as response:
+            assert response.status_code in (200, 202)
+    # A job folds its file in on a background thread
+    for thread in threading.enumerate():
+        if thread.name == 'upload-ingest':
+            thread.join(30)
+    assert uploads_count(app_module) - before == 250
@@ -0,0 +1,41 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+from conftest import REPO
+
+FORM = {'name': 'Trend Patient', 'age': '61', 'gender': 'Female', 'glucose': '142', 'systolic_bp': '138',
+        'diastolic_bp': '88', 'cholesterol': '221'}
+
+
+@pytest.fixture(scope='module')
+def hack1_client(app_module):
+    """The hack1 app on the session's temporary PATIENTS_DB (both apps are called app.py)"""
+    sys.path.insert(0, os.path.join(REPO, 'hack1'))
+    spec = importlib.util.spec_from_file_location('hack1_app', os.path.join(REPO, 'hack1', 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['hack1_app'] = module
+    spec.loader.exec_module(module)
+    import db
+    db.init_db()
+    return module.app.test_client()
+
+
+def test_trend_dates_are_normalized(hack1_client):
+    for glucose in ('142', '150'):
+        assert hack1_client.post('/analyze', data=dict(FORM, glucose=glucose)).status_code == 200
+    url = '/api/patients/Trend%20Patient/trend'
+    points = hack1_client.get(url).json
+    assert points['points'] == 2
+
+    # A bare end date includes that whole day
+    day = points['series']['created_at'][-1][:10]
+    assert hack1_client.get(f'{url}?since={day}&until={day}').json['points'] == 2
+    assert hack1_client.get(f'{url}?since=2999-01-01').json['points'] == 0
+
+    for query in ('until=yesterday', 'since=2024-13-01'):
+        response = hack1_client.get(f'{url}?{query}')
+        assert response.status_code == 400
+        assert 'Invalid date' in response.json['error']
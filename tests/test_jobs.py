@@ -0,0 +1,33 @@
+import jobs
+
+
+def noop(*args):
+    pass
+
+
+def test_publishing_a_model_retires_idle_pools(tmp_path):
+    runner = jobs.JobRunner(str(tmp_path), init_worker=noop, score_block=noop, workers=1)
+    try:
+        runner._acquire_pool('v1', None)
+        runner._acquire_pool('v1', None)
+        runner.use_version('v2')
+        # v1 still has jobs running
+        assert list(runner._pools) == ['v1']
+        runner._release_pool('v1')
+        runner._release_pool('v1')
+        assert runner._pools == {}
+
+        # The current version's pool stays up while idle, until a newer model
+        runner._acquire_pool('v2', None)
+        runner._release_pool('v2')
+        assert list(runner._pools) == ['v2']
+        runner.use_version('v3')
+        assert runner._pools == {}
+    finally:
+        runner.shutdown()
+
+
+def test_serve_splits_the_cores_between_prefork_workers(app_module, monkeypatch):
+    monkeypatch.setattr(app_module.os, 'cpu_count', lambda: 8)
+    assert app_module.job_workers_per_process(4) == 2
+    assert app_module.job_workers_per_process(16) == 1
@@ -0,0 +1,39 @@
+import hashlib
+import json
+
+import pytest
+
+import model_store
+
+
+def write_artifact(path, payload, **header):
+    header = dict({'format': model_store.ARTIFACT_FORMAT, 'model_version': 'test', 'gender_classes': ['F', 'M'],
+                   'sha256': hashlib.sha256(payload).hexdigest(), 'payload_bytes': len(payload)}, **header)
+    with open(path, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n' + payload)
+
+
+@pytest.mark.parametrize('payload', [
+    b'not a pickle',
+    # A pickled instance of a class this code no longer has
+    b'\x80\x04\x95\x1b\x00\x00\x00\x00\x00\x00\x00\x8c\x0eno_such_module\x94\x8c\x05Model\x94\x93\x94)\x81\x94.'
+])
+def test_unloadable_payload_is_an_artifact_error(tmp_path, app_module, payload):
+    path = str(tmp_path / 'model.bin')
+    write_artifact(path, payload)
+    with pytest.raises(model_store.ModelArtifactError):
+        model_store.load_model(path)
+    assert app_module.ai_system.load_model(path) is False
+
+
+def test_corrupt_artifacts_are_rejected(tmp_path):
+    path = str(tmp_path / 'model.bin')
+    write_artifact(path, b'payload', sha256='0' * 64)
+    with pytest.raises(model_store.ModelArtifactError, match='Checksum'):
+        model_store.load_model(path)
+
+    with open(path, 'wb') as f:
+        f.write(b'[1, 2]\npayload')
+    for load in (model_store.load_model, model_store.read_header):
+        with pytest.raises(model_store.ModelArtifactError):
+            load(path)
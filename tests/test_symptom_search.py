@@ -0,0 +1,91 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import pandas as pd
+
+import datasets
+import symptom_search
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads.csv')
+
+
+def test_each_upload_is_indexed_once(app_module, client):
+    with open(FIXTURE, 'rb') as f:
+        body = b''.join(f.readlines()[:151])
+    digest = datasets.DigestReader(io.BytesIO(body))
+    digest.read()
+
+    for _ in range(2):
+        with client.post('/api/upload_csv?stream=1&chunksize=50', data=body, content_type='text/csv') as response:
+            response.get_data()
+    for query in ('', '?async=1'):
+        with client.post(f'/api/upload_csv{query}', data={'file': (io.BytesIO(body), 'subset.csv')},
+                         content_type='multipart/form-data') as response:
+            assert response.status_code in (200, 202)
+    for thread in threading.enumerate():
+        if thread.name in ('symptom-indexing', 'upload-ingest'):
+            thread.join(30)
+
+    assert app_module.symptom_index.is_indexed(digest.hexdigest())
+    with closing(sqlite3.connect(app_module.symptom_index.path)) as conn:
+        counts = dict(conn.execute("SELECT dataset LIKE 'staged:%', COUNT(*) FROM symptom_records "
+                                   "WHERE dataset = ? OR dataset LIKE 'staged:%' GROUP BY 1",
+                                   (digest.hexdigest(),)))
+    assert counts == {0: 150}
+
+    results = app_module.symptom_index.search('routine', limit=1000)
+    keys = [(r['dataset'], r['patient_id']) for r in results]
+    assert len(keys) == len(set(keys))
+
+
+def test_interrupted_stream_leaves_nothing_staged(app_module, client):
+    with open(FIXTURE, 'rb') as f:
+        body = b''.join(f.readlines()[:400])
+    response = client.post('/api/upload_csv?stream=1&chunksize=50', data=body, content_type='text/csv',
+                           buffered=False)
+    next(iter(response.response))
+    response.close()
+    with closing(sqlite3.connect(app_module.symptom_index.path)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM symptom_records WHERE dataset LIKE 'staged:%'").fetchone()[0] == 0
+
+
+class SlowWriterIndex(symptom_search.SymptomIndex):
+    """Pauses after each statement that reads the last id, so writers interleave there"""
+
+    def _connect(self):
+        conn = super()._connect()
+        previous = ['']
+
+        def trace(sql):
+            if previous[0].startswith('SELECT MAX(id)'):
+                time.sleep(0.005)
+            previous[0] = sql
+        conn.set_trace_callback(trace)
+        return conn
+
+
+def test_concurrent_indexing_keeps_the_full_text_index_intact(tmp_path):
+    index = SlowWriterIndex(str(tmp_path / 'symptoms.db'))
+    index.stats()
+    df = pd.read_csv(FIXTURE)
+
+    def index_chunks(dataset):
+        for start in range(0, 500, 100):
+            index.index_frame('uploads', df.iloc[start:start + 100], dataset)
+    threads = [threading.Thread(target=index_chunks, args=(f'dataset-{i}',)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with closing(sqlite3.connect(index.path)) as conn:
+        # rank 1 also compares the index with the records it was built from
+        conn.execute("INSERT INTO symptom_fts (symptom_fts, rank) VALUES ('integrity-check', 1)")
+        with conn:
+            conn.execute("DELETE FROM symptom_records WHERE dataset = 'dataset-0'")
+        conn.execute("INSERT INTO symptom_fts (symptom_fts, rank) VALUES ('integrity-check', 1)")
+        assert conn.execute('SELECT COUNT(*) FROM symptom_records').fetchone()[0] == 1500
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lab_schema
+import tree_scorer
+
+# The model is fitted on a DataFrame and scored on bare arrays, as in serving
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads.csv')
+
+
+def lab_export_features(app_module, bundle):
+    """uploads.csv as a feature matrix, encoded the way verify-scorer does"""
+    patients = lab_schema.frame_to_patients(pd.read_csv(FIXTURE))
+    features = np.column_stack([
+        np.asarray([bundle.gender_codes.get(g, 0) for g in patients['gender']], dtype=float)
+        if field == 'gender' else np.asarray(patients[field], dtype=float)
+        for field in app_module.PATIENT_FIELDS
+    ])
+    # No BMI in the export: use the training mean so every row is scored
+    features[np.isnan(features)] = 25.0
+    return features
+
+
+@pytest.fixture(scope='module', params=['tree-d3', 'tree-d5', 'tree-d12'])
+def bundle(request, app_module):
+    X, labels = app_module.ai_system.synthetic_training_data(2000)
+    return app_module.ai_system.fit_model(X, labels, {'model_name': request.param})
+
+
+@pytest.fixture(scope='module')
+def datasets(app_module, bundle):
+    X, _ = app_module.ai_system.synthetic_training_data(5000, seed=7)
+    return {'synthetic': bundle.encode_features(X), 'uploads.csv': lab_export_features(app_module, bundle)}
+
+
+@pytest.mark.parametrize('name', ['synthetic', 'uploads.csv'])
+def test_compiled_tree_matches_sklearn(bundle, datasets, name):
+    features = datasets[name]
+    assert bundle.compiled is not None
+    assert tree_scorer.verify_against_sklearn(bundle.model, bundle.compiled, features) == 0
+
+    np.testing.assert_array_equal(bundle.compiled.apply(features), bundle.model.apply(features))
+    np.testing.assert_array_equal(bundle.compiled.predict_proba(features), bundle.model.predict_proba(features))
+    np.testing.assert_array_equal(bundle.compiled.predict(features), bundle.model.predict(features))
+
+    expected_proba = bundle.model.predict_proba(features)
+    expected_leaf = bundle.model.apply(features)
+    for i, row in enumerate(features[:200].tolist()):
+        _, proba, leaf = bundle.compiled.score_one(row)
+        assert leaf == expected_leaf[i]
+        assert proba == expected_proba[i].tolist()
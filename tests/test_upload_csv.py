@@ -0,0 +1,25 @@
+import io
+import os
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads.csv')
+
+
+def upload(client, query):
+    with open(FIXTURE, 'rb') as f:
+        body = f.read()
+    with client.post(f'/api/upload_csv{query}', data={'file': (io.BytesIO(body), 'uploads.csv')},
+                     content_type='multipart/form-data') as response:
+        return response.status_code, response.mimetype, response.get_json()
+
+
+def test_false_flags_keep_the_plain_upload(client):
+    for query in ('?stream=0', '?async=false', '?stream=no&async=0', '?async='):
+        status, mimetype, payload = upload(client, query)
+        assert (status, mimetype) == (200, 'application/json')
+        assert payload['total_records'] == 1000
+
+
+def test_true_flags_switch_modes(client):
+    status, _, payload = upload(client, '?async=TRUE')
+    assert status in (200, 202) and 'status_url' in payload
+    assert upload(client, '?stream=yes')[1] == 'application/x-ndjson'
@@ -0,0 +1,262 @@
+"""Clinical cut-offs shared by the rule engine, charts, training labels and the hack1 app
+
+Every cut-off lives once in THRESHOLD_TABLE. Each check lists its bands from
+lowest to highest; a band's limit is either "below" (the band holds values
+< limit) or "upto" (values <= limit), and the last band has no limit. Checks
+over several fields (blood pressure) give one limit per field and land in the
+highest band any of their fields reaches.
+
+The table is compiled once into sorted NumPy edge arrays, so classifying a
+value is a binary search (searchsorted for batches, bisect for single values)
+instead of an if/elif chain. Set THRESHOLDS_FILE to a JSON file with any of
+the table's sections to tune ranges without code changes.
+"""
+import bisect
+import json
+import os
+
+import numpy as np
+
+THRESHOLD_TABLE = {
+    # Findings reported by rule_based_analysis, in report order.
+    # severity: 1 = borderline, 2 = high; also used to label training data.
+    'findings': [
+        {
+            'name': 'glucose',
+            'fields': ['glucose'],
+            'bands': [
+                {'below': 100},
+                {'below': 126, 'severity': 1, 'condition': 'Prediabetes Risk', 'risk_factor': 'Elevated glucose level'},
+                {'severity': 2, 'condition': 'Diabetes', 'risk_factor': 'High glucose level'}
+            ]
+        },
+        {
+            'name': 'blood_pressure',
+            'fields': ['systolic_bp', 'diastolic_bp'],
+            'bands': [
+                {'below': {'systolic_bp': 130, 'diastolic_bp': 85}},
+                {'below': {'systolic_bp': 140, 'diastolic_bp': 90}, 'severity': 1,
+                 'condition': 'Elevated Blood Pressure', 'risk_factor': 'Elevated blood pressure'},
+                {'severity': 2, 'condition': 'Hypertension', 'risk_factor': 'High blood pressure'}
+            ]
+        },
+        {
+            'name': 'cholesterol',
+            'fields': ['cholesterol'],
+            'bands': [
+                {'below': 200},
+                {'below': 240, 'severity': 1, 'condition': 'Borderline High Cholesterol',
+                 'risk_factor': 'Borderline cholesterol level'},
+                {'severity': 2, 'condition': 'High Cholesterol', 'risk_factor': 'High cholesterol level'}
+            ]
+        },
+        {
+            'name': 'bmi',
+            'fields': ['bmi'],
+            'bands': [
+                {'below': 18.5, 'severity': 1, 'condition': 'Underweight', 'risk_factor': 'Low BMI'},
+                {'below': 25},
+                {'below': 30, 'severity': 1, 'condition': 'Overweight', 'risk_factor': 'Elevated BMI'},
+                {'severity': 2, 'condition': 'Obesity', 'risk_factor': 'High BMI'}
+            ]
+        }
+    ],
+
+    # Overall risk level by number of findings
+    'risk_levels': {
+        'name': 'risk_level',
+        'fields': ['findings'],
+        'bands': [
+            {'below': 1, 'label': 'Normal', 'emoji': '🟢'},
+            {'below': 3, 'label': 'Moderate', 'emoji': '🟡'},
+            {'label': 'High', 'emoji': '🔴'}
+        ]
+    },
+
+    # Chart colors (low / normal / elevated / high) and normal ranges, in chart order
+    'chart': [
+        {
+            'name': 'Glucose',
+            'fields': ['glucose'],
+            'normal_range': {'min': 70, 'max': 100},
+            'bands': [
+                {'below': 70, 'level': 'low'},
+                {'upto': 100, 'level': 'normal'},
+                {'upto': 126, 'level': 'elevated'},
+                {'level': 'high'}
+            ]
+        },
+        {
+            'name': 'Systolic BP',
+            'fields': ['systolic_bp'],
+            'normal_range': {'min': 90, 'max': 120},
+            'bands': [
+                {'below': 90, 'level': 'low'},
+                {'upto': 120, 'level': 'normal'},
+                {'upto': 130, 'level': 'elevated'},
+                {'level': 'high'}
+            ]
+        },
+        {
+            'name': 'Diastolic BP',
+            'fields': ['diastolic_bp'],
+            'normal_range': {'min': 60, 'max': 80},
+            'bands': [
+                {'below': 60, 'level': 'low'},
+                {'upto': 80, 'level': 'normal'},
+                {'upto': 85, 'level': 'elevated'},
+                {'level': 'high'}
+            ]
+        },
+        {
+            'name': 'Cholesterol',
+            'fields': ['cholesterol'],
+            'normal_range': {'min': 0, 'max': 200},
+            'bands': [
+                {'below': 200, 'level': 'normal'},
+                {'below': 240, 'level': 'elevated'},
+                {'level': 'high'}
+            ]
+        },
+        {
+            'name': 'BMI',
+            'fields': ['bmi'],
+            'normal_range': {'min': 18.5, 'max': 24.9},
+            'bands': [
+                {'below': 18.5, 'level': 'low'},
+                {'below': 25, 'level': 'normal'},
+                {'below': 30, 'level': 'elevated'},
+                {'level': 'high'}
+            ]
+        }
+    ],
+
+    # Quick screening used by the hack1 form app
+    'screening': [
+        {
+            'name': 'Glucose',
+            'fields': ['glucose'],
+            'bands': [
+                {'upto': 140, 'status': 'normal', 'message': 'Normal glucose level'},
+                {'status': 'risk', 'message': 'Possible diabetes risk'}
+            ]
+        },
+        {
+            'name': 'Blood Pressure',
+            'fields': ['systolic_bp', 'diastolic_bp'],
+            'bands': [
+                {'upto': {'systolic_bp': 140, 'diastolic_bp': 90}, 'status': 'normal', 'message': 'Normal blood pressure'},
+                {'status': 'risk', 'message': 'Possible hypertension'}
+            ]
+        },
+        {
+            'name': 'Cholesterol',
+            'fields': ['cholesterol'],
+            'bands': [
+                {'upto': 200, 'status': 'normal', 'message': 'Normal cholesterol level'},
+                {'status': 'risk', 'message': 'High cholesterol risk'}
+            ]
+        }
+    ]
+}
+
+# Band returned for values that weren't measured (NaN)
+MISSING_BAND = {'missing': True}
+
+
+class CompiledCheck:
+    """One check of the table with its band limits compiled to sorted edge arrays"""
+
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.fields = list(spec['fields'])
+        self.bands = [{k: v for k, v in band.items() if k not in ('below', 'upto')}
+                      for band in spec['bands']]
+        self.spec = spec
+        # Index of MISSING_BAND, appended after the real bands
+        self.missing = len(self.bands)
+        self.bands.append(MISSING_BAND)
+
+        # "upto x" is "below the next float after x", so every limit becomes a
+        # strict upper edge and a single right-sided search finds the band
+        self.edges = {}
+        for field in self.fields:
+            edges = []
+            for band in spec['bands'][:-1]:
+                if 'below' in band:
+                    limit = band['below']
+                    edge = float(limit[field] if isinstance(limit, dict) else limit)
+                elif 'upto' in band:
+                    limit = band['upto']
+                    edge = float(np.nextafter(limit[field] if isinstance(limit, dict) else limit, np.inf))
+                else:
+                    raise ValueError(f"Band of '{self.name}' needs a 'below' or 'upto' limit")
+                edges.append(edge)
+            if edges != sorted(edges):
+                raise ValueError(f"Band limits of '{self.name}' must increase for {field}")
+            self.edges[field] = np.array(edges)
+        self._edge_lists = {field: edges.tolist() for field, edges in self.edges.items()}
+
+    def classify(self, values):
+        """Band index for one record (mapping of field -> number)"""
+        band = -1
+        for field in self.fields:
+            value = values[field]
+            if value != value:  # NaN: not measured
+                continue
+            band = max(band, bisect.bisect_right(self._edge_lists[field], value))
+        return self.missing if band < 0 else band
+
+    def classify_batch(self, columns):
+        """Band index for each row of float column arrays"""
+        band = None
+        for field in self.fields:
+            values = np.asarray(columns[field], dtype=float)
+            field_band = np.searchsorted(self.edges[field], values, side='right')
+            field_band = np.where(np.isnan(values), -1, field_band)
+            band = field_band if band is None else np.maximum(band, field_band)
+        return np.where(band < 0, self.missing, band)
+
+    def band(self, values):
+        return self.bands[self.classify(values)]
+
+
+class ThresholdEngine:
+    """The whole threshold table, compiled"""
+
+    def __init__(self, table):
+        self.table = table
+        self.findings = [CompiledCheck(spec) for spec in table['findings']]
+        self.risk_levels = CompiledCheck(table['risk_levels'])
+        self.chart = [CompiledCheck(spec) for spec in table['chart']]
+        self.screening = {spec['name']: CompiledCheck(spec) for spec in table['screening']}
+
+    def risk_level(self, n_findings):
+        """Overall risk level band for a number of findings"""
+        return self.risk_levels.band({'findings': n_findings})
+
+    def severity_batch(self, columns):
+        """Highest finding severity (0, 1 or 2) of each row, e.g. for training labels"""
+        severity = None
+        for check in self.findings:
+            levels = np.array([band.get('severity', 0) for band in check.bands])
+            check_severity = levels[check.classify_batch(columns)]
+            severity = check_severity if severity is None else np.maximum(severity, check_severity)
+        return severity
+
+
+def load_table(path=None):
+    """The built-in table, with sections overridden from a JSON file if given"""
+    table = dict(THRESHOLD_TABLE)
+    path = path or os.environ.get('THRESHOLDS_FILE')
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        unknown = set(overrides) - set(THRESHOLD_TABLE)
+        if unknown:
+            raise ValueError(f"Unknown threshold sections in {path}: {', '.join(sorted(unknown))}")
+        table.update(overrides)
+    return table
+
+
+ENGINE = ThresholdEngine(load_table())